@@ -9,4 +9,5 @@ else
 	echo "Offline"
 fi
 sleep 30
-/home/pi/.local/bin/uos_aruco_detector
+# Replace the shell, so that systemctl reload signals the detector
+exec /home/pi/.local/bin/uos_aruco_detector
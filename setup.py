@@ -105,6 +105,9 @@ def run_setup():
                 "uos_aruco_detector = uos_aruco_detector.aruco_localisation:main",
                 "uos_aruco_detector_client = uos_aruco_detector.client_example:main",
                 "uos_aruco_camera_calibration = uos_aruco_detector.camera_calibration:main",
+                "uos_aruco_log_export = uos_aruco_detector.binary_log:main",
+                "uos_aruco_benchmark = uos_aruco_detector.benchmark:main",
+                "uos_aruco_recorder = uos_aruco_detector.frame_recorder:main",
             ],
         },
         include_package_data=True,
@@ -1,47 +1,457 @@
+import time
+from dataclasses import dataclass, field
+
 import cv2
 import cv2.aruco as aruco
 import numpy as np
 from scipy.spatial.transform import Rotation
 
+from .calibration_store import scale_camera_matrix
+from .undistort import UNDISTORT_MODES, Undistortion
+
+DICTIONARY = aruco.DICT_4X4_100
+
+
+@dataclass
+class FrameInfo:
+    sequence: int = 0
+    capture_time: float = 0.0  # [s] epoch when the frame was read
+    capture_monotonic: float = 0.0  # [s] time.monotonic() when the frame was read
+    timings: dict = field(default_factory=dict)  # [s] duration of each stage
+
+
+def dictionary_size():
+    """Number of markers in the ArUco dictionary, i.e. the number of tag ids."""
+    return len(aruco.getPredefinedDictionary(DICTIONARY).bytesList)
+
+
+def merge_boxes(boxes):
+    """Merge overlapping [x0, y0, x1, y1] boxes into their union."""
+    boxes = [list(b) for b in boxes]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i + 1, len(boxes)):
+                a, b = boxes[i], boxes[j]
+                if a[0] <= b[2] and b[0] <= a[2] and a[1] <= b[3] and b[1] <= a[3]:
+                    boxes[i] = [
+                        min(a[0], b[0]),
+                        min(a[1], b[1]),
+                        max(a[2], b[2]),
+                        max(a[3], b[3]),
+                    ]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return boxes
+
 
 class ArucoDetector:
-    def __init__(self, camera_matrix, camera_distortion, marker_size, frame_type):
+    def __init__(
+        self,
+        camera_matrix,
+        camera_distortion,
+        marker_size,
+        frame_type,
+        tracking=False,
+        full_search_interval=10,
+        roi_padding=0.5,
+        scale=1.0,
+        refine_window=5,
+        refine_iterations=30,
+        refine_epsilon=0.01,
+        undistort="none",
+        undistort_cache=None,
+        image_size=None,
+        capture=None,
+    ):
+        """Detect ArUco markers and estimate their pose.
+
+        Parameters
+        ----------
+        camera_matrix : list
+            3x3 camera intrinsic matrix
+        camera_distortion : list
+            Distortion coefficients of the camera
+        marker_size : float
+            Side of the markers in metres
+        frame_type : str
+            Reference frame used to draw the marker axes, NED or ENU
+        tracking : bool
+            Search the markers only around their last known location, and the
+            full frame every full_search_interval frames or when a tag is lost
+        full_search_interval : int
+            Number of frames between full frame searches when tracking
+        roi_padding : float
+            Padding added around each tracked marker, relative to its size
+        scale : float
+            Full frame searches look for candidates in the image downscaled by
+            this factor, and refine their corners at full resolution
+        refine_window : int
+            Half size in pixels of the sub-pixel corner refinement window
+        refine_iterations : int
+            Maximum number of sub-pixel refinement iterations
+        refine_epsilon : float
+            Corner displacement in pixels at which the refinement stops
+        undistort : str
+            Lens distortion handling. none passes the distortion to the pose
+            estimation, image detects the markers in rectified frames and
+            points only undistorts the detected corners
+        undistort_cache : str
+            Folder caching the rectification maps of the image mode. None
+            computes them when the first frame arrives
+        image_size : tuple
+            (width, height) of the calibration images. The camera matrix is
+            rescaled when the frames have another resolution. None uses it as
+            it is
+        capture : object
+            Frame source with the read() interface of cv2.VideoCapture. If
+            None, the first camera is opened
+        """
         # --- Get the camera calibration path and parameters
         self.camera_matrix = np.array(camera_matrix)
         self.camera_distortion = np.array(camera_distortion)
+        # -- Calibration as stored, rescaled to the size of the first frame
+        self.calibrated_matrix = self.camera_matrix
+        self.calibrated_size = tuple(image_size) if image_size else None
+        self.image_size = None
         self.marker_size = marker_size
         self.frame_type = frame_type
         # --- Define the aruco dictionary
-        self.aruco_dict = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
+        self.aruco_dict = aruco.getPredefinedDictionary(DICTIONARY)
         self.parameters = aruco.DetectorParameters_create()
+        # -- Sequence number of the next captured frame
+        self.sequence = 0
+        self.frame_count = 0
+        self.configure(
+            tracking,
+            full_search_interval,
+            roi_padding,
+            scale,
+            refine_window,
+            refine_iterations,
+            refine_epsilon,
+            undistort,
+            undistort_cache,
+        )
+        # -- (marker size, settings of configure()) applied before the next frame
+        self.pending_settings = None
+        # -- Gray, rectified and downscaled images, reused from frame to frame
+        self.gray = None
+        self.rectified = None
+        self.small = None
 
         # --- Capture the videocamera (this may also be a video or a picture)
-        self.cap = cv2.VideoCapture(0)
+        if capture is None:
+            capture = cv2.VideoCapture(0)
+        self.cap = capture
 
-    def loop(self):
-        # -- Read the frame
-        ret, frame = self.cap.read()
+    @property
+    def finished(self):
+        """True once the capture has no more frames, e.g. at the end of a video."""
+        return getattr(self.cap, "finished", False)
+
+    def configure(
+        self,
+        tracking=False,
+        full_search_interval=10,
+        roi_padding=0.5,
+        scale=1.0,
+        refine_window=5,
+        refine_iterations=30,
+        refine_epsilon=0.01,
+        undistort="none",
+        undistort_cache=None,
+    ):
+        """Set the detection settings, described in ArucoDetector."""
+        if undistort not in UNDISTORT_MODES:
+            raise ValueError("Unknown undistort mode {}".format(undistort))
+        if full_search_interval < 1:
+            raise ValueError("full_search_interval must be at least 1")
+        self.undistort = undistort
+        self.undistort_cache = undistort_cache
+        self.undistortion = None
+        # -- Distortion passed to the pose estimation
+        self.pose_distortion = self.camera_distortion
+        if undistort != "none":
+            self.undistortion = Undistortion(
+                self.camera_matrix, self.camera_distortion, undistort_cache
+            )
+            self.pose_distortion = np.zeros(5)
+
+        # --- Region of interest tracking
+        self.tracking = tracking
+        self.full_search_interval = full_search_interval
+        self.roi_padding = roi_padding
+        self.full_search_requested = True
+        # -- Last corners (4, 2) and displacement per frame of each tracked id
+        self.tracks = {}
+
+        # --- Multi-scale detection
+        self.scale = scale
+        self.refine_window = (refine_window, refine_window)
+        self.refine_criteria = (
+            cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER,
+            refine_iterations,
+            refine_epsilon,
+        )
+
+    def reconfigure(self, marker_size, settings):
+        """Change the marker size and the settings of configure().
+
+        They are applied when the next frame is detected, so this can be
+        called while another thread detects.
+        """
+        self.pending_settings = (marker_size, settings)
+
+    def grab(self, image=None):
+        """Read the next frame from the capture device.
+
+        Parameters
+        ----------
+        image : np.ndarray
+            Preallocated frame to read into, e.g. a slot of a SharedFrameRing.
+            The returned frame may be a new array if the size does not match
+
+        Returns
+        -------
+        np.ndarray
+            The captured frame, or None if no frame could be grabbed.
+        FrameInfo
+            Sequence number, capture time and grab duration of the frame
+        """
+        start = time.monotonic()
+        ret, frame = self.cap.read(image)
         # Check if frame is not empty
         if not ret:
-            print("Could not grab a frame")
-            return None, None, None, None, None
+            if not self.finished:
+                print("Could not grab a frame")
+            return None, None
+        # -- Also rescale here, as the detector of the pipelines with workers
+        # -- only grabs, but draws the axes with the camera matrix
+        if (frame.shape[1], frame.shape[0]) != self.image_size:
+            self.set_image_size((frame.shape[1], frame.shape[0]))
+        now = time.monotonic()
+        info = FrameInfo(self.sequence, time.time(), now, {"grab": now - start})
+        self.sequence += 1
+        return frame, info
+
+    def detect(self, frame, info=None, gray=None):
+        """Detect the ArUco markers in a frame and estimate their poses.
 
-        # -- Convert to gray scale
-        gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
-        # -- Find the aruco markers
+        Parameters
+        ----------
+        frame : np.ndarray
+            BGR frame as returned by grab()
+        info : FrameInfo
+            Information of the frame, where the detect and pose durations are
+            stored
+        gray : np.ndarray
+            Gray version of the frame if it is already available, e.g. from a
+            SharedFrameRing
+
+        Returns
+        -------
+        tuple
+            Detected corners, ids, rotation vectors and translation vectors
+        """
+        start = time.monotonic()
+        if self.pending_settings is not None:
+            marker_size, settings = self.pending_settings
+            self.pending_settings = None
+            self.marker_size = marker_size
+            self.configure(**settings)
+        if (frame.shape[1], frame.shape[0]) != self.image_size:
+            self.set_image_size((frame.shape[1], frame.shape[0]))
+        corners, ids = self.locate_markers(frame, gray)
+        located = time.monotonic()
+        # -- Estimate the pose of the aruco markers
+        rvecs, tvecs = self.estimate_poses(corners, ids)
+        if info is not None:
+            info.timings["detect"] = located - start
+            info.timings["pose"] = time.monotonic() - located
+        return corners, ids, rvecs, tvecs
+
+    def set_image_size(self, size):
+        """Rescale the camera matrix to frames of the given (width, height)."""
+        self.image_size = size
+        if self.calibrated_size is None:
+            return
+        camera_matrix = self.calibrated_matrix
+        if size != self.calibrated_size:
+            print(
+                "Rescaling the {}x{} calibration to {}x{} frames".format(
+                    *self.calibrated_size, *size
+                )
+            )
+            camera_matrix = scale_camera_matrix(
+                self.calibrated_matrix, self.calibrated_size, size
+            )
+        if camera_matrix is self.camera_matrix:
+            return
+        self.camera_matrix = camera_matrix
+        if self.undistortion is not None:
+            self.undistortion = Undistortion(
+                self.camera_matrix, self.camera_distortion, self.undistort_cache
+            )
+
+    def locate_markers(self, frame, gray=None):
+        """Find the corners and ids of the ArUco markers in a BGR frame."""
+        # -- Convert to gray scale, into the image of the previous frame
+        if gray is None:
+            if frame.ndim == 2:
+                gray = frame
+            else:
+                self.gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=self.gray)
+                gray = self.gray
+        if self.undistort != "image":
+            # -- Find the aruco markers
+            if self.tracking:
+                return self.track_markers(gray)
+            return self.find_markers(gray)
+        # -- Find them in the rectified image, and give their corners in the
+        # -- frame so that they can be drawn on it
+        self.rectified = self.undistortion.rectify(gray, self.rectified)
+        if self.tracking:
+            corners, ids = self.track_markers(self.rectified)
+        else:
+            corners, ids = self.find_markers(self.rectified)
+        corners = tuple(self.undistortion.distort_points(c) for c in corners)
+        return corners, ids
+
+    def find_markers(self, gray, roi=False):
+        """Find the ArUco markers in a grayscale image, or in a region of it.
+
+        If a scale below 1 is set, the candidates are found in the downscaled
+        image and their corners are refined in the full resolution one. The
+        downscaled image of a whole frame is reused for the next frame.
+        """
+        if self.scale >= 1.0:
+            return self.detect_markers(gray)
+        small = cv2.resize(
+            gray,
+            None,
+            dst=None if roi else self.small,
+            fx=self.scale,
+            fy=self.scale,
+            interpolation=cv2.INTER_AREA,
+        )
+        if not roi:
+            self.small = small
+        corners, ids = self.detect_markers(small)
+        if ids is None:
+            return corners, ids
+        # -- Map pixel centres back to the full resolution image
+        corners = tuple(
+            self.refine_corners(gray, (c + 0.5) / self.scale - 0.5) for c in corners
+        )
+        return corners, ids
+
+    def detect_markers(self, gray):
+        """Run the ArUco detector on a grayscale image."""
         corners, ids, _ = aruco.detectMarkers(
             gray, self.aruco_dict, parameters=self.parameters
         )
+        # corners = aruco.refineDetectedMarkers(gray, corners, rejectedImgPoints)
+        return corners, ids
+
+    def refine_corners(self, gray, corners):
+        """Refine the (1, 4, 2) corners of a marker with sub-pixel accuracy."""
+        points = np.ascontiguousarray(corners, dtype=np.float32).reshape(-1, 1, 2)
+        points = cv2.cornerSubPix(
+            gray, points, self.refine_window, (-1, -1), self.refine_criteria
+        )
+        return points.reshape(1, 4, 2)
+
+    def estimate_poses(self, corners, ids):
+        """Estimate the pose of the detected ArUco markers."""
         rvecs = []
         tvecs = []
-        # -- Estimate the pose of the aruco markers
         if ids is not None and ids.size > 0:
-            # -- Get the corners of the aruco markers
-            # corners = aruco.refineDetectedMarkers(gray, corners, rejectedImgPoints)
-            # -- Estimate the pose of the aruco markers
+            if self.undistortion is not None:
+                corners = tuple(self.undistortion.undistort_points(c) for c in corners)
             rvecs, tvecs, _ = aruco.estimatePoseSingleMarkers(
-                corners, self.marker_size, self.camera_matrix, self.camera_distortion
+                corners, self.marker_size, self.camera_matrix, self.pose_distortion
             )
+        return rvecs, tvecs
+
+    def track_markers(self, gray):
+        """Find the ArUco markers around their predicted location.
+
+        The full image is searched every full_search_interval frames, when
+        there is nothing to track or when a tracked marker was lost.
+        """
+        self.frame_count += 1
+        if (
+            self.full_search_requested
+            or not self.tracks
+            or self.frame_count % self.full_search_interval == 0
+        ):
+            self.full_search_requested = False
+            corners, ids = self.find_markers(gray)
+        else:
+            corners, ids = self.find_markers_in_rois(gray)
+        self.update_tracks(corners, ids)
+        return corners, ids
+
+    def find_markers_in_rois(self, gray):
+        """Find the ArUco markers inside the padded boxes of the tracked ones.
+
+        The boxes are searched like the full image, at the same scale and
+        with the same corner refinement, so tracking does not change the
+        accuracy of the corners.
+        """
+        height, width = gray.shape[:2]
+        boxes = []
+        for last_corners, velocity in self.tracks.values():
+            predicted = last_corners + velocity
+            x0, y0 = predicted.min(axis=0)
+            x1, y1 = predicted.max(axis=0)
+            padding = self.roi_padding * max(x1 - x0, y1 - y0)
+            boxes.append([x0 - padding, y0 - padding, x1 + padding, y1 + padding])
+
+        corners = []
+        ids = []
+        for x0, y0, x1, y1 in merge_boxes(boxes):
+            x0, y0 = max(int(x0), 0), max(int(y0), 0)
+            x1, y1 = min(int(np.ceil(x1)), width), min(int(np.ceil(y1)), height)
+            if x1 - x0 < 8 or y1 - y0 < 8:
+                continue
+            roi_corners, roi_ids = self.find_markers(gray[y0:y1, x0:x1], roi=True)
+            if roi_ids is None:
+                continue
+            offset = np.array([x0, y0], dtype=np.float32)
+            for c, i in zip(roi_corners, roi_ids):
+                corners.append(c + offset)
+                ids.append(i)
+        if len(ids) == 0:
+            return (), None
+        return tuple(corners), np.array(ids, dtype=np.int32).reshape(-1, 1)
+
+    def update_tracks(self, corners, ids):
+        tracks = {}
+        if ids is not None:
+            for c, i in zip(corners, ids[:, 0]):
+                c = c.reshape(4, 2)
+                velocity = np.zeros(2, dtype=np.float32)
+                previous = self.tracks.get(int(i))
+                if previous is not None:
+                    velocity = c.mean(axis=0) - previous[0].mean(axis=0)
+                tracks[int(i)] = (c, velocity)
+        # -- Look for lost markers in the whole image on the next frame
+        if any(i not in tracks for i in self.tracks):
+            self.full_search_requested = True
+        self.tracks = tracks
+
+    def loop(self):
+        # -- Read the frame
+        frame, _ = self.grab()
+        if frame is None:
+            return None, None, None, None, None
+        corners, ids, rvecs, tvecs = self.detect(frame)
         return frame, corners, ids, rvecs, tvecs
 
     def draw_markers(self, frame, corners, ids, rvecs, tvecs) -> np.ndarray:
@@ -1,4 +1,5 @@
 import argparse
+import copy
 import os
 import shutil
 import time
@@ -6,14 +7,51 @@ from datetime import datetime
 from pathlib import Path
 from typing import List
 
+import cv2
 import numpy as np
 
-from .aruco_detector import ArucoDetector
-from .configuration import Configuration
-from .frame_decorator import Colors, FrameDecorator
+from .aruco_detector import ArucoDetector, dictionary_size
+from .binary_log import BinarySink
+from .config_watcher import ConfigurationWatcher
+from .configuration import Configuration, changed_settings
+from .frame_decorator import Colors, FrameDecorator, NullFrameDecorator
+from .frame_source import create_frame_source
+from .log_writer import CsvSink, LogWriter
+from .multi_camera import MultiCameraPipeline, fuse_observations
 from .origin_reference import OriginReference
-from .tag_logger import TagLogger
-from .udp_broadcast_server import UDPBroadcastServer
+from .pipeline import DetectionPipeline, ParallelDetectionPipeline
+from .pose_filter import PoseFilter
+from .protocol import TIMED_STAGES
+from .publisher import Publisher
+from .stream_server import StreamServer
+from .tag_logger import SESSION_LOG_HEADER, TIMING_LOG_HEADER, TagLogger
+
+# -- Settings of the configuration file applied without restarting
+LIVE_SETTINGS = [
+    "tags_to_log",
+    "marker",
+    "broadcast_frequency",
+    "frame",
+    "udp_server_ip",
+    "udp_server_port",
+    "udp_server_format",
+    "udp_server_targets",
+    "udp_server_status_targets",
+    "reload_interval",
+]
+# -- Also applied live, when the markers are detected in this process
+DETECTOR_SETTINGS = [
+    "marker_size",
+    "detector_tracking",
+    "detector_full_search_interval",
+    "detector_roi_padding",
+    "detector_scale",
+    "detector_refine_window",
+    "detector_refine_iterations",
+    "detector_refine_epsilon",
+    "detector_undistort",
+    "detector_undistort_cache",
+]
 
 
 def detected(ids, marker_id):
@@ -22,12 +60,47 @@ def detected(ids, marker_id):
 
 
 class ArucoLocalisation:
-    def __init__(self, shutdown_at_end=True):
-        """Initialise the ArUco localisation system."""
+    def __init__(
+        self,
+        shutdown_at_end=True,
+        pipelined=False,
+        source=None,
+        source_input=None,
+        headless=False,
+        workers=0,
+    ):
+        """Initialise the ArUco localisation system.
+
+        Parameters
+        ----------
+        shutdown_at_end : bool
+            Shutdown the computer when the program finishes
+        pipelined : bool
+            Run capture and detection on background threads
+        source : str
+            Frame source overriding the configuration: camera, video, images
+            or shm
+        source_input : str
+            Camera index or device path, or path of the video, image folder
+            or shared memory name, overriding the configuration
+        headless : bool
+            Do not draw nor display anything. The operator is informed of the
+            system state through the console and UDP status messages
+        workers : int
+            Number of detector processes. If above 0, frames are detected by
+            a pool of processes instead of the main thread
+        """
         # Initialisation
         self.calibrated = False
         self.initial_time_s = 0.0
         self.last_broadcast_time_s = 0.0
+        self.headless = headless
+        self.render = False
+        # -- Frames of the pipelines are shared and copied here to be drawn on
+        self.shared_frames = False
+        self.display = None
+        self.status = None
+        self.last_status_time_s = 0.0
 
         print("Running ArUco localisation system")
         if shutdown_at_end:
@@ -39,6 +112,7 @@ class ArucoLocalisation:
         app_dir = home_dir / "uos_aruco_detector"
         log_dir = app_dir / "log"
         config_dir = app_dir / "configuration"
+        self.cache_dir = app_dir / "cache"
 
         if not log_dir.exists():
             log_dir.mkdir(parents=True)
@@ -54,6 +128,17 @@ class ArucoLocalisation:
             shutil.copy(str(default_configuration_file), str(config_file))
 
         self.config = Configuration(config_file)
+        # -- Settings as in the file, before the command line and the marker
+        # -- cards change them, to find what changed when it is reloaded
+        self.file_config = copy.copy(self.config)
+        self.watcher = ConfigurationWatcher(config_file, self.config.reload_interval)
+        if source is not None:
+            self.config.capture_source = source
+        if source_input is not None:
+            if self.config.capture_source == "camera":
+                self.config.capture_device = source_input
+            else:
+                self.config.capture_path = source_input
 
         if self.config.usb_storage_path != "":
             self.config.usb_storage_path = Path(self.config.usb_storage_path)
@@ -77,49 +162,395 @@ class ArucoLocalisation:
 
         print("Logging to {}".format(log_dir))
 
-        self.server = UDPBroadcastServer(
-            self.config.udp_server_ip, self.config.udp_server_port
-        )
-        self.frame_decorator = FrameDecorator(
-            self.config.screen_width, self.config.screen_height
+        # Several cameras are detected in worker processes and fused
+        self.multi_camera = len(self.config.cameras) > 0
+        # -- Detector of this process, that can be reconfigured live
+        self.local_detector = not self.multi_camera and workers == 0
+        if self.multi_camera and not headless:
+            print("The frames of multiple cameras are not displayed")
+            headless = True
+            self.headless = True
+
+        self.server = Publisher(
+            self.config.udp_server_targets, self.config.udp_server_format
         )
-        self.detector = ArucoDetector(
-            self.config.camera_matrix,
-            self.config.camera_distortion,
-            self.config.marker_size,
-            self.config.frame,
-        )
-        self.origin = OriginReference(log_dir, self.config.frame)
+        self.status_server = Publisher(self.config.udp_server_status_targets)
+        self.stream_server = None
+        if self.config.stream_server_enabled:
+            self.stream_server = StreamServer(
+                self.config.stream_server_host,
+                self.config.stream_server_port,
+                self.config.stream_server_max_clients,
+            )
+            self.stream_server.start()
+        if headless:
+            self.frame_decorator = NullFrameDecorator()
+        else:
+            self.frame_decorator = FrameDecorator(
+                self.config.screen_width,
+                self.config.screen_height,
+                self.config.display_frequency,
+            )
+        self.detector = None
+        if not self.multi_camera:
+            self.detector = ArucoDetector(
+                self.config.camera_matrix,
+                self.config.camera_distortion,
+                self.config.marker_size,
+                self.config.frame,
+                image_size=self.config.camera_image_size,
+                capture=create_frame_source(
+                    self.config.capture_source,
+                    self.config.capture_device,
+                    self.config.capture_path,
+                    self.config.capture_width,
+                    self.config.capture_height,
+                    self.config.capture_fps,
+                    self.config.capture_fourcc,
+                    self.config.capture_buffer_size,
+                    self.config.capture_loop,
+                    self.config.capture_realtime,
+                ),
+                **self.detector_settings(),
+            )
+        # One origin per camera, holding the extrinsics of the camera
+        self.origins = [
+            OriginReference(log_dir, self.config.frame)
+            for _ in range(max(len(self.config.cameras), 1))
+        ]
+        self.origin = self.origins[0]
+        self.pose_filter = None
+        if self.config.filter_enabled:
+            self.pose_filter = PoseFilter(
+                dictionary_size(),
+                self.config.filter_position_noise,
+                self.config.filter_angle_noise,
+                self.config.filter_acceleration_noise,
+                self.config.filter_angular_acceleration_noise,
+                self.config.filter_gate,
+                self.config.filter_max_rejections,
+                self.config.filter_timeout,
+            )
 
         self.tag_loggers = {}
+        # -- Loggers of the tags removed from tags_to_log while running
+        self.retired_loggers = {}
         self.stop_requested = False
+        # -- Set when a video or image folder has no more frames
+        self.source_finished = False
+
+        self.log_writer = None
+        if self.config.log_in_background:
+            self.log_writer = LogWriter(self.config.log_queue_size)
+        self.log_dir = log_dir
+        self.log_metadata = {
+            "frame": self.config.frame,
+            "marker_size": self.config.marker_size,
+            "camera": {
+                "matrix": self.config.camera_matrix,
+                "distortion": self.config.camera_distortion,
+                "image_size": self.config.camera_image_size,
+            },
+            "origin": None,
+        }
+        if self.multi_camera:
+            self.log_metadata["cameras"] = self.config.cameras
+        # Sinks with a tag id column, shared or not by the tag loggers
+        self.log_sinks = []
+        if self.config.log_session_file:
+            self.log_sinks.append(self.create_log_sink("session"))
 
         for n in self.config.tags_to_log:
-            tl = TagLogger(n, f"Tag_{n}", Colors.RED, log_dir)
-            self.tag_loggers[str(n)] = tl
-        while not self.stop_requested:
-            self.loop()
+            self.tag_loggers[str(n)] = self.create_tag_logger(n)
+        # Capture time, stage durations and latency of every frame
+        self.timing_sink = CsvSink(
+            log_dir / "timings.csv",
+            TIMING_LOG_HEADER,
+            self.config.log_buffer_size,
+            self.config.log_flush_interval,
+            self.config.log_flush_rows,
+        )
 
-        if shutdown_at_end:
+        try:
+            if self.multi_camera:
+                self.run_multi_camera()
+            elif pipelined or workers > 0:
+                self.run_pipelined(workers)
+            else:
+                while not self.stop_requested:
+                    self.loop()
+        finally:
+            self.watcher.close()
+            self.close_loggers()
+            self.server.close()
+            self.status_server.close()
+            if self.pose_filter is not None:
+                rejected = self.pose_filter.rejected
+                print("Pose filter rejected {} outliers".format(rejected))
+            if self.stream_server is not None:
+                self.stream_server.stop()
+
+        if self.source_finished:
+            print("All the frames of the source were processed")
+        elif shutdown_at_end:
             print("Performing shutdown...")
             os.system("shutdown now -h")  # Uncomment for raspberry Pi
 
     def loop(self):
         """Main loop."""
-        frame, corners, ids, rvecs, tvecs = self.detector.loop()
+        self.check_configuration()
+        # -- Read into the frame of the previous iteration
+        frame, info = self.detector.grab(self.display)
+        if frame is None:
+            if self.detector.finished:
+                self.finish_source()
+            return
+        self.display = frame
+        corners, ids, rvecs, tvecs = self.detector.detect(frame, info)
+        self.process(frame, corners, ids, rvecs, tvecs, info)
+
+    def run_pipelined(self, workers=0):
+        """Main loop when capture and detection run on background threads.
+
+        This thread only publishes, logs and displays the detections, so that
+        a slow stage never delays grabbing the next frame. With workers, the
+        detection runs in that many processes.
+        """
+        ring_name = self.config.capture_ring_name
+        if workers > 0:
+            pipeline = ParallelDetectionPipeline(
+                self.detector, self.detector_settings(), workers, ring_name=ring_name
+            )
+        else:
+            pipeline = DetectionPipeline(self.detector, ring_name=ring_name)
+        self.shared_frames = True
+        pipeline.start()
+        try:
+            while not self.stop_requested:
+                self.check_configuration()
+                result = pipeline.get()
+                if result is None:
+                    if pipeline.finished:
+                        self.finish_source()
+                    continue
+                self.process(*result)
+        finally:
+            pipeline.stop()
+
+    def finish_source(self):
+        """Stop at the end of a video or image folder, without shutting down."""
+        self.source_finished = True
+        self.stop_requested = True
+
+    def detector_settings(self):
+        """Keyword arguments of ArucoDetector from the configuration."""
+        return {
+            "tracking": self.config.detector_tracking,
+            "full_search_interval": self.config.detector_full_search_interval,
+            "roi_padding": self.config.detector_roi_padding,
+            "scale": self.config.detector_scale,
+            "refine_window": self.config.detector_refine_window,
+            "refine_iterations": self.config.detector_refine_iterations,
+            "refine_epsilon": self.config.detector_refine_epsilon,
+            "undistort": self.config.detector_undistort,
+            "undistort_cache": (
+                str(self.cache_dir) if self.config.detector_undistort_cache else None
+            ),
+        }
+
+    def run_multi_camera(self):
+        """Main loop when several cameras are detected in worker processes.
+
+        The detections of the cameras captured at about the same time are
+        fused into a single pose per tag before being logged and published.
+        """
+        pipeline = MultiCameraPipeline(
+            self.config.cameras,
+            self.config.marker_size,
+            self.config.frame,
+            self.detector_settings(),
+            self.config.fusion_window,
+            self.config.multi_camera_queue_size,
+        )
+        pipeline.start()
+        sequence = 0
+        try:
+            while not self.stop_requested:
+                self.check_configuration()
+                observations = pipeline.get()
+                if not observations:
+                    if pipeline.finished:
+                        self.finish_source()
+                    continue
+                if not self.calibrated:
+                    self.multi_camera_calibration(observations)
+                    continue
+                ids, positions, rotations, info = fuse_observations(
+                    observations, self.origins, sequence
+                )
+                sequence += 1
+                self.detection_loop(
+                    None, None, ids, None, None, info, (positions, rotations)
+                )
+        finally:
+            pipeline.stop()
+
+    def multi_camera_calibration(self, observations):
+        """Set the origin of every camera that sees the calibration marker
+        alone, and wait for the OK marker once all the cameras are set."""
+        marker = self.config.marker
+        ok = False
+        for index, _, corners, ids, rvecs, tvecs in observations:
+            if ids is None:
+                continue
+            if np.all(ids == marker.CALIBRATION):
+                self.origins[index].set(corners[0], rvecs[0, 0, :], tvecs[0, 0, :])
+            ok = ok or detected(ids, marker.OK)
+        missing = [i for i, origin in enumerate(self.origins) if not origin.initialised]
+        if missing:
+            self.report_status(
+                "calibrating",
+                "Please present the calibration tag to cameras {}".format(missing),
+            )
+        elif ok:
+            self.calibrated = True
+            self.report_status("ready", "Origin calibrated, the system is ready")
+            self.log_metadata["frame"] = self.config.frame
+            self.log_metadata["origin"] = [
+                {
+                    "rvec": np.asarray(origin.rvec).tolist(),
+                    "tvec": np.asarray(origin.tvec).tolist(),
+                }
+                for origin in self.origins
+            ]
+            self.reset_time()
+            if self.pose_filter is not None:
+                self.pose_filter.reset()
+        else:
+            self.report_status("origin_set", "Please present the OK tag")
+
+    def process(self, frame, corners, ids, rvecs, tvecs, info):
+        """Handle the detections of a single frame."""
         if frame is None:
             return
+        # Only draw on the frames that will be shown
+        self.render = self.frame_decorator.should_render()
+        if self.render:
+            frame = self.drawable(frame)
         # Wait until the system is calibrated
         if not self.calibrated:
             frame = self.calibration_loop(frame, corners, ids, rvecs, tvecs)
         # When calibration has been achieved, the system is ready to start
         else:
-            frame = self.detection_loop(frame, corners, ids, rvecs, tvecs)
-        if not self.stop_requested:
+            frame = self.detection_loop(frame, corners, ids, rvecs, tvecs, info)
+        if self.render and not self.stop_requested:
             self.stop_requested = self.frame_decorator.show(frame)
 
+    def drawable(self, frame):
+        """Frame that can be drawn on, copied if it is shared with other stages."""
+        if not self.shared_frames or frame is self.display:
+            return frame
+        if self.display is None or self.display.shape != frame.shape:
+            self.display = np.empty_like(frame)
+        np.copyto(self.display, frame)
+        return self.display
+
+    def create_tag_logger(self, n):
+        """Create the logger of a tag, in the configured log format."""
+        sink = None
+        if self.config.log_session_file:
+            sink = self.log_sinks[0]
+        elif self.config.log_format == "binary":
+            sink = self.create_log_sink(f"{n}_Tag_{n}", n)
+            self.log_sinks.append(sink)
+        return TagLogger(
+            n,
+            f"Tag_{n}",
+            Colors.RED,
+            self.log_dir,
+            self.config.log_buffer_size,
+            self.config.log_flush_interval,
+            self.config.log_flush_rows,
+            sink=sink,
+            writer=self.log_writer,
+        )
+
+    def create_log_sink(self, name, tag_id=None):
+        """Create a log file with a tag id column in the configured format."""
+        if self.config.log_format == "binary":
+            return BinarySink(
+                self.log_dir / (name + ".bin"),
+                self.log_metadata,
+                tag_id,
+                self.config.log_buffer_size,
+                self.config.log_flush_interval,
+                self.config.log_flush_rows,
+            )
+        return CsvSink(
+            self.log_dir / (name + ".csv"),
+            SESSION_LOG_HEADER,
+            self.config.log_buffer_size,
+            self.config.log_flush_interval,
+            self.config.log_flush_rows,
+        )
+
+    def close_loggers(self):
+        """Flush and close all the tag logs."""
+        # Write the rows still queued before closing the files
+        if self.log_writer is not None:
+            self.log_writer.close()
+        for tl in list(self.tag_loggers.values()) + list(self.retired_loggers.values()):
+            tl.close()
+        for sink in self.log_sinks:
+            sink.close()
+        self.timing_sink.close()
+
+    def frame_header(self, info, publish_start):
+        """Build the broadcast header of a frame, just before sending it."""
+        now = time.monotonic()
+        info.timings["publish"] = now - publish_start
+        return {
+            "frame_id": info.sequence,
+            "capture_time": info.capture_time,
+            "latency": (now - info.capture_monotonic) * 1000.0,
+            "timings": {
+                stage: seconds * 1000.0 for stage, seconds in info.timings.items()
+            },
+        }
+
+    def log_timings(self, info, num_tags, broadcasted):
+        """Log the stage durations and latency of a frame."""
+        latency = time.monotonic() - info.capture_monotonic
+        row = (
+            [info.sequence, info.capture_time]
+            + [info.timings.get(stage, 0.0) * 1000.0 for stage in TIMED_STAGES]
+            + [latency * 1000.0, num_tags, broadcasted]
+        )
+        if self.log_writer is not None:
+            row.append(self.log_writer.depth)
+            self.log_writer.submit(self.timing_sink, row)
+        else:
+            row.append(0)
+            self.timing_sink.write_row(row)
+
+    def predict_broadcast_msg(self, broadcast_msg, tag_ids, info):
+        """Replace the filtered poses of a message with the poses predicted at
+        the current time, to compensate for the latency of the pipeline."""
+        now = time.monotonic()
+        lead = now - info.capture_monotonic
+        positions, rotations, _, _ = self.pose_filter.predict(tag_ids, now)
+        positions, rotations = self.origin.express(positions, rotations)
+        for i, tag_id in enumerate(tag_ids):
+            values = broadcast_msg.get(int(tag_id), None)
+            if values is None:
+                continue
+            values[0] += lead
+            values[1] += lead
+            values[2:5] = positions[i].tolist()
+            values[5:8] = rotations[i].tolist()
+
     def draw_coordinate_system(self, frame) -> np.ndarray:
-        """Draw the coordinate system."""
+        """Draw the coordinate system and the border."""
         frame = self.detector.drawMarkerAxes(
             frame,
             self.origin.corners,
@@ -128,10 +559,106 @@ class ArucoLocalisation:
             self.config.marker_size,
             self.config.frame,
         )
-        return self.frame_decorator.draw_text(
-            frame, self.config.frame, Colors.BLUE, (50, 100)
+        return self.frame_decorator.draw_overlay(
+            frame, Colors.GREEN, ((self.config.frame, Colors.BLUE, (50, 100)),)
         )
 
+    def notify(self, message):
+        """Send a message to the operator through the console and the status targets."""
+        print(message)
+        self.status_server.send({"status": self.status, "message": message})
+
+    def report_status(self, status, message):
+        """Report the system state to the operator.
+
+        The state is notified when it changes, and repeated every second
+        while waiting for the operator to present a tag.
+        """
+        now = time.monotonic()
+        if status == self.status and (
+            status == "ready" or now - self.last_status_time_s < 1.0
+        ):
+            return
+        self.status = status
+        self.last_status_time_s = now
+        self.notify(message)
+
+    def change_setting(self, name, value):
+        """Change a configuration setting, notifying the operator."""
+        if getattr(self.config, name) == value:
+            return
+        setattr(self.config, name, value)
+        self.notify("Setting {} changed to {}".format(name, value))
+
+    def check_configuration(self):
+        """Reload the configuration file if it changed."""
+        if self.watcher.changed():
+            self.reload_configuration()
+
+    def reload_configuration(self):
+        """Apply the changes of the configuration file that can be made live.
+
+        The new file is validated before any of it is used, and a file that
+        does not load leaves the running configuration untouched. The
+        settings changed with the marker cards are kept unless the file
+        changes them too. The other changes are reported, as they need a
+        restart.
+        """
+        config, error = self.watcher.load()
+        if config is None:
+            self.notify("Configuration not reloaded: {}".format(error))
+            return
+        changed = changed_settings(self.file_config, config)
+        live = LIVE_SETTINGS + (DETECTOR_SETTINGS if self.local_detector else [])
+        applied = [name for name in changed if name in live]
+        restart = [name for name in changed if name not in live]
+
+        if any(name.startswith("udp_server") for name in applied):
+            server = None
+            try:
+                server = Publisher(config.udp_server_targets, config.udp_server_format)
+                status_server = Publisher(config.udp_server_status_targets)
+            except (OSError, ValueError) as e:
+                if server is not None:
+                    server.close()
+                self.notify("Configuration not reloaded: {}".format(e))
+                return
+            server.sequence = self.server.sequence
+            self.server.close()
+            self.server = server
+            self.status_server.close()
+            self.status_server = status_server
+        self.file_config = config
+        for name in applied:
+            setattr(self.config, name, getattr(config, name))
+        if "tags_to_log" in applied:
+            self.update_tag_loggers()
+        if any(name in DETECTOR_SETTINGS for name in applied):
+            self.detector.reconfigure(self.config.marker_size, self.detector_settings())
+            self.log_metadata["marker_size"] = self.config.marker_size
+        self.watcher.interval = self.config.reload_interval
+
+        if applied:
+            self.notify("Configuration reloaded: {}".format(", ".join(applied)))
+        if restart:
+            self.notify("Restart to apply: {}".format(", ".join(restart)))
+
+    def update_tag_loggers(self):
+        """Log the tags of tags_to_log, keeping the files of removed tags."""
+        tags = [str(n) for n in self.config.tags_to_log]
+        for key in list(self.tag_loggers):
+            if key not in tags:
+                self.retired_loggers[key] = self.tag_loggers.pop(key)
+        for n in self.config.tags_to_log:
+            key = str(n)
+            if key in self.tag_loggers:
+                continue
+            # -- A tag logged again appends to its file
+            if key in self.retired_loggers:
+                self.tag_loggers[key] = self.retired_loggers.pop(key)
+            else:
+                self.tag_loggers[key] = self.create_tag_logger(n)
+
     def get_time(self):
         """Get the current time in seconds."""
         current_time_s = datetime.now().timestamp()
@@ -166,26 +693,38 @@ class ArucoLocalisation:
         """
         if np.all(ids == self.config.marker.CALIBRATION):
             self.origin.set(corners[0], rvecs[0, 0, :], tvecs[0, 0, :])
-            frame = self.frame_decorator.draw_text(
-                frame,
-                "Please present the OK tag",
-                Colors.YELLOW,
-            )
-            frame = self.frame_decorator.draw_border(frame, Colors.YELLOW)
-            frame = self.detector.draw_markers(frame, corners, ids, rvecs, tvecs)
+            self.report_status("origin_set", "Please present the OK tag")
+            if self.render:
+                frame = self.frame_decorator.draw_overlay(
+                    frame,
+                    Colors.YELLOW,
+                    (("Please present the OK tag", Colors.YELLOW, None),),
+                )
+                frame = self.detector.draw_markers(frame, corners, ids, rvecs, tvecs)
         elif detected(ids, self.config.marker.OK) and self.origin.initialised:
             self.calibrated = True
+            self.report_status("ready", "Origin calibrated, the system is ready")
+            self.log_metadata["frame"] = self.config.frame
+            self.log_metadata["origin"] = {
+                "rvec": np.asarray(self.origin.rvec).tolist(),
+                "tvec": np.asarray(self.origin.tvec).tolist(),
+            }
             self.reset_time()
+            if self.pose_filter is not None:
+                self.pose_filter.reset()
         else:
-            self.frame_decorator.draw_text(
-                frame,
-                "Please present the calibration tag",
-                Colors.YELLOW,
-            )
-            frame = self.frame_decorator.draw_border(frame, Colors.RED)
+            self.report_status("calibrating", "Please present the calibration tag")
+            if self.render:
+                frame = self.frame_decorator.draw_overlay(
+                    frame,
+                    Colors.RED,
+                    (("Please present the calibration tag", Colors.YELLOW, None),),
+                )
         return frame
 
-    def detection_loop(self, frame, corners, ids, rvecs, tvecs) -> np.ndarray:
+    def detection_loop(
+        self, frame, corners, ids, rvecs, tvecs, info, poses=None
+    ) -> np.ndarray:
         """Detects the aruco markers and updates the tag loggers.
 
         Parameters
@@ -200,15 +739,21 @@ class ArucoLocalisation:
             Rotation vectors
         tvecs : np.ndarray
             Translation vectors
+        info : FrameInfo
+            Sequence number, capture time and stage durations of the frame
+        poses : tuple
+            Positions and Rotation of the markers in the ENU frame of the
+            origin, when already known, e.g. fused from several cameras.
+            rvecs and tvecs are not used then
 
         Returns
         -------
         np.ndarray
             Frame to display
         """
-        frame = self.draw_coordinate_system(frame)
-        frame = self.frame_decorator.draw_border(frame, Colors.GREEN)
-        frame = self.detector.draw_markers(frame, corners, ids, rvecs, tvecs)
+        if self.render:
+            frame = self.draw_coordinate_system(frame)
+            frame = self.detector.draw_markers(frame, corners, ids, rvecs, tvecs)
 
         # Shorten name
         marker = self.config.marker
@@ -216,56 +761,103 @@ class ArucoLocalisation:
         # Handle broadcasting frequency
         broadcast = False
         current_time_s = datetime.now().timestamp()
-        broadcast_interval = 1.0 / self.config.broadcast_frequency
-        if current_time_s - self.last_broadcast_time_s > broadcast_interval:
-            broadcast = True
-            self.last_broadcast_time_s = current_time_s
+        if self.config.broadcast_frequency != 0:
+            broadcast_interval = 1.0 / self.config.broadcast_frequency
+            if current_time_s - self.last_broadcast_time_s > broadcast_interval:
+                broadcast = True
+                self.last_broadcast_time_s = current_time_s
+
+        # Flush logs of tags that are no longer in view
+        for tl in self.tag_loggers.values():
+            tl.flush_if_due()
 
         if ids is None:
+            self.log_timings(info, 0, False)
             return frame
 
         if detected(ids, marker.BROADCAST_ALWAYS) and detected(ids, marker.OK):
-            self.config.broadcast_frequency = -1
+            self.change_setting("broadcast_frequency", -1)
         elif detected(ids, marker.BROADCAST_FREQ_01_HZ) and detected(ids, marker.OK):
-            self.config.broadcast_frequency = 0.1
+            self.change_setting("broadcast_frequency", 0.1)
         elif detected(ids, marker.BROADCAST_FREQ_02_HZ) and detected(ids, marker.OK):
-            self.config.broadcast_frequency = 0.2
+            self.change_setting("broadcast_frequency", 0.2)
         elif detected(ids, marker.BROADCAST_FREQ_1_HZ) and detected(ids, marker.OK):
-            self.config.broadcast_frequency = 1.0
+            self.change_setting("broadcast_frequency", 1.0)
         elif detected(ids, marker.BROADCAST_FREQ_5_HZ) and detected(ids, marker.OK):
-            self.config.broadcast_frequency = 5.0
+            self.change_setting("broadcast_frequency", 5.0)
         elif detected(ids, marker.BROADCAST_NEVER) and detected(ids, marker.OK):
-            self.config.broadcast_frequency = 0.0
+            self.change_setting("broadcast_frequency", 0.0)
         elif detected(ids, marker.FRAME_NED) and detected(ids, marker.OK):
-            self.config.frame = "NED"
+            self.change_setting("frame", "NED")
         elif detected(ids, marker.FRAME_ENU) and detected(ids, marker.OK):
-            self.config.frame = "ENU"
+            self.change_setting("frame", "ENU")
         elif detected(ids, marker.SHUTDOWN) and detected(ids, marker.OK):
+            self.report_status("shutdown", "Shutting down in 10 sec")
             # -- Wait one second and increase the count
-            frame = frame - 100 * np.ones(frame.shape, dtype=np.uint8)
+            if not self.headless:
+                frame = self.drawable(frame)
+                cv2.subtract(frame, (100, 100, 100, 0), dst=frame)
             self.frame_decorator.draw_text(frame, "Shutting down in 10 sec", Colors.RED)
             self.frame_decorator.draw_border(frame, Colors.RED)
             self.frame_decorator.show(frame)
+            self.close_loggers()
             time.sleep(10)
             self.stop_requested = True
             self.frame_decorator.stop()
             return None
 
+        localise_start = time.monotonic()
+        tag_ids = ids.reshape(-1)
+        velocities = None
+        if poses is None:
+            poses = self.origin.get_relative_poses(rvecs, tvecs)
+        positions, rotations = poses
+        if self.pose_filter is None:
+            positions, rotations = self.origin.express(positions, rotations)
+        else:
+            self.pose_filter.update(
+                tag_ids, info.capture_monotonic, positions, rotations
+            )
+            positions, rotations, linear, angular = self.pose_filter.predict(
+                tag_ids, info.capture_monotonic
+            )
+            positions, rotations = self.origin.express(positions, rotations)
+            if self.config.filter_velocity:
+                velocities = self.origin.express_rates(linear, angular)
+        publish_start = time.monotonic()
+        info.timings["pose"] = (
+            info.timings.get("pose", 0.0) + publish_start - localise_start
+        )
+
+        # All the tags of a frame are stamped with its capture time
+        capture_time = info.capture_time
+        elapsed_time = capture_time - self.initial_time_s
         broadcast_msg = {}
         for i, id in enumerate(ids):
-            time_list, elapsed_time = self.get_time()
             # Handle platforms and broadcasting
-            pos, rot = self.origin.get_relative_position(rvecs[i, 0, :], tvecs[i, 0, :])
+            pos, rot = positions[i], rotations[i]
             tl = self.tag_loggers.get(str(id[0]), None)
             if tl is None:
                 print("No tag was found with ID", id)
                 continue
-            tl.log(time_list, elapsed_time, pos, rot, broadcast)
-            broadcast_msg = tl.update_broadcast_msg(broadcast_msg)
+            tl.log(capture_time, elapsed_time, pos, rot, broadcast)
+            velocity = None if velocities is None else velocities[i].tolist()
+            broadcast_msg = tl.update_broadcast_msg(broadcast_msg, velocity)
+        if self.pose_filter is not None and self.config.filter_predict:
+            self.predict_broadcast_msg(broadcast_msg, tag_ids, info)
         # Make sure to update the origin frame
         self.origin.frame = self.config.frame
+        header = None
+        if broadcast or self.stream_server is not None:
+            header = self.frame_header(info, publish_start)
+        # Stream clients get every frame and apply their own rate limits
+        if self.stream_server is not None:
+            self.stream_server.publish(broadcast_msg, header, self.config.frame)
         if broadcast:
-            self.server.broadcast(broadcast_msg)
+            self.server.broadcast(broadcast_msg, header, self.config.frame)
+        if header is None:
+            info.timings["publish"] = time.monotonic() - publish_start
+        self.log_timings(info, len(broadcast_msg), broadcast)
         return frame
 
 
@@ -281,5 +873,42 @@ def main():
         action="store_false",
         help="Don't shutdown at the end of the program",
     )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Run capture and detection on separate threads",
+    )
+    parser.add_argument(
+        "--source",
+        type=str,
+        choices=["camera", "video", "images", "shm"],
+        default=None,
+        help="Frame source, overrides the configuration",
+    )
+    parser.add_argument(
+        "--input",
+        type=str,
+        default=None,
+        help="Camera index or device path, video file, image folder or shared"
+        + " memory name, overrides the configuration",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="Don't draw nor display the frames, report the state in messages",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Detect the markers in this many processes, to use several cores",
+    )
     args = parser.parse_args()
-    ArucoLocalisation(args.no_shutdown)
+    ArucoLocalisation(
+        args.no_shutdown,
+        args.pipeline,
+        args.source,
+        args.input,
+        args.headless,
+        args.workers,
+    )
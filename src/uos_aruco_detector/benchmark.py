@@ -0,0 +1,571 @@
+import argparse
+import json
+import tempfile
+import time
+from pathlib import Path
+
+import cv2
+import cv2.aruco as aruco
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from .aruco_detector import ArucoDetector
+from .configuration import Configuration
+from .frame_source import ImageFolderSource, VideoFileSource
+from .origin_reference import OriginReference
+from .pipeline import DetectionPipeline, ParallelDetectionPipeline
+from .undistort import UNDISTORT_MODES
+
+# -- Size of the rendered markers, in pixels per bit
+BIT_PIXELS = 10
+
+
+def render_patch(frame, patch, image_corners):
+    """Warp a square patch onto the frame so that its corners land on image_corners.
+
+    Only the bounding box of the projected patch is warped and blended.
+    """
+    height, width = frame.shape[:2]
+    x0, y0 = np.floor(image_corners.min(axis=0)).astype(int) - 2
+    x1, y1 = np.ceil(image_corners.max(axis=0)).astype(int) + 2
+    x0, y0 = max(x0, 0), max(y0, 0)
+    x1, y1 = min(x1, width), min(y1, height)
+    if x1 <= x0 or y1 <= y0:
+        return
+    size = patch.shape[0]
+    src = np.float32(
+        [[-0.5, -0.5], [size - 0.5, -0.5], [size - 0.5, size - 0.5], [-0.5, size - 0.5]]
+    )
+    dst = (image_corners - np.array([x0, y0])).astype(np.float32)
+    homography = cv2.getPerspectiveTransform(src, dst)
+    box = (x1 - x0, y1 - y0)
+    warped = cv2.warpPerspective(patch, homography, box, flags=cv2.INTER_LINEAR)
+    alpha = cv2.warpPerspective(
+        np.ones(patch.shape, dtype=np.float32), homography, box, flags=cv2.INTER_LINEAR
+    )
+    region = frame[y0:y1, x0:x1]
+    region[:] = (region * (1.0 - alpha) + warped * alpha).astype(np.uint8)
+
+
+class SyntheticScene:
+    def __init__(
+        self,
+        width=1280,
+        height=720,
+        num_markers=4,
+        marker_size=0.1,
+        blur=0.0,
+        noise=0.0,
+        num_frames=300,
+        seed=0,
+    ):
+        """Rendered ArUco markers with known poses.
+
+        Markers from the DICT_4X4_100 dictionary are placed on a grid facing
+        the camera with random tilts, and move slowly from frame to frame. The
+        scene has the read() interface of cv2.VideoCapture, so it can be used
+        as the capture device of ArucoDetector. The ground truth of the last
+        rendered frame is available in ids, rvecs and tvecs.
+
+        Parameters
+        ----------
+        width : int
+            Image width in pixels
+        height : int
+            Image height in pixels
+        num_markers : int
+            Number of markers in the scene, with ids 0 to num_markers - 1
+        marker_size : float
+            Side of the markers in metres
+        blur : float
+            Standard deviation of the Gaussian blur in pixels
+        noise : float
+            Standard deviation of the Gaussian noise in grey levels
+        num_frames : int
+            Number of frames rendered before read() reports the end. If None,
+            the scene never ends
+        seed : int
+            Seed of the random poses and noise
+        """
+        self.width = width
+        self.height = height
+        self.marker_size = marker_size
+        self.blur = blur
+        self.noise = noise
+        self.num_frames = num_frames
+        self.frame_index = 0
+        self.rng = np.random.default_rng(seed)
+
+        focal_length = 0.9 * width
+        self.camera_matrix = np.array(
+            [
+                [focal_length, 0.0, width / 2.0],
+                [0.0, focal_length, height / 2.0],
+                [0.0, 0.0, 1.0],
+            ]
+        )
+        self.camera_distortion = np.zeros(5)
+
+        # -- Markers with a one bit white quiet zone around them
+        aruco_dict = aruco.getPredefinedDictionary(aruco.DICT_4X4_100)
+        marker_pixels = 6 * BIT_PIXELS
+        self.patches = []
+        for marker_id in range(num_markers):
+            marker = aruco.drawMarker(aruco_dict, marker_id, marker_pixels)
+            self.patches.append(
+                cv2.copyMakeBorder(
+                    marker,
+                    BIT_PIXELS,
+                    BIT_PIXELS,
+                    BIT_PIXELS,
+                    BIT_PIXELS,
+                    cv2.BORDER_CONSTANT,
+                    value=255,
+                )
+            )
+        half_side = marker_size / 2.0 * (marker_pixels + 2 * BIT_PIXELS) / marker_pixels
+        # -- Same corner order as estimatePoseSingleMarkers
+        self.patch_points = np.array(
+            [
+                [-half_side, half_side, 0.0],
+                [half_side, half_side, 0.0],
+                [half_side, -half_side, 0.0],
+                [-half_side, -half_side, 0.0],
+            ]
+        )
+
+        # -- Place the markers on a grid, small enough to never overlap
+        cols = int(np.ceil(np.sqrt(num_markers * width / height)))
+        rows = int(np.ceil(num_markers / cols))
+        cell = min(width / cols, height / rows)
+        self.ids = np.arange(num_markers, dtype=np.int32).reshape(-1, 1)
+        self.centres = np.array(
+            [
+                [(i % cols + 0.5) * width / cols, (i // cols + 0.5) * height / rows]
+                for i in range(num_markers)
+            ]
+        )
+        self.depths = (focal_length * marker_size / (0.4 * cell)) * self.rng.uniform(
+            0.9, 1.3, num_markers
+        )
+        self.tilts = self.rng.uniform(-30.0, 30.0, (num_markers, 2))
+        self.yaws = self.rng.uniform(-180.0, 180.0, num_markers)
+        self.phases = self.rng.uniform(0.0, 2.0 * np.pi, num_markers)
+        self.amplitude = 0.1 * cell
+        self.rvecs = np.zeros((num_markers, 3))
+        self.tvecs = np.zeros((num_markers, 3))
+
+    def update_poses(self):
+        self.rvecs, self.tvecs = self.poses(self.frame_index)
+
+    def poses(self, k):
+        """Rotation and translation vectors of the markers in frame k."""
+        angle = 2.0 * np.pi * k / 120.0 + self.phases
+        u = self.centres[:, 0] + self.amplitude * np.sin(angle)
+        v = self.centres[:, 1] + self.amplitude * np.cos(angle)
+        pixels = np.stack([u, v, np.ones_like(u)], axis=1)
+        rays = pixels @ np.linalg.inv(self.camera_matrix).T
+        tvecs = rays * self.depths[:, None]
+        # -- Facing the camera, then tilted and rotated about the optical axis
+        euler = np.column_stack(
+            [
+                180.0 + self.tilts[:, 0],
+                self.tilts[:, 1],
+                self.yaws + 0.5 * k,
+            ]
+        )
+        rvecs = Rotation.from_euler("xyz", euler, degrees=True).as_rotvec()
+        return rvecs, tvecs
+
+    def render(self, image=None):
+        self.update_poses()
+        gray = np.full((self.height, self.width), 128, dtype=np.uint8)
+        for patch, rvec, tvec in zip(self.patches, self.rvecs, self.tvecs):
+            image_corners, _ = cv2.projectPoints(
+                self.patch_points,
+                rvec,
+                tvec,
+                self.camera_matrix,
+                self.camera_distortion,
+            )
+            render_patch(gray, patch, image_corners.reshape(4, 2))
+        if self.blur > 0:
+            gray = cv2.GaussianBlur(gray, (0, 0), self.blur)
+        if self.noise > 0:
+            noisy = gray + self.rng.normal(0.0, self.noise, gray.shape)
+            gray = np.clip(noisy, 0, 255).astype(np.uint8)
+        return cv2.cvtColor(gray, cv2.COLOR_GRAY2BGR, dst=image)
+
+    def read(self, image=None):
+        if self.num_frames is not None and self.frame_index >= self.num_frames:
+            return False, None
+        frame = self.render(image)
+        self.frame_index += 1
+        return True, frame
+
+    def release(self):
+        pass
+
+
+class StageTimer:
+    """Collects the duration of each stage of the processing of a frame."""
+
+    def __init__(self):
+        self.durations = {}
+
+    def add(self, stage, seconds):
+        self.durations.setdefault(stage, []).append(seconds * 1000.0)
+
+    def summary(self):
+        summary = {}
+        for stage, durations in self.durations.items():
+            durations = np.array(durations)
+            summary[stage] = {
+                "mean [ms]": float(durations.mean()),
+                "p50 [ms]": float(np.percentile(durations, 50)),
+                "p90 [ms]": float(np.percentile(durations, 90)),
+                "p99 [ms]": float(np.percentile(durations, 99)),
+                "max [ms]": float(durations.max()),
+            }
+        return summary
+
+
+def pose_errors(ids, rvecs, tvecs, truth_ids, truth_rvecs, truth_tvecs):
+    """Translation [m] and rotation [deg] errors of the detected markers."""
+    translation_errors = []
+    rotation_errors = []
+    if ids is None:
+        return translation_errors, rotation_errors
+    truth = {int(i): k for k, i in enumerate(truth_ids[:, 0])}
+    for i, marker_id in enumerate(ids[:, 0]):
+        k = truth.get(int(marker_id))
+        if k is None:
+            continue
+        translation_errors.append(np.linalg.norm(tvecs[i, 0] - truth_tvecs[k]))
+        error = Rotation.from_rotvec(truth_rvecs[k]).inv() * Rotation.from_rotvec(
+            rvecs[i, 0]
+        )
+        rotation_errors.append(np.degrees(error.magnitude()))
+    return translation_errors, rotation_errors
+
+
+class PoseAccuracy:
+    """Collects the detection rate and the pose errors against the ground truth."""
+
+    def __init__(self):
+        self.expected = 0
+        self.detected = 0
+        self.translation_errors = []
+        self.rotation_errors = []
+
+    def add(self, ids, rvecs, tvecs, truth_ids, truth_rvecs, truth_tvecs):
+        self.expected += len(truth_ids)
+        if ids is None:
+            return
+        self.detected += len(ids)
+        t_err, r_err = pose_errors(
+            ids, rvecs, tvecs, truth_ids, truth_rvecs, truth_tvecs
+        )
+        self.translation_errors += t_err
+        self.rotation_errors += r_err
+
+    def summary(self):
+        summary = {
+            "detection rate": (
+                self.detected / self.expected if self.expected > 0 else 0.0
+            )
+        }
+        for name, errors in [
+            ("translation error [m]", self.translation_errors),
+            ("rotation error [deg]", self.rotation_errors),
+        ]:
+            if len(errors) > 0:
+                summary[name] = {
+                    "p50": float(np.percentile(errors, 50)),
+                    "p90": float(np.percentile(errors, 90)),
+                    "max": float(np.max(errors)),
+                }
+        return summary
+
+
+def run_serial(detector, scene=None, max_frames=None, calibration_id=-1):
+    """Run the detector and localisation stages one frame after the other.
+
+    With a synthetic scene, the first marker is used as the origin and the
+    poses are compared with the ground truth. Otherwise the origin is set the
+    first time the calibration tag is seen.
+    """
+    # -- The origin stores its pose in a folder, which is not kept
+    with tempfile.TemporaryDirectory() as origin_dir:
+        origin = OriginReference(Path(origin_dir), "ENU")
+        return measure_serial(detector, origin, scene, max_frames, calibration_id)
+
+
+def measure_serial(detector, origin, scene, max_frames, calibration_id):
+    """run_serial, localising the markers from the given origin."""
+    timer = StageTimer()
+    accuracy = PoseAccuracy()
+    frames = 0
+    start = time.perf_counter()
+    frame = None
+    while max_frames is None or frames < max_frames:
+        t0 = time.perf_counter()
+        # -- Read into the previous frame, as the detector does live
+        frame, _ = detector.grab(frame)
+        if frame is None:
+            break
+        t1 = time.perf_counter()
+        corners, ids = detector.locate_markers(frame)
+        t2 = time.perf_counter()
+        rvecs, tvecs = detector.estimate_poses(corners, ids)
+        t3 = time.perf_counter()
+        if scene is not None and not origin.initialised:
+            # -- The first marker of the scene acts as the calibration tag
+            origin.set(None, scene.rvecs[0], scene.tvecs[0])
+        elif scene is None and not origin.initialised and ids is not None:
+            calibration = np.flatnonzero(ids[:, 0] == calibration_id)
+            if calibration.size > 0:
+                k = calibration[0]
+                origin.set(corners[k], rvecs[k, 0, :], tvecs[k, 0, :])
+        if ids is not None and origin.initialised:
+            origin.get_relative_positions(rvecs, tvecs)
+        t4 = time.perf_counter()
+        timer.add("grab", t1 - t0)
+        timer.add("detect", t2 - t1)
+        timer.add("pose", t3 - t2)
+        timer.add("localise", t4 - t3)
+        timer.add("total", t4 - t0)
+        frames += 1
+
+        if scene is not None:
+            accuracy.add(ids, rvecs, tvecs, scene.ids, scene.rvecs, scene.tvecs)
+    elapsed = time.perf_counter() - start
+
+    results = {
+        "mode": "serial",
+        "frames": frames,
+        "fps": frames / elapsed if elapsed > 0 else 0.0,
+        "stages": timer.summary(),
+    }
+    if scene is not None:
+        results.update(accuracy.summary())
+    return results
+
+
+def run_pipelined(
+    detector, duration, max_frames=None, workers=0, settings=None, scene=None
+):
+    """Run the threaded pipeline and measure the published results.
+
+    With workers, the frames are detected by a pool of processes instead of a
+    thread. The durations of the stages are those stored in the FrameInfo of
+    each result, the latency is the time from capture to get(). With a
+    synthetic scene, the poses are compared with the ground truth of the
+    frame they were detected in. The benchmark ends after the given duration,
+    after max_frames results, or when no result arrives for a second because
+    the video has ended.
+    """
+    if workers > 0:
+        pipeline = ParallelDetectionPipeline(detector, settings or {}, workers)
+    else:
+        pipeline = DetectionPipeline(detector)
+    frames = 0
+    timer = StageTimer()
+    accuracy = PoseAccuracy()
+    pipeline.start()
+    start = time.perf_counter()
+    last = start
+    while time.perf_counter() - start < duration:
+        if max_frames is not None and frames >= max_frames:
+            break
+        result = pipeline.get()
+        if result is None:
+            if time.perf_counter() - last > 1.0:
+                break
+            continue
+        received = time.monotonic()
+        now = time.perf_counter()
+        _, _, ids, rvecs, tvecs, info = result
+        for stage, seconds in info.timings.items():
+            timer.add(stage, seconds)
+        timer.add("latency", received - info.capture_monotonic)
+        timer.add("result interval", now - last)
+        last = now
+        frames += 1
+        if scene is not None:
+            # -- The scene renders frame k as the k-th frame grabbed
+            truth_rvecs, truth_tvecs = scene.poses(info.sequence)
+            accuracy.add(ids, rvecs, tvecs, scene.ids, truth_rvecs, truth_tvecs)
+    elapsed = time.perf_counter() - start
+    pipeline.stop()
+    results = {
+        "mode": "pipeline" if workers == 0 else "{} workers".format(workers),
+        "frames": frames,
+        "fps": frames / elapsed if elapsed > 0 else 0.0,
+    }
+    results.update(pipeline.stats())
+    if scene is not None:
+        results.update(accuracy.summary())
+    results["stages"] = timer.summary()
+    return results
+
+
+def print_results(results):
+    print("Mode: {}".format(results["mode"]))
+    print("Frames: {}  FPS: {:.1f}".format(results["frames"], results["fps"]))
+    for key, value in results.items():
+        if key in ["mode", "frames", "fps", "stages"]:
+            continue
+        print("{}: {}".format(key, value))
+    print(
+        "{:<18}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            "stage", "mean", "p50", "p90", "p99", "max"
+        )
+    )
+    for stage, stats in results["stages"].items():
+        print(
+            "{:<18}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}{:>10.2f}".format(
+                stage,
+                stats["mean [ms]"],
+                stats["p50 [ms]"],
+                stats["p90 [ms]"],
+                stats["p99 [ms]"],
+                stats["max [ms]"],
+            )
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the ArUco detector on synthetic scenes with known"
+        + " poses or on recorded videos, without a camera or a display."
+    )
+    parser.add_argument(
+        "--video",
+        type=str,
+        default=None,
+        help="Recorded video to use instead of a synthetic scene",
+    )
+    parser.add_argument(
+        "--images",
+        type=str,
+        default=None,
+        help="Folder of recorded images to use instead of a synthetic scene",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=None,
+        help="Configuration file with the camera calibration of the recording",
+    )
+    parser.add_argument("--frames", type=int, default=300, help="Number of frames")
+    parser.add_argument("--width", type=int, default=1280, help="Image width")
+    parser.add_argument("--height", type=int, default=720, help="Image height")
+    parser.add_argument("--markers", type=int, default=4, help="Number of markers")
+    parser.add_argument(
+        "--marker-size", type=float, default=0.1, help="Marker size in metres"
+    )
+    parser.add_argument("--blur", type=float, default=0.0, help="Blur sigma [px]")
+    parser.add_argument("--noise", type=float, default=0.0, help="Noise sigma")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed")
+    parser.add_argument(
+        "--tracking", action="store_true", help="Enable region of interest tracking"
+    )
+    parser.add_argument(
+        "--scale", type=float, default=1.0, help="Multi-scale detection factor"
+    )
+    parser.add_argument(
+        "--undistort",
+        type=str,
+        default="none",
+        choices=UNDISTORT_MODES,
+        help="Lens distortion handling of the detector",
+    )
+    parser.add_argument(
+        "--pipeline",
+        action="store_true",
+        help="Measure the threaded capture and detection pipeline",
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=10.0,
+        help="Maximum duration of the pipeline benchmark in seconds",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=0,
+        help="Detect in a pool of processes in the pipeline benchmark",
+    )
+    parser.add_argument(
+        "-o", "--output", type=str, default=None, help="Save the results as JSON"
+    )
+    args = parser.parse_args()
+
+    scene = None
+    calibration_id = -1
+    if args.video is not None or args.images is not None:
+        if args.video is not None:
+            capture = VideoFileSource(args.video)
+        else:
+            capture = ImageFolderSource(args.images)
+        config_file = args.config
+        if config_file is None:
+            config_file = Path(__file__).parent / "configuration" / "configuration.yaml"
+        config = Configuration(Path(config_file))
+        camera_matrix = config.camera_matrix
+        camera_distortion = config.camera_distortion
+        image_size = config.camera_image_size
+        marker_size = config.marker_size
+        calibration_id = config.marker.CALIBRATION
+    else:
+        scene = SyntheticScene(
+            args.width,
+            args.height,
+            args.markers,
+            args.marker_size,
+            args.blur,
+            args.noise,
+            # -- The pipeline drops frames, so let it render as many as needed
+            None if args.pipeline else args.frames,
+            args.seed,
+        )
+        capture = scene
+        camera_matrix = scene.camera_matrix
+        camera_distortion = scene.camera_distortion
+        image_size = None
+        marker_size = args.marker_size
+
+    detector = ArucoDetector(
+        camera_matrix,
+        camera_distortion,
+        marker_size,
+        "ENU",
+        tracking=args.tracking,
+        scale=args.scale,
+        undistort=args.undistort,
+        image_size=image_size,
+        capture=capture,
+    )
+    if args.pipeline:
+        results = run_pipelined(
+            detector,
+            args.duration,
+            args.frames,
+            args.workers,
+            {"scale": args.scale, "undistort": args.undistort},
+            scene,
+        )
+    else:
+        results = run_serial(detector, scene, args.frames, calibration_id)
+    results["settings"] = vars(args)
+    print_results(results)
+    if args.output is not None:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Results saved to", args.output)
+
+
+if __name__ == "__main__":
+    main()
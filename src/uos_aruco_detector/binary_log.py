@@ -0,0 +1,237 @@
+import argparse
+import json
+import os
+import struct
+import sys
+import time
+from datetime import datetime
+from pathlib import Path
+
+import numpy as np
+
+from .tag_logger import SESSION_LOG_HEADER
+
+MAGIC = b"UOSARLOG"
+VERSION = 1
+# -- Magic, format version and length of the JSON header that follows
+PREAMBLE = struct.Struct("<8sHI")
+# -- Records start at a multiple of this offset
+ALIGNMENT = 64
+
+# -- One detection of a tag, 43 bytes per record
+RECORD_DTYPE = np.dtype(
+    [
+        ("tag_id", "<u2"),
+        ("epoch", "<f8"),
+        ("elapsed", "<f8"),
+        ("x", "<f4"),
+        ("y", "<f4"),
+        ("z", "<f4"),
+        ("roll", "<f4"),
+        ("pitch", "<f4"),
+        ("yaw", "<f4"),
+        ("broadcasted", "u1"),
+    ]
+)
+
+
+class BinarySink:
+    def __init__(
+        self,
+        fname,
+        metadata,
+        tag_id=None,
+        buffer_size=65536,
+        flush_interval=1.0,
+        flush_rows=100,
+    ):
+        """Fixed-size binary records appended to a file.
+
+        The file starts with a small JSON header describing the session, which
+        is written together with the first record so that it can include the
+        origin set during calibration. Records are stored as RECORD_DTYPE and
+        can be read back with read_binary_log().
+
+        Parameters
+        ----------
+        fname : Path
+            Path of the binary file
+        metadata : dict
+            Session information stored in the header. It is read when the
+            first record is written, so it may be filled in after creation
+        tag_id : int
+            ArUco id of the tag logged in this file, or None for all tags
+        buffer_size : int
+            Size of the file buffer in bytes
+        flush_interval : float
+            Maximum time in seconds a row stays in the buffer
+        flush_rows : int
+            Maximum number of rows kept in the buffer, 0 writes every row
+        """
+        self.fname = Path(fname)
+        self.metadata = metadata
+        self.tag_id = tag_id
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.file = self.fname.open("wb", buffering=buffer_size)
+        self.header_written = False
+        # -- At least one row is buffered, even when every row is flushed
+        self.records = np.zeros(max(flush_rows, 1), dtype=RECORD_DTYPE)
+        self.pending_rows = 0
+        self.last_flush_time = time.monotonic()
+
+    def write_header(self):
+        header = dict(self.metadata)
+        header["tag_id"] = self.tag_id
+        header["dtype"] = RECORD_DTYPE.descr
+        header["created"] = datetime.now().isoformat()
+        data = json.dumps(header).encode("utf-8")
+        # -- Pad with spaces so that records are aligned
+        padding = -(PREAMBLE.size + len(data)) % ALIGNMENT
+        data += b" " * padding
+        self.file.write(PREAMBLE.pack(MAGIC, VERSION, len(data)))
+        self.file.write(data)
+        self.header_written = True
+
+    def write_row(self, row):
+        """Write a row with the same columns as SESSION_LOG_HEADER."""
+        if not self.header_written:
+            self.write_header()
+        self.records[self.pending_rows] = tuple(row)
+        self.pending_rows += 1
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush the buffered rows if the row count or time limit is reached."""
+        if self.pending_rows == 0:
+            return
+        if (
+            self.pending_rows >= self.flush_rows
+            or time.monotonic() - self.last_flush_time >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to disk."""
+        if self.file.closed:
+            return
+        self.file.write(self.records[: self.pending_rows].tobytes())
+        self.file.flush()
+        self.pending_rows = 0
+        self.last_flush_time = time.monotonic()
+
+    def close(self):
+        """Flush the buffered rows and close the file."""
+        if self.file.closed:
+            return
+        if not self.header_written:
+            self.write_header()
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+def read_binary_log(fname):
+    """Read a binary log without loading the records into memory.
+
+    Parameters
+    ----------
+    fname : Path
+        Path of the binary log
+
+    Returns
+    -------
+    dict
+        Header of the log
+    np.memmap
+        Records of the log, with dtype RECORD_DTYPE
+    """
+    fname = Path(fname)
+    with fname.open("rb") as f:
+        preamble = f.read(PREAMBLE.size)
+        if len(preamble) < PREAMBLE.size:
+            raise ValueError(f"{fname} is empty")
+        magic, version, header_size = PREAMBLE.unpack(preamble)
+        if magic != MAGIC:
+            raise ValueError(f"{fname} is not an ArUco binary log")
+        if version > VERSION:
+            raise ValueError(f"{fname} has an unsupported version {version}")
+        header = json.loads(f.read(header_size).decode("utf-8"))
+    offset = PREAMBLE.size + header_size
+    # -- Ignore a partially written record at the end of the file
+    count = (fname.stat().st_size - offset) // RECORD_DTYPE.itemsize
+    if count == 0:
+        return header, np.zeros(0, dtype=RECORD_DTYPE)
+    records = np.memmap(
+        fname, dtype=RECORD_DTYPE, mode="r", offset=offset, shape=(count,)
+    )
+    return header, records
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Convert binary ArUco logs to CSV or Parquet. All the logs of"
+        + " a session folder are merged in a single table sorted by time."
+    )
+    parser.add_argument(
+        "input", type=str, help="Binary log file or session folder containing them"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=str,
+        default="csv",
+        choices=["csv", "parquet"],
+        help="Output format",
+    )
+    parser.add_argument(
+        "-o",
+        "--output",
+        type=str,
+        default=None,
+        help="Output file. Defaults to the input with the new extension",
+    )
+    args = parser.parse_args()
+
+    import pandas as pd
+
+    input_path = Path(args.input)
+    if input_path.is_dir():
+        files = sorted(input_path.glob("*.bin"))
+        output = input_path / ("session." + args.format)
+    else:
+        files = [input_path]
+        output = input_path.with_suffix("." + args.format)
+    if args.output is not None:
+        output = Path(args.output)
+    if len(files) == 0:
+        print("No binary logs found in {}".format(input_path))
+        sys.exit(1)
+
+    logs = []
+    for f in files:
+        try:
+            logs.append(read_binary_log(f)[1])
+        except ValueError as e:
+            print("Skipping {}".format(e))
+    if len(logs) == 0:
+        print("No records to convert")
+        sys.exit(1)
+    records = np.concatenate(logs)
+    records = records[np.argsort(records["epoch"], kind="stable")]
+    df = pd.DataFrame(records)
+    df.columns = SESSION_LOG_HEADER
+    print("Converting {} records from {} files".format(len(df), len(files)))
+    if args.format == "csv":
+        df.to_csv(output, index=False)
+    else:
+        try:
+            df.to_parquet(output, index=False)
+        except ImportError as e:
+            print("Parquet export needs pyarrow or fastparquet: {}".format(e))
+            sys.exit(1)
+    print("Saved", output)
+
+
+if __name__ == "__main__":
+    main()
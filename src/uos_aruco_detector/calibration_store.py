@@ -0,0 +1,283 @@
+import os
+from dataclasses import dataclass
+from datetime import datetime
+from pathlib import Path
+
+import cv2
+import numpy as np
+import yaml
+
+# -- Number of distortion coefficients of each model, and the flags calibrating it
+DISTORTION_MODELS = {
+    "plumb_bob": 5,
+    "rational_polynomial": 8,
+    "thin_prism": 12,
+    "tilted": 14,
+}
+MODEL_FLAGS = {
+    "plumb_bob": 0,
+    "rational_polynomial": cv2.CALIB_RATIONAL_MODEL,
+    "thin_prism": cv2.CALIB_RATIONAL_MODEL | cv2.CALIB_THIN_PRISM_MODEL,
+    "tilted": cv2.CALIB_RATIONAL_MODEL
+    | cv2.CALIB_THIN_PRISM_MODEL
+    | cv2.CALIB_TILTED_MODEL,
+}
+# -- Largest relative difference of aspect ratio between the calibrated and the
+# -- captured images for which the intrinsics are rescaled
+MAX_ASPECT_CHANGE = 0.01
+
+
+def distortion_model(camera_distortion):
+    """Name of the distortion model with this many coefficients."""
+    count = np.asarray(camera_distortion).size
+    # -- OpenCV also accepts the 4 coefficients of plumb_bob without k3
+    if count == 4:
+        return "plumb_bob"
+    for model, coefficients in DISTORTION_MODELS.items():
+        if coefficients == count:
+            return model
+    raise ValueError(
+        "{} distortion coefficients match no model, expected 4, 5, 8, 12 or"
+        " 14".format(count)
+    )
+
+
+def scale_camera_matrix(camera_matrix, calibrated_size, size):
+    """Camera matrix of a calibration for images of another resolution.
+
+    The distortion coefficients apply to normalised coordinates, so only the
+    focal lengths and the principal point change. Pixel centres are kept
+    aligned, which matters for binned camera modes.
+
+    Parameters
+    ----------
+    camera_matrix : np.ndarray
+        3x3 camera matrix for the calibrated size
+    calibrated_size : tuple
+        (width, height) of the calibration images
+    size : tuple
+        (width, height) of the captured images
+
+    Returns
+    -------
+    np.ndarray
+        3x3 camera matrix for the captured images
+    """
+    sx = size[0] / calibrated_size[0]
+    sy = size[1] / calibrated_size[1]
+    if abs(sx / sy - 1.0) > MAX_ASPECT_CHANGE:
+        raise ValueError(
+            "The camera was calibrated at {}x{} and captures {}x{}: the aspect"
+            " ratio changed, calibrate this resolution".format(
+                calibrated_size[0], calibrated_size[1], size[0], size[1]
+            )
+        )
+    scaled = np.array(camera_matrix, dtype=np.float64)
+    scaled[0, 0] *= sx
+    scaled[0, 1] *= sx
+    scaled[1, 1] *= sy
+    scaled[0, 2] = (scaled[0, 2] + 0.5) * sx - 0.5
+    scaled[1, 2] = (scaled[1, 2] + 0.5) * sy - 0.5
+    return scaled
+
+
+@dataclass
+class CameraCalibration:
+    """Intrinsics of a camera, as stored in the camera section."""
+
+    camera_matrix: np.ndarray
+    distortion: np.ndarray
+    # -- (width, height) of the calibration images, None if unknown
+    image_size: tuple = None
+    reprojection_error: float = None  # [px]
+    views: int = None
+    date: str = None
+
+    @property
+    def model(self):
+        return distortion_model(self.distortion)
+
+    @classmethod
+    def from_section(cls, section, base_dir=None):
+        """Read and validate a camera section.
+
+        Parameters
+        ----------
+        section : dict
+            camera section of the configuration. With a file key, the camera
+            section of that file is read instead, e.g. the output of
+            uos_aruco_camera_calibration
+        base_dir : Path
+            Folder relative file paths start from
+
+        Returns
+        -------
+        CameraCalibration
+        """
+        if not isinstance(section, dict):
+            raise ValueError("The camera section must be a mapping")
+        if section.get("file"):
+            path = Path(section["file"]).expanduser()
+            if base_dir is not None and not path.is_absolute():
+                path = Path(base_dir) / path
+            if not path.exists():
+                raise FileNotFoundError(f"Camera calibration file {path} not found")
+            with path.open("r") as f:
+                stored = yaml.safe_load(f) or {}
+            return cls.from_section(stored.get("camera", stored), path.parent)
+
+        try:
+            camera_matrix = np.array(section["matrix"], dtype=np.float64)
+            distortion = np.array(section["distortion"], dtype=np.float64).ravel()
+        except KeyError as e:
+            raise ValueError(f"The camera section has no {e.args[0]}") from None
+        except (TypeError, ValueError):
+            raise ValueError("The camera matrix and distortion must be numbers")
+        if camera_matrix.shape != (3, 3):
+            raise ValueError("The camera matrix must be 3x3")
+        if not np.all(np.isfinite(camera_matrix)) or not np.all(
+            np.isfinite(distortion)
+        ):
+            raise ValueError("The camera calibration is not finite")
+        if camera_matrix[0, 0] <= 0 or camera_matrix[1, 1] <= 0:
+            raise ValueError("The focal lengths of the camera matrix must be positive")
+        if not np.allclose(camera_matrix[2], [0.0, 0.0, 1.0]) or camera_matrix[1, 0]:
+            raise ValueError("The camera matrix must be upper triangular with a 1")
+        model = distortion_model(distortion)
+        if section.get("model", model) != model:
+            if section["model"] not in DISTORTION_MODELS:
+                raise ValueError(f"Unknown distortion model {section['model']}")
+            raise ValueError(
+                "The {} model has {} distortion coefficients, not {}".format(
+                    section["model"],
+                    DISTORTION_MODELS[section["model"]],
+                    distortion.size,
+                )
+            )
+
+        image_size = section.get("image_size")
+        if image_size is not None:
+            if len(image_size) != 2 or min(int(x) for x in image_size) <= 0:
+                raise ValueError("The camera image_size must be [width, height]")
+            image_size = (int(image_size[0]), int(image_size[1]))
+        error = section.get("reprojection_error")
+        views = section.get("views")
+        return cls(
+            camera_matrix,
+            distortion,
+            image_size,
+            float(error) if error is not None else None,
+            int(views) if views is not None else None,
+            section.get("date"),
+        )
+
+    def check_size(self, size):
+        """Raise a ValueError if frames of this (width, height) cannot be used.
+
+        The camera matrix is rescaled to frames of another resolution, but not
+        to frames of another aspect ratio. A 0 width or height, i.e. the
+        default of the camera, is not checked.
+        """
+        if self.image_size is not None and min(size) > 0:
+            scale_camera_matrix(self.camera_matrix, self.image_size, size)
+
+    def section(self):
+        """camera section of the configuration file, in its usual layout."""
+        lines = ["camera:", "  matrix:"]
+        for row in self.camera_matrix:
+            lines.append("    - [{}]".format(", ".join("%f" % x for x in row)))
+        # -- The thin prism and tilt coefficients are small, keep their digits
+        distortion = ", ".join("%.8g" % x for x in self.distortion)
+        lines.append("  distortion: [{}]".format(distortion))
+        lines.append("  model: {}".format(self.model))
+        if self.image_size is not None:
+            lines.append("  image_size: [{}, {}]".format(*self.image_size))
+        if self.reprojection_error is not None:
+            lines.append("  reprojection_error: %f  # [px]" % self.reprojection_error)
+        if self.views is not None:
+            lines.append("  views: {}".format(self.views))
+        if self.date is not None:
+            lines.append('  date: "{}"'.format(self.date))
+        return "\n".join(lines) + "\n"
+
+    def save(self, filename):
+        """Write the calibration to its own file, loadable with camera: {file: }."""
+        replace_text(Path(filename), self.section())
+
+
+def new_calibration(camera_matrix, camera_distortion, size, error=None, views=None):
+    """CameraCalibration of a calibration made now."""
+    return CameraCalibration(
+        np.array(camera_matrix, dtype=np.float64).reshape(3, 3),
+        np.array(camera_distortion, dtype=np.float64).ravel(),
+        (int(size[0]), int(size[1])),
+        float(error) if error is not None else None,
+        views,
+        datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+    )
+
+
+def replace_text(filename, text):
+    """Replace a file atomically, once the text is checked to load."""
+    config = yaml.safe_load(text)
+    CameraCalibration.from_section(config["camera"])
+    temporary = filename.with_name(filename.name + ".tmp")
+    temporary.write_text(text)
+    os.replace(temporary, filename)
+
+
+def write_camera_calibration(filename, calibration):
+    """Replace the camera section of a configuration file with a calibration.
+
+    The rest of the file, including its comments, is kept as it is. The file
+    is replaced atomically, and only if the result still loads. A camera
+    section with a file key is left as it is, and the calibration is written
+    to the referenced file instead.
+
+    Parameters
+    ----------
+    filename : Path
+        Configuration file
+    calibration : CameraCalibration
+        Calibration written to the file
+
+    Returns
+    -------
+    Path
+        File the calibration was written to
+    """
+    filename = Path(filename)
+    text = filename.read_text()
+    config = yaml.safe_load(text) or {}
+    section = config.get("camera") if isinstance(config, dict) else None
+    if isinstance(section, dict) and section.get("file"):
+        path = Path(section["file"]).expanduser()
+        if not path.is_absolute():
+            path = filename.parent / path
+        # -- The referenced file may only hold the section, without the key
+        if path.exists() and "camera" in (yaml.safe_load(path.read_text()) or {}):
+            return write_camera_calibration(path, calibration)
+        calibration.save(path)
+        return path
+
+    # -- Find the lines of the section from the parsed file, so that any
+    # -- layout of the section is replaced, e.g. camera: {matrix: ...}
+    lines = text.splitlines(keepends=True)
+    start = end = None
+    root = yaml.compose(text)
+    if isinstance(root, yaml.MappingNode):
+        for key, value in root.value:
+            if key.value == "camera":
+                start = key.start_mark.line
+                end = value.end_mark.line + (value.end_mark.column > 0)
+    if start is None:
+        text = "".join(lines).rstrip("\n") + "\n\n" + calibration.section()
+    else:
+        # -- Keep the blank lines and comments that precede the next section
+        while end > start + 1 and (
+            not lines[end - 1].strip() or lines[end - 1].startswith("#")
+        ):
+            end -= 1
+        text = "".join(lines[:start]) + calibration.section() + "".join(lines[end:])
+    replace_text(filename, text)
+    return filename
@@ -1,52 +1,426 @@
 import argparse
-import glob
+import hashlib
+import multiprocessing
+import os
 import sys
-from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+from dataclasses import dataclass
 from pathlib import Path
 
 import cv2
+import cv2.aruco as aruco
 import numpy as np
 
+from .aruco_detector import DICTIONARY
+from .calibration_store import (
+    DISTORTION_MODELS,
+    MODEL_FLAGS,
+    new_calibration,
+    write_camera_calibration,
+)
+
+# -- Changing the corner extraction invalidates the cached corners
+CORNER_CACHE_VERSION = 2
+CHESSBOARD_FLAGS = (
+    cv2.CALIB_CB_ADAPTIVE_THRESH
+    + cv2.CALIB_CB_FAST_CHECK
+    + cv2.CALIB_CB_NORMALIZE_IMAGE
+)
+SUBPIX_WINDOW = (11, 11)
+# -- Termination criteria of the sub-pixel refinement
+SUBPIX_CRITERIA = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 1000, 0.0001)
+# -- Fewest ChArUco corners for a partial view to be used
+MIN_CHARUCO_CORNERS = 6
+# -- Cells of the image counted by the view selection
+COVERAGE_GRID = (8, 6)
+# -- Views of the first calibration estimating the board orientations
+INITIAL_VIEWS = 20
+
+
+@dataclass(frozen=True)
+class CalibrationBoard:
+    """Calibration target, a plain chessboard or a ChArUco board.
+
+    Both are described by their nx by ny inside corners. A ChArUco board has
+    nx + 1 by ny + 1 squares with markers of the DICT_4X4_100 dictionary of the
+    detector in its white squares, so its corners can be identified in partial
+    views of the board.
+    """
+
+    kind: str = "chessboard"  # chessboard or charuco
+    nx: int = 9
+    ny: int = 6
+    square_size: float = 0.03  # [m]
+    marker_size: float = 0.0225  # [m] ChArUco markers only
+
+    @property
+    def pattern_size(self):
+        return (self.nx, self.ny)
+
+    @property
+    def num_corners(self):
+        return self.nx * self.ny
+
+    def key(self):
+        """Identifier of the board in the corner cache."""
+        key = "{}_{}x{}_v{}".format(self.kind, self.nx, self.ny, CORNER_CACHE_VERSION)
+        if self.kind == "charuco":
+            key += "_{:g}".format(self.marker_size / self.square_size)
+        return key
+
+    def charuco(self):
+        return aruco.CharucoBoard_create(
+            self.nx + 1,
+            self.ny + 1,
+            self.square_size,
+            self.marker_size,
+            aruco.getPredefinedDictionary(DICTIONARY),
+        )
+
+    def object_points(self, ids):
+        """3D inside corners of the board with the given ids, (0,0,0), (1,0,0)
+        .... times the square size, in the order of the ids."""
+        points = np.zeros((self.num_corners, 3), np.float32)
+        points[:, :2] = np.mgrid[0 : self.nx, 0 : self.ny].T.reshape(-1, 2)
+        return points[np.asarray(ids).ravel()] * self.square_size
+
+
+def file_hash(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def corner_cache_path(cache_dir, path, board):
+    """Cache file of the corners of an image, keyed by its content and the board."""
+    return Path(cache_dir) / "{}_{}.npz".format(file_hash(path), board.key())
+
+
+def downscale(gray, scale):
+    if scale >= 1.0:
+        return gray
+    return cv2.resize(gray, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+
+def find_chessboard(gray, board, scale=1.0):
+    """Find the corners of a chessboard, in the image downscaled by scale.
 
-def yaml(size, intrinsics, distortion, num_images, avg_reprojection_error):
-    now = datetime.now()
-    calmessage = (
-        "%YAML:1.0\n"
-        + "image_width: "
-        + str(size[0])
-        + "\n"
-        + "image_height: "
-        + str(size[1])
-        + "\n"
-        + "camera_matrix: !!opencv-matrix\n"
-        + "  rows: 3\n"
-        + "  cols: 3\n"
-        + "  dt: d\n"
-        + "  data: ["
-        + ", ".join(["%8f" % i for i in intrinsics.reshape(1, 9)[0]])
-        + "]\n"
-        + "distortion_model: "
-        + ("rational_polynomial" if distortion.size > 5 else "plumb_bob")
-        + "\n"
-        + "distortion_coefficients: !!opencv-matrix\n"
-        + "  rows: 1\n"
-        + "  cols: 5\n"
-        + "  dt: d\n"
-        + "  data: ["
-        + ", ".join(["%8f" % i for i in distortion.reshape(1, distortion.size)[0]])
-        + "]\n"
-        + 'date: "'
-        + now.strftime("%d/%m/%Y %H:%M:%S")
-        + '" \n'
-        + "number_of_images: "
-        + str(num_images)
-        + "\n"
-        + "avg_reprojection_error: "
-        + str(avg_reprojection_error)
-        + "\n"
-        + ""
-    )
-    return calmessage
+    The corners are then refined in the full resolution image.
+    """
+    found, corners = cv2.findChessboardCorners(
+        downscale(gray, scale), board.pattern_size, CHESSBOARD_FLAGS
+    )
+    if not found:
+        return None, None
+    if scale < 1.0:
+        corners = (corners + 0.5) / scale - 0.5
+    # --- Sometimes, Harris cornes fails with crappy pictures, so
+    corners = cv2.cornerSubPix(gray, corners, SUBPIX_WINDOW, (-1, -1), SUBPIX_CRITERIA)
+    return corners, np.arange(board.num_corners, dtype=np.int32).reshape(-1, 1)
+
+
+def find_charuco(gray, board, scale=1.0):
+    """Find the corners of a ChArUco board, which may be partly visible.
+
+    The markers are found in the image downscaled by scale and the corners
+    are interpolated and refined in the full resolution image.
+    """
+    charuco = board.charuco()
+    marker_corners, marker_ids, _ = aruco.detectMarkers(
+        downscale(gray, scale), charuco.dictionary
+    )
+    if marker_ids is None or len(marker_ids) < 2:
+        return None, None
+    if scale < 1.0:
+        marker_corners = tuple((c + 0.5) / scale - 0.5 for c in marker_corners)
+    count, corners, ids = aruco.interpolateCornersCharuco(
+        marker_corners, marker_ids, gray, charuco
+    )
+    if corners is None or count < MIN_CHARUCO_CORNERS:
+        return None, None
+    # -- Corners on a single line do not constrain the camera
+    if aruco.testCharucoCornersCollinear(charuco, ids):
+        return None, None
+    return corners, ids
+
+
+def find_board(gray, board, scale=1.0):
+    """Corners and ids of the corners of a board in a gray image, or None."""
+    if board.kind == "charuco":
+        return find_charuco(gray, board, scale)
+    return find_chessboard(gray, board, scale)
+
+
+def extract_corners(path, board, cache_dir=None):
+    """Find and refine the corners of the calibration board in an image.
+
+    Runs in the worker processes of the calibration. The result, including
+    a board that was not found, is cached so that the image is only processed
+    once for a given board.
+
+    Parameters
+    ----------
+    path : Path
+        Image file
+    board : CalibrationBoard
+        Board to look for
+    cache_dir : Path
+        Folder of the cached corners, None to always process the image
+
+    Returns
+    -------
+    np.ndarray
+        (N, 1, 2) refined corners, or None if the board was not found
+    np.ndarray
+        (N, 1) ids of the corners on the board, or None
+    tuple
+        (width, height) of the image, or None if it could not be read
+    bool
+        True if the result came from the cache
+    """
+    cache_file = None
+    if cache_dir is not None:
+        cache_file = corner_cache_path(cache_dir, path, board)
+        if cache_file.exists():
+            try:
+                with np.load(cache_file) as cached:
+                    size = tuple(int(x) for x in cached["size"])
+                    if not cached["found"]:
+                        return None, None, size, True
+                    return cached["corners"], cached["ids"], size, True
+            except (OSError, ValueError, KeyError):
+                pass
+
+    img = cv2.imread(str(path))
+    if img is None:
+        return None, None, None, False
+    # -- Convert in greyscale
+    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+    size = (gray.shape[1], gray.shape[0])
+    corners, ids = find_board(gray, board)
+
+    if cache_file is not None:
+        cache_file.parent.mkdir(parents=True, exist_ok=True)
+        # -- Written aside and renamed, so that an interrupted run never
+        # -- leaves a truncated cache file
+        temporary = cache_file.with_name(
+            "{}.{}.tmp.npz".format(cache_file.stem, os.getpid())
+        )
+        found = corners is not None
+        np.savez(
+            temporary,
+            found=found,
+            corners=corners if found else np.zeros((0, 1, 2), np.float32),
+            ids=ids if found else np.zeros((0, 1), np.int32),
+            size=size,
+        )
+        os.replace(temporary, cache_file)
+    return corners, ids, size, False
+
+
+def extract_all_corners(images, board, cache_dir=None, jobs=None):
+    """Extract the corners of all the images in a pool of processes.
+
+    Returns
+    -------
+    list
+        (corners, ids, size, cached) of each image, in the order of the images
+    """
+    jobs = jobs or os.cpu_count() or 1
+    if jobs == 1 or len(images) < 2:
+        return [extract_corners(p, board, cache_dir) for p in images]
+    # -- Spawned processes do not inherit the OpenCV state of this one
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(jobs, mp_context=context) as executor:
+        return list(
+            executor.map(
+                extract_corners,
+                images,
+                [board] * len(images),
+                [cache_dir] * len(images),
+                chunksize=max(1, len(images) // (4 * jobs)),
+            )
+        )
+
+
+def coverage_cells(corners, size, grid=COVERAGE_GRID):
+    """Cells of a grid over the image that contain corners of a view."""
+    points = corners.reshape(-1, 2)
+    columns = np.clip((points[:, 0] * grid[0] / size[0]).astype(int), 0, grid[0] - 1)
+    rows = np.clip((points[:, 1] * grid[1] / size[1]).astype(int), 0, grid[1] - 1)
+    return set((rows * grid[0] + columns).tolist())
+
+
+def board_normals(objpoints, imgpoints, camera_matrix, distortion):
+    """Unit normal of the board in the camera frame of each view."""
+    normals = np.zeros((len(objpoints), 3))
+    for i, (objp, imgp) in enumerate(zip(objpoints, imgpoints)):
+        ok, rvec, _ = cv2.solvePnP(objp, imgp, camera_matrix, distortion)
+        if ok:
+            normals[i] = cv2.Rodrigues(rvec)[0][:, 2]
+    return normals
+
+
+def select_views(
+    objpoints,
+    imgpoints,
+    size,
+    max_views,
+    diversity=0.5,
+    grid=COVERAGE_GRID,
+    max_angle=30.0,
+):
+    """Greedy selection of the most informative views.
+
+    Each step adds the view with the largest gain: the fraction of the cells
+    of a grid over the image that its corners newly cover, plus diversity
+    times the angle between its board orientation and the closest one already
+    selected, relative to max_angle. The orientations come from a first
+    calibration on a subset of the views. Views that bring neither coverage
+    nor a new orientation are left out.
+
+    Parameters
+    ----------
+    objpoints : list
+        3D board points of each view
+    imgpoints : list
+        Image points of each view
+    size : tuple
+        (width, height) of the images
+    max_views : int
+        Maximum number of views selected
+    diversity : float
+        Weight of the orientation diversity against the coverage
+    grid : tuple
+        Number of coverage cells in x and y
+    max_angle : float
+        Angle in degrees from which orientations are fully diverse
+
+    Returns
+    -------
+    list
+        Indices of the selected views
+    """
+    count = len(objpoints)
+    if count <= max_views:
+        return list(range(count))
+    cells = [coverage_cells(imgp, size, grid) for imgp in imgpoints]
+    num_cells = grid[0] * grid[1]
+    normals = None
+    subset = np.linspace(0, count - 1, min(count, INITIAL_VIEWS)).astype(int)
+    try:
+        _, camera_matrix, distortion, _, _ = cv2.calibrateCamera(
+            [objpoints[i] for i in subset],
+            [imgpoints[i] for i in subset],
+            size,
+            None,
+            None,
+        )
+        normals = board_normals(objpoints, imgpoints, camera_matrix, distortion)
+    except cv2.error:
+        print("Could not estimate the board orientations, selecting by coverage")
+
+    selected = []
+    covered = set()
+    # -- Angle to the closest selected orientation, full diversity at first
+    closest = np.full(count, max_angle)
+    available = np.ones(count, dtype=bool)
+    while len(selected) < max_views and available.any():
+        gains = np.array([len(c - covered) / num_cells for c in cells])
+        if normals is not None:
+            gains += diversity * np.minimum(closest / max_angle, 1.0)
+        gains[~available] = -1.0
+        best = int(np.argmax(gains))
+        if gains[best] <= 1e-3:
+            break
+        selected.append(best)
+        available[best] = False
+        covered |= cells[best]
+        if normals is not None:
+            cosines = np.clip(normals @ normals[best], -1.0, 1.0)
+            closest = np.minimum(closest, np.degrees(np.arccos(cosines)))
+    return sorted(selected)
+
+
+def calibrate_rejecting_outliers(
+    objpoints, imgpoints, size, outlier_ratio=3.0, min_views=3, model="plumb_bob"
+):
+    """Calibrate, removing the worst view while it is an outlier.
+
+    A view is an outlier when its reprojection error exceeds outlier_ratio
+    times the median error of the views. The camera is calibrated again after
+    each removal, as the errors of the other views change. model is one of
+    DISTORTION_MODELS.
+
+    Returns
+    -------
+    float
+        RMS reprojection error of the kept views [px]
+    np.ndarray
+        3x3 camera matrix
+    np.ndarray
+        Distortion coefficients
+    list
+        Indices of the kept views
+    np.ndarray
+        Reprojection error of each kept view [px]
+    """
+    kept = list(range(len(objpoints)))
+    while True:
+        (
+            rms,
+            camera_matrix,
+            distortion,
+            _,
+            _,
+            _,
+            _,
+            errors,
+        ) = cv2.calibrateCameraExtended(
+            [objpoints[i] for i in kept],
+            [imgpoints[i] for i in kept],
+            size,
+            None,
+            None,
+            flags=MODEL_FLAGS[model],
+        )
+        # -- OpenCV pads the coefficients of the rational models to 14
+        distortion = distortion.reshape(1, -1)[:, : DISTORTION_MODELS[model]]
+        errors = errors.ravel()
+        worst = int(np.argmax(errors))
+        if (
+            outlier_ratio <= 0
+            or len(kept) <= min_views
+            or errors[worst] <= outlier_ratio * np.median(errors)
+        ):
+            return rms, camera_matrix, distortion, kept, errors
+        print(
+            "Rejecting view {} with a reprojection error of {:.3f} px".format(
+                kept[worst], errors[worst]
+            )
+        )
+        del kept[worst]
+
+
+def review_image(path, board, corners, ids):
+    """Show the corners found in an image and ask whether to use it."""
+    img = cv2.imread(str(path))
+    print("Press ESC to skip or ENTER to accept")
+    # Draw and display the corners
+    cv2.namedWindow("uos-aruco-camera-cal", cv2.WINDOW_NORMAL)
+    if board.kind == "charuco":
+        aruco.drawDetectedCornersCharuco(img, corners, ids)
+    else:
+        cv2.drawChessboardCorners(img, board.pattern_size, corners, True)
+    cv2.imshow("uos-aruco-camera-cal", img)
+    k = cv2.waitKey(0) & 0xFF
+    if k == 27:  # -- ESC Button
+        print("Image Skipped")
+        return False
+    print("Image accepted")
+    return True
 
 
 def main():
@@ -69,6 +443,50 @@ def main():
     parser.add_argument(
         "--size", type=float, default=0.03, help="Size of chessboard squares"
     )
+    parser.add_argument(
+        "--board",
+        type=str,
+        default="chessboard",
+        choices=["chessboard", "charuco"],
+        help="Calibration board. A ChArUco board has nx + 1 by ny + 1 squares and"
+        + " can be partly visible",
+    )
+    parser.add_argument(
+        "--marker-size",
+        type=float,
+        default=None,
+        help="Size of the ChArUco markers. Defaults to 0.75 times the square size",
+    )
+    parser.add_argument(
+        "--draw-board",
+        type=int,
+        default=0,
+        metavar="WIDTH",
+        help="Save an image of the ChArUco board this many pixels wide to print,"
+        + " and exit",
+    )
+    parser.add_argument(
+        "--max-views",
+        type=int,
+        default=40,
+        help="Calibrate with at most this many views, selected for their coverage"
+        + " of the image and the diversity of the board orientations. 0 uses all",
+    )
+    parser.add_argument(
+        "--outlier-ratio",
+        type=float,
+        default=3.0,
+        help="Reject the views whose reprojection error exceeds this many times the"
+        + " median error. 0 keeps all the views",
+    )
+    parser.add_argument(
+        "--model",
+        type=str,
+        default="plumb_bob",
+        choices=list(DISTORTION_MODELS),
+        help="Distortion model: 5, 8, 12 or 14 coefficients. The rational and"
+        + " later models suit wide-angle lenses but need more views",
+    )
     parser.add_argument(
         "-o",
         "--output",
@@ -77,6 +495,54 @@ def main():
         help="Output directory for calibration results",
     )
     parser.add_argument("--debug", action="store_true", help="Show debug images")
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=None,
+        help="Number of processes extracting the corners. Defaults to the number"
+        + " of cores",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        type=str,
+        default=None,
+        help="Folder caching the corners of each image. Defaults to"
+        + " .calibration_cache in the input folder",
+    )
+    parser.add_argument(
+        "--no-cache", action="store_true", help="Process every image again"
+    )
+    parser.add_argument(
+        "--live",
+        action="store_true",
+        help="Calibrate the camera of the configuration from its live frames and"
+        + " save the result in its camera section",
+    )
+    parser.add_argument(
+        "--config",
+        type=str,
+        default=str(
+            Path.home() / "uos_aruco_detector" / "configuration" / "configuration.yaml"
+        ),
+        help="Configuration file read and updated by --live and --update-config",
+    )
+    parser.add_argument(
+        "--update-config",
+        action="store_true",
+        help="Also write the calibration into the camera section of --config",
+    )
+    parser.add_argument(
+        "--preview-scale",
+        type=float,
+        default=0.5,
+        help="Scale of the preview the board is searched in with --live",
+    )
+    parser.add_argument(
+        "--headless",
+        action="store_true",
+        help="With --live, show no window and save once --max-views views are kept",
+    )
     args = parser.parse_args()
 
     # If no arguments are provided, print help
@@ -88,10 +554,45 @@ def main():
             "Users can skip the image pressing ESC or accepting the image with RETURN.",
             "At the end the end the following files are created:\n",
             "  - camera_calibration.yaml:\n",
-            "      Contains the calibration matrix and distortion coefficients\n",
+            "      camera section with the calibration matrix, distortion",
+            "coefficients and image size, loaded with camera: {file: ...}\n",
         )
         sys.exit(1)
 
+    output_directory = Path(args.output)
+    board = CalibrationBoard(
+        args.board,
+        args.nx,
+        args.ny,
+        args.size,
+        args.marker_size if args.marker_size is not None else 0.75 * args.size,
+    )
+    if args.draw_board > 0:
+        output_directory.mkdir(parents=True, exist_ok=True)
+        width = args.draw_board
+        height = int(round(width * (board.ny + 1) / (board.nx + 1)))
+        output_file = str(output_directory / "charuco_board.png")
+        cv2.imwrite(output_file, board.charuco().draw((width, height)))
+        print("Board saved as", output_file)
+        sys.exit()
+
+    if args.live:
+        # -- Imported here as the live calibration builds on this module
+        from .configuration import Configuration
+        from .live_calibration import run
+
+        config_file = Path(args.config)
+        run(
+            Configuration(config_file),
+            config_file,
+            board,
+            args.preview_scale,
+            args.max_views or 40,
+            args.headless,
+            args.model,
+        )
+        sys.exit()
+
     if args.input is None:
         print("Please specify an input folder")
         sys.exit(1)
@@ -108,20 +609,16 @@ def main():
         print("Please specify extension")
         sys.exit(1)
 
-    output_directory = Path(args.output)
     if not output_directory.exists():
         output_directory.mkdir(parents=True)
 
     debug = args.debug
-    n_rows = args.nx
-    n_cols = args.ny
-    dimension = args.size
     image_folder = Path(args.input)
     image_extension = args.extension
-    images = list(image_folder.glob("*." + image_extension))
-
-    # Define the dimensions of checkerboard
-    CHECKERBOARD = (n_rows, n_cols)
+    images = sorted(image_folder.glob("*." + image_extension))
+    cache_dir = None
+    if not args.no_cache:
+        cache_dir = Path(args.cache_dir or image_folder / ".calibration_cache")
 
     print(
         "Looking for images in {}".format(image_folder),
@@ -132,62 +629,38 @@ def main():
         print("Not enough images were found: at least 9 shall be provided")
         sys.exit()
 
-    # termination criteria
-    criteria = (cv2.TERM_CRITERIA_EPS + cv2.TERM_CRITERIA_MAX_ITER, 1000, 0.0001)
-
-    # prepare object points, like (0,0,0), (1,0,0), (2,0,0) ....,(6,5,0)
-    #  3D points real world coordinates
-    objectp3d = np.zeros((1, CHECKERBOARD[0] 
-                          * CHECKERBOARD[1], 
-                          3), np.float32)
-    objectp3d[0, :, :2] = np.mgrid[0:CHECKERBOARD[0],
-                                   0:CHECKERBOARD[1]].T.reshape(-1, 2)
-    objectp3d *= dimension
+    results = extract_all_corners(images, board, cache_dir, args.jobs)
+    cached = sum(1 for result in results if result[3])
+    print("Processed {} images, {} from the cache".format(len(images) - cached, cached))
 
     # Arrays to store object points and image points from all the images.
     objpoints = []  # 3d point in real world space
     imgpoints = []  # 2d points in image plane.
-
-    num_patterns_found = 0
     good_images = []
+    size = None
 
-    for fname in images:
-        # -- Read the file and convert in greyscale
-        img = cv2.imread(str(fname))
-        gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-
-        print("Reading image ", fname)
-
-        # Find the chess board corners
-        chessboard_found, corners = cv2.findChessboardCorners(
-            gray, CHECKERBOARD, cv2.CALIB_CB_ADAPTIVE_THRESH 
-                    + cv2.CALIB_CB_FAST_CHECK + 
-                    cv2.CALIB_CB_NORMALIZE_IMAGE
-        )
-
-        if not chessboard_found:
+    for fname, (corners, ids, image_size, _) in zip(images, results):
+        if image_size is None:
+            print("Could not read image ", fname)
             continue
-
-        # If found, add object points, image points (after refining them)
-        print("Pattern found!")
-        # --- Sometimes, Harris cornes fails with crappy pictures, so
-        corners2 = cv2.cornerSubPix(gray, corners, (11, 11), (-1, -1), criteria)
-
-        if debug:
-            print("Press ESC to skip or ENTER to accept")
-            # Draw and display the corners
-            cv2.namedWindow("uos-aruco-camera-cal", cv2.WINDOW_NORMAL)
-            cv2.drawChessboardCorners(img, (n_cols, n_rows), corners2, chessboard_found)
-            cv2.imshow("uos-aruco-camera-cal", img)
-            k = cv2.waitKey(0) & 0xFF
-            if k == 27:  # -- ESC Button
-                print("Image Skipped")
-            print("Image accepted")
-        num_patterns_found += 1
-        objpoints.append(objectp3d)
-        imgpoints.append(corners2)
+        if corners is None:
+            continue
+        if size is None:
+            size = image_size
+        elif image_size != size:
+            print(
+                "Skipping {}: its size {} differs from {}".format(
+                    fname, image_size, size
+                )
+            )
+            continue
+        if debug and not review_image(fname, board, corners, ids):
+            continue
+        objpoints.append(board.object_points(ids))
+        imgpoints.append(corners)
         good_images.append(fname)
-    cv2.destroyAllWindows()
+    if debug:
+        cv2.destroyAllWindows()
 
     num_images = len(good_images)
 
@@ -197,21 +670,39 @@ def main():
         print("Not enough good images were found, we need at least 3")
         sys.exit()
 
-    avg_reprojection_error, mtx, distortion, rvecs, tvecs = cv2.calibrateCamera(
-        objpoints, imgpoints, gray.shape[::-1], None, None
+    if args.max_views > 0:
+        selected = select_views(objpoints, imgpoints, size, args.max_views)
+        print("Selected {} of the {} views".format(len(selected), num_images))
+        objpoints = [objpoints[i] for i in selected]
+        imgpoints = [imgpoints[i] for i in selected]
+        good_images = [good_images[i] for i in selected]
+
+    (
+        avg_reprojection_error,
+        mtx,
+        distortion,
+        kept,
+        errors,
+    ) = calibrate_rejecting_outliers(
+        objpoints, imgpoints, size, args.outlier_ratio, model=args.model
+    )
+    good_images = [good_images[i] for i in kept]
+    num_images = len(good_images)
+    print(
+        "Calibrated with {} views, reprojection error {:.3f} px, worst view"
+        " {:.3f} px".format(num_images, avg_reprojection_error, errors.max())
     )
-    
+
     # Displaying required output
     print(" Camera matrix:")
     print(mtx)
-      
+
     print("\n Distortion coefficient:")
     print(distortion)
 
     # Undistort an image
     img = cv2.imread(str(good_images[0]))
-    h, w = img.shape[:2]
-    print(h, w)
+    w, h = size
     newcameramtx, roi = cv2.getOptimalNewCameraMatrix(
         mtx, distortion, (w, h), 1, (w, h)
     )
@@ -224,8 +715,6 @@ def main():
     output_file = str(output_directory / "calib_result_raw.png")
     cv2.imwrite(output_file, dst)
 
-    size = (w, h)
-
     # crop the image
     x, y, w, h = roi
     dst = dst[y : y + h, x : x + w]
@@ -236,10 +725,15 @@ def main():
     print("Calibration Matrix: \n", mtx)
     print("Disortion: \n", distortion)
 
+    calibration = new_calibration(
+        mtx, distortion, size, avg_reprojection_error, num_images
+    )
     output_file = output_directory / "camera_calibration.yaml"
-    with output_file.open("w") as f:
-        f.write(yaml(size, mtx, distortion, num_images, avg_reprojection_error))
+    calibration.save(output_file)
     print("Calibration data saved as", output_file)
+    if args.update_config:
+        saved = write_camera_calibration(args.config, calibration)
+        print("Calibration saved in the camera section of", saved)
 
 
 if __name__ == "__main__":
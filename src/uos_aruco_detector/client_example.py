@@ -1,14 +1,22 @@
+import argparse
 import json
+import os
 import socket
+import struct
 import time
 
+from .protocol import decode_message, is_binary_message
 
-def main():
-    # Parameters
-    params = {
-        "port": 50000,
-        "timeout": 0.5,
-    }
+
+def create_client(port, multicast="", unix=""):
+    """Open a socket receiving the messages of one of the publisher targets."""
+    if unix:
+        # -- Local Unix datagram socket, replacing a stale one
+        if os.path.exists(unix):
+            os.remove(unix)
+        client = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        client.bind(unix)
+        return client
 
     # -- UDP
     client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
@@ -18,16 +26,53 @@ def main():
 
     # -- Enable broadcasting mode
     client.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
-    client.settimeout(params["timeout"])
-    client.bind(("", params["port"]))
-
-    while True:
-        try:
-            broadcast_data, _ = client.recvfrom(4096)
-            result = json.loads(broadcast_data)
-            print("Received: %s" % result)
-        except TimeoutError as e:
-            print("Waiting for broadcast...")
+    client.bind(("", port))
+
+    if multicast:
+        # -- Join the multicast group on the default interface
+        membership = struct.pack("4sl", socket.inet_aton(multicast), socket.INADDR_ANY)
+        client.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, membership)
+    return client
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print the tag poses published by uos_aruco_detector"
+    )
+    parser.add_argument("--port", type=int, default=50000, help="UDP port")
+    parser.add_argument(
+        "--multicast", type=str, default="", help="Multicast group to join"
+    )
+    parser.add_argument(
+        "--unix",
+        type=str,
+        default="",
+        help="Path of a Unix datagram socket to receive on instead of UDP",
+    )
+    parser.add_argument(
+        "--timeout", type=float, default=0.5, help="Receive timeout in seconds"
+    )
+    args = parser.parse_args()
+
+    client = create_client(args.port, args.multicast, args.unix)
+    client.settimeout(args.timeout)
+
+    try:
+        while True:
+            try:
+                broadcast_data, _ = client.recvfrom(65535)
+                if is_binary_message(broadcast_data):
+                    header, result = decode_message(broadcast_data)
+                else:
+                    message = json.loads(broadcast_data)
+                    header, result = message["header"], message["tags"]
+                print("Received frame %d: %s" % (header["frame_id"], result))
+            except TimeoutError as e:
+                print("Waiting for broadcast...")
+    finally:
+        client.close()
+        if args.unix:
+            os.remove(args.unix)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,88 @@
+import signal
+import threading
+import time
+from pathlib import Path
+
+import yaml
+
+from .configuration import Configuration
+
+
+class ConfigurationWatcher:
+    def __init__(self, filename, interval=1.0):
+        """Notice the changes of a configuration file.
+
+        The modification time and size of the file are checked every interval
+        seconds, from the loop calling changed(), so no thread is needed and
+        the changes are applied between two frames. A SIGHUP also requests a
+        reload, e.g. with kill -HUP or systemctl reload.
+
+        Parameters
+        ----------
+        filename : Path
+            Configuration file
+        interval : float
+            Time in seconds between two checks of the file. 0 only reloads
+            on SIGHUP
+        """
+        self.filename = Path(filename)
+        self.interval = interval
+        self.signature = self.stat()
+        self.last_check = time.monotonic()
+        self.requested = False
+        self.previous_handler = None
+        # -- Signal handlers can only be set from the main thread
+        if (
+            hasattr(signal, "SIGHUP")
+            and threading.current_thread() is threading.main_thread()
+        ):
+            self.previous_handler = signal.signal(signal.SIGHUP, self.request)
+
+    def request(self, signum=None, frame=None):
+        """Reload the configuration at the next call of changed()."""
+        self.requested = True
+
+    def stat(self):
+        try:
+            stat = self.filename.stat()
+        except OSError:
+            return None
+        return stat.st_mtime_ns, stat.st_size
+
+    def changed(self):
+        """True if the file changed, or a reload was requested, since the last call."""
+        if not self.requested:
+            now = time.monotonic()
+            if self.interval <= 0 or now - self.last_check < self.interval:
+                return False
+            self.last_check = now
+            signature = self.stat()
+            # -- A missing file is being replaced, wait for the new one
+            if signature is None or signature == self.signature:
+                return False
+        self.requested = False
+        self.signature = self.stat()
+        return True
+
+    def load(self):
+        """Load and validate the configuration file.
+
+        Returns
+        -------
+        Configuration
+            The new configuration, or None if it is not valid
+        str
+            Why the configuration is not valid, or None
+        """
+        try:
+            return Configuration(self.filename), None
+        except (OSError, KeyError, TypeError, ValueError, yaml.YAMLError) as e:
+            if isinstance(e, KeyError):
+                return None, "missing setting {}".format(e)
+            return None, str(e)
+
+    def close(self):
+        """Restore the SIGHUP handler replaced by the watcher."""
+        if self.previous_handler is not None:
+            signal.signal(signal.SIGHUP, self.previous_handler)
+            self.previous_handler = None
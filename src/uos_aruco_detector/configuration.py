@@ -3,6 +3,10 @@ from pathlib import Path
 
 import yaml
 
+from .calibration_store import CameraCalibration
+from .publisher import TARGET_KEYS, TARGET_TYPES
+from .undistort import UNDISTORT_MODES
+
 
 @dataclass
 class Marker:
@@ -33,11 +37,23 @@ class Configuration:
         self.load()
 
     def load(self):
-        f = self.filename.open("r")
-        config = yaml.safe_load(f)
+        with self.filename.open("r") as f:
+            config = yaml.safe_load(f)
         # -- Define path where all code is stored
         self.logging_folder = config["logging_folder"]
         self.usb_storage_path = config["usb_storage_path"]
+        logging = config.get("logging", {})
+        self.log_buffer_size = int(logging.get("buffer_size", 65536))  # [bytes]
+        self.log_flush_interval = float(logging.get("flush_interval", 1.0))  # [s]
+        self.log_flush_rows = int(logging.get("flush_rows", 100))
+        if self.log_flush_rows < 0:
+            raise ValueError("The logging flush_rows must be at least 0")
+        self.log_in_background = bool(logging.get("background", False))
+        self.log_queue_size = int(logging.get("queue_size", 10000))  # [rows]
+        self.log_session_file = bool(logging.get("session_file", False))
+        self.log_format = logging.get("format", "csv")  # csv or binary
+        if self.log_format not in ["csv", "binary"]:
+            raise ValueError(f"Unknown log format {self.log_format}")
         # --- Define Tags
         self.marker_size = float(config["defaults"]["marker_size"])  # [m]
         self.marker.OK = int(config["markers"]["OK"])
@@ -56,17 +72,185 @@ class Configuration:
         self.marker.FRAME_ENU = int(config["markers"]["FRAME_ENU"])
         self.marker.SHUTDOWN = int(config["markers"]["SHUTDOWN"])
 
+        capture = config.get("capture", {})
+        self.capture_source = capture.get("source", "camera")
+        self.capture_device = capture.get("device", 0)
+        self.capture_path = capture.get("path", "")
+        self.capture_width = int(capture.get("width", 0))  # [px]
+        self.capture_height = int(capture.get("height", 0))  # [px]
+        self.capture_fps = float(capture.get("fps", 0))  # [Hz]
+        self.capture_fourcc = capture.get("fourcc", "")
+        self.capture_buffer_size = int(capture.get("buffer_size", 0))  # [frames]
+        self.capture_loop = bool(capture.get("loop", False))
+        self.capture_realtime = bool(capture.get("realtime", False))
+        # -- Shared memory name of the frame ring of the pipelines, so that
+        # -- other processes can attach to it. Empty for a private name
+        self.capture_ring_name = capture.get("ring_name", "")
+
+        detector = config.get("detector", {})
+        self.detector_tracking = bool(detector.get("tracking", False))
+        self.detector_full_search_interval = int(
+            detector.get("full_search_interval", 10)  # [frames]
+        )
+        if self.detector_full_search_interval < 1:
+            raise ValueError("The detector full_search_interval must be at least 1")
+        self.detector_roi_padding = float(detector.get("roi_padding", 0.5))
+        self.detector_scale = float(detector.get("scale", 1.0))
+        if not 0.0 < self.detector_scale <= 1.0:
+            raise ValueError("The detector scale must be in (0, 1]")
+        self.detector_refine_window = int(detector.get("refine_window", 5))  # [px]
+        self.detector_refine_iterations = int(detector.get("refine_iterations", 30))
+        self.detector_refine_epsilon = float(
+            detector.get("refine_epsilon", 0.01)  # [px]
+        )
+        self.detector_undistort = detector.get("undistort", "none")
+        if self.detector_undistort not in UNDISTORT_MODES:
+            raise ValueError(f"Unknown undistort mode {self.detector_undistort}")
+        self.detector_undistort_cache = bool(detector.get("undistort_cache", True))
+
         self.udp_server_port = int(config["udp_server"]["port"])
         self.udp_server_ip = config["udp_server"]["ip"]
+        self.udp_server_format = config["udp_server"].get("format", "json")
+        if self.udp_server_format not in ["json", "binary"]:
+            raise ValueError(f"Unknown UDP message format {self.udp_server_format}")
+        # -- The ip and port target first, unless the ip is empty
+        self.udp_server_targets = []
+        if self.udp_server_ip:
+            self.udp_server_targets.append(
+                {"type": "udp", "ip": self.udp_server_ip, "port": self.udp_server_port}
+            )
+        self.udp_server_targets += publisher_targets(
+            config["udp_server"].get("targets", None)
+        )
+        # -- The status messages have their own destinations, none by default
+        self.udp_server_status_targets = publisher_targets(
+            config["udp_server"].get("status_targets", None)
+        )
+
+        pose_filter = config.get("filter", {})
+        self.filter_enabled = bool(pose_filter.get("enabled", False))
+        self.filter_predict = bool(pose_filter.get("predict", True))
+        self.filter_velocity = bool(pose_filter.get("velocity", True))
+        self.filter_position_noise = float(
+            pose_filter.get("position_noise", 0.005)  # [m]
+        )
+        self.filter_angle_noise = float(pose_filter.get("angle_noise", 1.0))  # [deg]
+        self.filter_acceleration_noise = float(
+            pose_filter.get("acceleration_noise", 2.0)  # [m/s^2]
+        )
+        self.filter_angular_acceleration_noise = float(
+            pose_filter.get("angular_acceleration_noise", 90.0)  # [deg/s^2]
+        )
+        self.filter_gate = float(pose_filter.get("gate", 16.0))
+        self.filter_max_rejections = int(pose_filter.get("max_rejections", 5))
+        self.filter_timeout = float(pose_filter.get("timeout", 1.0))  # [s]
 
-        self.camera_matrix = config["camera"]["matrix"]
-        self.camera_distortion = config["camera"]["distortion"]
+        stream_server = config.get("stream_server", {})
+        self.stream_server_enabled = bool(stream_server.get("enabled", False))
+        self.stream_server_host = stream_server.get("host", "0.0.0.0")
+        self.stream_server_port = int(stream_server.get("port", 50002))
+        self.stream_server_max_clients = int(stream_server.get("max_clients", 16))
+
+        # -- The intrinsics are rescaled by the detector when the frames differ
+        # -- from the calibrated image_size
+        self.camera_calibration = CameraCalibration.from_section(
+            config["camera"], self.filename.parent
+        )
+        self.camera_matrix = self.camera_calibration.camera_matrix.tolist()
+        self.camera_distortion = self.camera_calibration.distortion.tolist()
+        self.camera_image_size = self.camera_calibration.image_size
+        # -- Fail now rather than in the detector when the first frame arrives
+        self.camera_calibration.check_size((self.capture_width, self.capture_height))
+
+        # -- Cameras fused together, missing settings default to the capture
+        # -- and camera sections
+        multi_camera = config.get("multi_camera", {})
+        self.cameras = []
+        for camera in multi_camera.get("cameras", None) or []:
+            calibration = self.camera_calibration
+            if "matrix" in camera or "file" in camera:
+                calibration = CameraCalibration.from_section(
+                    camera, self.filename.parent
+                )
+            calibration.check_size(
+                (
+                    int(camera.get("width", self.capture_width)),
+                    int(camera.get("height", self.capture_height)),
+                )
+            )
+            self.cameras.append(
+                {
+                    "source": camera.get("source", self.capture_source),
+                    "device": camera.get("device", self.capture_device),
+                    "path": camera.get("path", self.capture_path),
+                    "width": int(camera.get("width", self.capture_width)),
+                    "height": int(camera.get("height", self.capture_height)),
+                    "fps": float(camera.get("fps", self.capture_fps)),
+                    "fourcc": camera.get("fourcc", self.capture_fourcc),
+                    "buffer_size": int(
+                        camera.get("buffer_size", self.capture_buffer_size)
+                    ),
+                    "loop": bool(camera.get("loop", self.capture_loop)),
+                    "realtime": bool(camera.get("realtime", self.capture_realtime)),
+                    "matrix": calibration.camera_matrix.tolist(),
+                    "distortion": calibration.distortion.tolist(),
+                    "image_size": calibration.image_size,
+                }
+            )
+        self.fusion_window = float(multi_camera.get("fusion_window", 0.02))  # [s]
+        self.multi_camera_queue_size = int(multi_camera.get("queue_size", 4))
 
         self.screen_width = config["defaults"].get("screen_width", 1920)
         self.screen_height = config["defaults"].get("screen_height", 1920)
+        self.display_frequency = float(
+            config["defaults"].get("display_frequency", 0.0)  # [Hz]
+        )
 
         self.broadcast_frequency = float(
             config["defaults"]["broadcast_frequency"]  # [Hz]
         )
         self.frame = config["defaults"]["frame"]
         self.tags_to_log = config["defaults"]["tags_to_log"]
+        self.reload_interval = float(
+            config["defaults"].get("reload_interval", 1.0)  # [s]
+        )
+
+
+def publisher_targets(targets):
+    """Validate a list of publisher target configurations.
+
+    Parameters
+    ----------
+    targets : list
+        Target configurations, see publisher.create_target. None is empty
+
+    Returns
+    -------
+    list
+        The target configurations
+    """
+    for target in targets or []:
+        if not isinstance(target, dict):
+            raise ValueError(f"Publisher target {target} must be a mapping")
+        kind = target.get("type", "udp")
+        if kind not in TARGET_TYPES:
+            raise ValueError(f"Unknown publisher target type {kind}")
+        for key in TARGET_KEYS[kind]:
+            if key not in target:
+                raise ValueError(f"Publisher target {target} has no {key}")
+        if "port" in target:
+            try:
+                int(target["port"])
+            except (TypeError, ValueError):
+                raise ValueError(f"Invalid port in publisher target {target}")
+    return list(targets or [])
+
+
+def changed_settings(old, new):
+    """Names of the settings that differ between two configurations."""
+    return [
+        name
+        for name, value in vars(new).items()
+        # -- The calibration is compared through camera_matrix and the like
+        if name != "camera_calibration" and getattr(old, name, None) != value
+    ]
@@ -1,4 +1,8 @@
+import time
+
 import cv2
+import numpy as np
+
 from .version import __version__
 
 
@@ -25,10 +29,29 @@ def justify(text, frame, font, scale, thickness):
 
 
 class FrameDecorator:
-    def __init__(self, screen_width, screen_height):
+    def __init__(self, screen_width, screen_height, refresh_rate=0.0):
+        """Draw information on the frames and show them on the screen.
+
+        Parameters
+        ----------
+        screen_width : int
+            Width of the displayed image in pixels
+        screen_height : int
+            Height of the displayed image in pixels
+        refresh_rate : float
+            Maximum rate at which frames are drawn and shown, in Hz. 0 shows
+            every frame
+        """
         # -- Font for the text in the image
         self.screen_width = screen_width
         self.screen_height = screen_height
+        self.refresh_period = 1.0 / refresh_rate if refresh_rate > 0 else 0.0
+        self.last_render_time = 0.0
+        # -- Pre-rendered overlays, their masks and their blended edges, by frame
+        # -- shape, colour and texts
+        self.overlays = {}
+        # -- Frame resized to the screen, reused for every frame shown
+        self.resized = None
         cv2.namedWindow("Frame", cv2.WINDOW_FREERATIO)
         cv2.setWindowProperty("Frame", cv2.WND_PROP_FULLSCREEN, cv2.WINDOW_FULLSCREEN)
 
@@ -90,6 +113,76 @@ class FrameDecorator:
         )
         return frame
 
+    def draw_overlay(self, frame, color, texts=()):
+        """Draw the border and the given texts over the frame.
+
+        The overlay is rendered once for each frame shape, colour and texts.
+        Its opaque pixels are then copied over the frames through a
+        precomputed mask, and only its anti-aliased edges are blended.
+
+        Parameters
+        ----------
+        frame : np.ndarray
+            Frame to draw on
+        color : tuple
+            Colour of the border
+        texts : tuple
+            (message, colour, coordinates) of each text. The text is centred
+            if the coordinates are None
+
+        Returns
+        -------
+        np.ndarray
+            The frame with the overlay
+        """
+        key = (frame.shape, color, texts)
+        if key not in self.overlays:
+            self.overlays[key] = self.render_overlay(frame.shape, color, texts)
+        overlay, mask, rows, cols, edge_colors, edge_transmission = self.overlays[key]
+        cv2.copyTo(overlay, mask, frame)
+        if rows.size > 0:
+            blended = edge_colors + edge_transmission * frame[rows, cols]
+            frame[rows, cols] = blended + 0.5
+        return frame
+
+    def render_overlay(self, shape, color, texts):
+        # -- Draw on a black and a white background. A pixel drawn with an
+        # -- opacity alpha is alpha * colour on black and alpha * colour +
+        # -- (1 - alpha) * 255 on white, so the difference of the two gives
+        # -- the part of the frame that shows through each pixel
+        layers = []
+        for background in [0, 255]:
+            layer = np.full(shape, background, dtype=np.uint8)
+            self.draw_border(layer, color)
+            for msg, text_color, coord in texts:
+                self.draw_text(layer, msg, text_color, coord)
+            layers.append(layer)
+        transmission = (layers[1].astype(np.float32) - layers[0]) / 255.0
+        if transmission.ndim == 2:
+            transmission = transmission[:, :, None]
+        mask = np.all(transmission == 0.0, axis=2).astype(np.uint8)
+        # -- The anti-aliased edges, partly covered, are blended with the frame
+        rows, cols = np.nonzero(
+            np.any((transmission > 0.0) & (transmission < 1.0), axis=2)
+        )
+        edge_colors = layers[0][rows, cols].astype(np.float32)
+        edge_transmission = transmission[rows, cols].reshape(edge_colors.shape)
+        return layers[0], mask, rows, cols, edge_colors, edge_transmission
+
+    def should_render(self):
+        """Check if the current frame has to be drawn and shown.
+
+        Returns
+        -------
+        bool
+            True if the refresh period has elapsed since the last shown frame
+        """
+        now = time.monotonic()
+        if now - self.last_render_time < self.refresh_period:
+            return False
+        self.last_render_time = now
+        return True
+
     def stop(self):
         cv2.destroyAllWindows()
 
@@ -106,10 +199,37 @@ class FrameDecorator:
         bool
             True if the user requested to stop the program, False otherwise.
         """
-        frame_resized = cv2.resize(frame, (self.screen_width, self.screen_height))
-        cv2.imshow("Frame", frame_resized)
+        if frame.shape[1] != self.screen_width or frame.shape[0] != self.screen_height:
+            # -- Resized into the image of the previous frame
+            self.resized = cv2.resize(
+                frame, (self.screen_width, self.screen_height), dst=self.resized
+            )
+            frame = self.resized
+        cv2.imshow("Frame", frame)
         key = cv2.waitKey(1) & 0xFF
         if key == ord("q"):
             return True
         else:
             return False
+
+
+class NullFrameDecorator:
+    """Frame decorator for headless operation, nothing is drawn nor shown."""
+
+    def draw_text(self, frame, msg, color, coord=None, **kwargs):
+        return frame
+
+    def draw_border(self, frame, color, thickness=20):
+        return frame
+
+    def draw_overlay(self, frame, color, texts=()):
+        return frame
+
+    def should_render(self):
+        return False
+
+    def stop(self):
+        pass
+
+    def show(self, frame):
+        return False
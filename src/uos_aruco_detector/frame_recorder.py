@@ -0,0 +1,119 @@
+import argparse
+import time
+
+import cv2
+
+from .frame_ring import SharedFrameRing
+
+
+def record(ring, path, reader=1, fps=30.0, fourcc="mp4v", duration=None):
+    """Write the frames of a SharedFrameRing to a video file.
+
+    Each frame is held while it is encoded, straight from the shared memory,
+    so it is never copied and the writer of the ring cannot reuse its slot in
+    the meantime. Frames written to the ring while the previous one is
+    encoded are skipped.
+
+    Parameters
+    ----------
+    ring : SharedFrameRing
+        Ring the frames are read from
+    path : str
+        Path of the video file
+    reader : int
+        Reader id used to hold the slots. It must not be used by another
+        reader of the ring, and 0 is used by the pipelines
+    fps : float
+        Frame rate of the video file
+    fourcc : str
+        Four character code of the video codec
+    duration : float
+        Time in seconds after which the recording stops, None to record until
+        interrupted
+
+    Returns
+    -------
+    int
+        Number of frames written
+    int
+        Number of frames skipped
+    """
+    height, width, channels = ring.shape
+    writer = cv2.VideoWriter(
+        str(path),
+        cv2.VideoWriter_fourcc(*fourcc),
+        fps,
+        (width, height),
+        channels == 3,
+    )
+    if not writer.isOpened():
+        raise IOError("Could not open video {} for writing".format(path))
+    written = 0
+    skipped = 0
+    last_sequence = -1
+    start = time.monotonic()
+    try:
+        while duration is None or time.monotonic() - start < duration:
+            sequence, slot = ring.hold_latest(last_sequence, reader)
+            if slot is None:
+                time.sleep(0.001)
+                continue
+            try:
+                writer.write(ring.frame(slot))
+            finally:
+                ring.release(slot, reader)
+            if last_sequence >= 0:
+                skipped += sequence - last_sequence - 1
+            last_sequence = sequence
+            written += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        writer.release()
+    return written, skipped
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Record the frames shared in memory by uos_aruco_detector to a"
+        + " video file. Set ring_name in the capture section of the configuration"
+        + " and run the detector with --pipeline or --workers."
+    )
+    parser.add_argument("ring", type=str, help="Shared memory name of the frame ring")
+    parser.add_argument("output", type=str, help="Video file to write")
+    parser.add_argument(
+        "--reader",
+        type=int,
+        default=1,
+        help="Reader id holding the frames, unique among the readers of the ring",
+    )
+    parser.add_argument(
+        "--fps", type=float, default=30.0, help="Frame rate of the video file"
+    )
+    parser.add_argument(
+        "--fourcc", type=str, default="mp4v", help="Four character code of the codec"
+    )
+    parser.add_argument(
+        "--duration",
+        type=float,
+        default=None,
+        help="Recording time in seconds. Defaults to recording until Ctrl+C",
+    )
+    args = parser.parse_args()
+
+    ring = SharedFrameRing(args.ring, track=False)
+    if not 0 < args.reader < ring.readers:
+        ring.close()
+        parser.error("The reader id must be between 1 and {}".format(ring.readers - 1))
+    print("Recording {} to {}, press Ctrl+C to stop".format(args.ring, args.output))
+    try:
+        written, skipped = record(
+            ring, args.output, args.reader, args.fps, args.fourcc, args.duration
+        )
+    finally:
+        ring.close()
+    print("Wrote {} frames, skipped {}".format(written, skipped))
+
+
+if __name__ == "__main__":
+    main()
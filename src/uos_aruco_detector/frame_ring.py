@@ -0,0 +1,317 @@
+import os
+from contextlib import contextmanager
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+try:
+    import fcntl
+except ImportError:
+    # -- Windows, where the writer and the holders are not locked
+    fcntl = None
+
+MAGIC = 0x41525543  # "ARUC"
+
+# -- Indices of the int64 header fields
+HEADER_MAGIC = 0
+HEADER_SLOTS = 1
+HEADER_HEIGHT = 2
+HEADER_WIDTH = 3
+HEADER_CHANNELS = 4
+HEADER_WRITE_COUNT = 5
+HEADER_READERS = 6
+HEADER_GRAY = 7
+HEADER_SIZE = 8
+
+# -- Frames and gray images start on cache line boundaries
+ALIGNMENT = 64
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+class SharedFrameRing:
+    def __init__(
+        self,
+        name,
+        shape=None,
+        slots=4,
+        create=False,
+        gray=False,
+        readers=8,
+        track=True,
+    ):
+        """Ring of frames in shared memory, written by one process.
+
+        The memory holds a small header, the sequence number of the frame in
+        each slot, the references held on each slot, the frames and
+        optionally a gray version of each frame. Stages work directly on the
+        slots, e.g. cap.read(image=ring.frame(slot)) or
+        cv2.cvtColor(..., dst=ring.gray(slot)), so frames are never allocated
+        nor copied between the stages, even in other processes.
+
+        Readers hold the slots they use with hold() and release(). The writer
+        never reuses a held slot. Each reader has its own reference counter
+        per slot, only written by that reader. The writer reserving a slot
+        and hold_latest() choosing one are serialised by a lock on the shared
+        memory, see locked(). Readers that do not hold slots can still copy
+        frames with read_latest(), which detects frames overwritten while
+        copied.
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory block
+        shape : tuple
+            Shape of the frames (height, width, channels). Only needed when
+            creating the ring
+        slots : int
+            Number of frames in the ring. Only needed when creating the ring
+        create : bool
+            Create the shared memory block instead of attaching to it
+        gray : bool
+            Add a gray image to each slot. Only needed when creating the ring
+        readers : int
+            Number of reader ids that can hold slots. Only needed when
+            creating the ring
+        track : bool
+            Let the resource tracker of this process remove the memory when
+            the process exits. Only processes spawned by the creator of the
+            ring, which share its tracker, should track a ring they attach to
+        """
+        if create:
+            if len(shape) == 2:
+                shape = (shape[0], shape[1], 1)
+            frames_offset = align((HEADER_SIZE + slots + slots * readers) * 8)
+            frame_size = int(np.prod(shape))
+            size = frames_offset + slots * frame_size
+            if gray:
+                size = align(size) + slots * shape[0] * shape[1]
+            self.memory = shared_memory.SharedMemory(name, create=True, size=size)
+            header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.memory.buf)
+            header[:] = 0
+            header[HEADER_MAGIC] = MAGIC
+            header[HEADER_SLOTS] = slots
+            header[HEADER_HEIGHT : HEADER_CHANNELS + 1] = shape
+            header[HEADER_READERS] = readers
+            header[HEADER_GRAY] = int(gray)
+        else:
+            self.memory = shared_memory.SharedMemory(name)
+            if not track and os.name == "posix":
+                # -- Attaching registered the memory with the tracker, which
+                # -- would remove it under the feet of its creator
+                resource_tracker.unregister(self.memory._name, "shared_memory")
+            header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.memory.buf)
+            if header[HEADER_MAGIC] != MAGIC:
+                self.memory.close()
+                raise ValueError(f"Shared memory {name} is not a frame ring")
+        self.name = self.memory.name
+        self.created = create
+        self.header = header
+        self.slots = int(header[HEADER_SLOTS])
+        self.readers = int(header[HEADER_READERS])
+        self.shape = tuple(int(x) for x in header[HEADER_HEIGHT : HEADER_CHANNELS + 1])
+        self.sequences = np.ndarray(
+            (self.slots,),
+            dtype=np.int64,
+            buffer=self.memory.buf,
+            offset=HEADER_SIZE * 8,
+        )
+        self.references = np.ndarray(
+            (self.slots, self.readers),
+            dtype=np.int64,
+            buffer=self.memory.buf,
+            offset=(HEADER_SIZE + self.slots) * 8,
+        )
+        frames_offset = align((HEADER_SIZE + self.slots * (1 + self.readers)) * 8)
+        self.frames = np.ndarray(
+            (self.slots,) + self.shape,
+            dtype=np.uint8,
+            buffer=self.memory.buf,
+            offset=frames_offset,
+        )
+        self.grays = None
+        if header[HEADER_GRAY]:
+            self.grays = np.ndarray(
+                (self.slots,) + self.shape[:2],
+                dtype=np.uint8,
+                buffer=self.memory.buf,
+                offset=align(frames_offset + self.frames.nbytes),
+            )
+        if create:
+            self.sequences[:] = -1
+            self.references[:] = 0
+
+    @property
+    def write_count(self):
+        """Number of frames written to the ring so far."""
+        return int(self.header[HEADER_WRITE_COUNT])
+
+    def frame(self, slot):
+        """View of the frame of a slot, (height, width) for gray frames."""
+        if self.shape[2] == 1:
+            return self.frames[slot, :, :, 0]
+        return self.frames[slot]
+
+    def gray(self, slot):
+        """View of the gray image of a slot, or None if the ring has none."""
+        if self.grays is None:
+            return None
+        return self.grays[slot]
+
+    @contextmanager
+    def locked(self):
+        """Exclude the writer and the holders of the other processes.
+
+        The writer marks a slot busy, then checks that no reader holds it,
+        while a holder references a slot, then checks that it is not busy.
+        Without a memory fence both can miss the store of the other, so both
+        are done under a record lock of the shared memory file, whose system
+        calls also order the memory accesses. The threads of a process are
+        already ordered by the GIL, and do not exclude each other.
+        """
+        fd = getattr(self.memory, "_fd", -1)
+        if fcntl is None or fd < 0:
+            yield
+            return
+        fcntl.lockf(fd, fcntl.LOCK_EX, 1)
+        try:
+            yield
+        finally:
+            fcntl.lockf(fd, fcntl.LOCK_UN, 1)
+
+    def acquire_write(self):
+        """Reserve the oldest slot that no reader holds, for the writer.
+
+        Returns
+        -------
+        int
+            The slot, or None if all the slots are held
+        """
+        start = self.write_count
+        with self.locked():
+            for i in range(self.slots):
+                slot = (start + i) % self.slots
+                if not self.references[slot].any():
+                    # -- Hide the frame from hold_latest() and read_latest()
+                    self.sequences[slot] = -1
+                    return slot
+        return None
+
+    def commit(self, slot):
+        """Publish the frame written to a reserved slot.
+
+        Returns
+        -------
+        int
+            Sequence number of the frame
+        """
+        sequence = self.write_count
+        self.sequences[slot] = sequence
+        self.header[HEADER_WRITE_COUNT] = sequence + 1
+        return sequence
+
+    def write(self, frame, gray=None):
+        """Copy a frame into the next free slot.
+
+        Returns
+        -------
+        int
+            Sequence number of the frame, or None if all the slots are held
+        int
+            The slot, or None
+        """
+        slot = self.acquire_write()
+        if slot is None:
+            return None, None
+        self.frames[slot] = frame.reshape(self.shape)
+        if gray is not None and self.grays is not None:
+            self.grays[slot] = gray
+        return self.commit(slot), slot
+
+    def hold(self, slot, reader=0):
+        """Prevent the writer from reusing a slot until it is released."""
+        self.references[slot, reader] += 1
+
+    def release(self, slot, reader=0):
+        self.references[slot, reader] -= 1
+
+    def latest(self):
+        """Sequence number and slot of the newest frame, or (-1, None)."""
+        slot = int(np.argmax(self.sequences))
+        sequence = int(self.sequences[slot])
+        if sequence < 0:
+            return -1, None
+        return sequence, slot
+
+    def hold_latest(self, last_sequence=-1, reader=0):
+        """Hold the newest frame if it is newer than last_sequence.
+
+        The frame can be used in place with frame(slot) and gray(slot) until
+        release(slot, reader) is called.
+
+        Returns
+        -------
+        int
+            Sequence number of the frame, or None if there is no new frame
+        int
+            The held slot, or None if there is no new frame
+        """
+        # -- The writer cannot reserve the slot between choosing and holding it
+        with self.locked():
+            sequence, slot = self.latest()
+            if slot is None or sequence <= last_sequence:
+                return None, None
+            self.hold(slot, reader)
+        return sequence, slot
+
+    def read_latest(self, last_sequence=-1, out=None):
+        """Copy the newest frame if it is newer than last_sequence.
+
+        Parameters
+        ----------
+        last_sequence : int
+            Sequence number of the last frame read
+        out : np.ndarray
+            Preallocated array receiving the frame, instead of a new one
+
+        Returns
+        -------
+        int
+            Sequence number of the frame, or None if there is no new frame
+        np.ndarray
+            Copy of the frame, or None if there is no new frame
+        """
+        while True:
+            sequence, slot = self.latest()
+            if slot is None or sequence <= last_sequence:
+                return None, None
+            frame = self.frame(slot)
+            if out is None:
+                out = frame.copy()
+            else:
+                np.copyto(out, frame)
+            # -- Retry if the writer overwrote the slot while it was copied
+            if self.sequences[slot] == sequence:
+                return sequence, out
+
+    def close(self):
+        """Detach from the shared memory, removing it if created here."""
+        # -- Views must be released before the memory can be closed
+        self.header = None
+        self.sequences = None
+        self.references = None
+        self.frames = None
+        self.grays = None
+        try:
+            self.memory.close()
+        except BufferError:
+            # -- Views of the frames are still in use, the memory is unmapped
+            # -- when they are released
+            pass
+        if self.created:
+            try:
+                self.memory.unlink()
+            except FileNotFoundError:
+                pass
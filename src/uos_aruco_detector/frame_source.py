@@ -0,0 +1,264 @@
+import sys
+import time
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+from .frame_ring import SharedFrameRing
+
+IMAGE_EXTENSIONS = [".png", ".jpg", ".jpeg", ".bmp", ".tif", ".tiff"]
+
+
+def copy_into(frame, image):
+    """Copy a frame into a preallocated image of the same shape, if given."""
+    if frame is None or image is None or image.shape != frame.shape:
+        return frame
+    np.copyto(image, frame)
+    return image
+
+
+class FrameSource:
+    """Source of frames with the read() interface of cv2.VideoCapture."""
+
+    # -- Set once the source has no more frames, e.g. at the end of a video
+    finished = False
+
+    def read(self, image=None):
+        """Read the next frame.
+
+        Parameters
+        ----------
+        image : np.ndarray
+            Preallocated frame to read into, as the image argument of
+            cv2.VideoCapture.read(). A new frame is returned if it is None or
+            its shape does not match
+
+        Returns
+        -------
+        bool
+            True if a frame was read
+        np.ndarray
+            BGR frame, or None if no frame was read
+        """
+        raise NotImplementedError
+
+    def release(self):
+        pass
+
+
+class CameraSource(FrameSource):
+    def __init__(self, device=0, width=0, height=0, fps=0, fourcc="", buffer_size=0):
+        """Camera opened with explicit capture properties.
+
+        Parameters
+        ----------
+        device : int or str
+            Camera index or device path, e.g. /dev/video0
+        width : int
+            Capture width in pixels, 0 keeps the camera default
+        height : int
+            Capture height in pixels, 0 keeps the camera default
+        fps : float
+            Capture frame rate, 0 keeps the camera default
+        fourcc : str
+            Pixel format, e.g. MJPG. Empty keeps the camera default
+        buffer_size : int
+            Number of frames buffered by the driver, 0 keeps the default. A
+            buffer of 1 frame gives the lowest latency
+        """
+        if isinstance(device, str) and device.isdigit():
+            device = int(device)
+        backend = cv2.CAP_V4L2 if sys.platform.startswith("linux") else cv2.CAP_ANY
+        self.cap = cv2.VideoCapture(device, backend)
+        if not self.cap.isOpened():
+            raise IOError(f"Could not open camera {device}")
+        # -- The pixel format has to be set before the resolution
+        if fourcc:
+            self.cap.set(cv2.CAP_PROP_FOURCC, cv2.VideoWriter_fourcc(*fourcc))
+        if width > 0:
+            self.cap.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+        if height > 0:
+            self.cap.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        if fps > 0:
+            self.cap.set(cv2.CAP_PROP_FPS, fps)
+        if buffer_size > 0:
+            self.cap.set(cv2.CAP_PROP_BUFFERSIZE, buffer_size)
+        print(
+            "Camera {} capturing {}x{} at {} fps".format(
+                device,
+                int(self.cap.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                int(self.cap.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                self.cap.get(cv2.CAP_PROP_FPS),
+            )
+        )
+
+    def read(self, image=None):
+        return self.cap.read(image)
+
+    def release(self):
+        self.cap.release()
+
+
+class VideoFileSource(FrameSource):
+    def __init__(self, path, loop=False, realtime=False):
+        """Frames of a video file.
+
+        Parameters
+        ----------
+        path : str
+            Path of the video file
+        loop : bool
+            Start again from the beginning at the end of the video
+        realtime : bool
+            Deliver the frames at the frame rate of the video instead of as
+            fast as they can be decoded
+        """
+        self.path = str(path)
+        self.loop = loop
+        self.realtime = realtime
+        self.cap = cv2.VideoCapture(self.path)
+        if not self.cap.isOpened():
+            raise IOError(f"Could not open video {self.path}")
+        fps = self.cap.get(cv2.CAP_PROP_FPS)
+        self.frame_period = 1.0 / fps if fps > 0 else 0.0
+        self.next_frame_time = None
+
+    def read(self, image=None):
+        ret, frame = self.cap.read(image)
+        if not ret and self.loop:
+            self.cap.set(cv2.CAP_PROP_POS_FRAMES, 0)
+            ret, frame = self.cap.read(image)
+        if not ret and not self.loop:
+            self.finished = True
+        if ret and self.realtime:
+            now = time.monotonic()
+            if self.next_frame_time is None:
+                self.next_frame_time = now
+            if self.next_frame_time > now:
+                time.sleep(self.next_frame_time - now)
+            self.next_frame_time += self.frame_period
+        return ret, frame
+
+    def release(self):
+        self.cap.release()
+
+
+class ImageFolderSource(FrameSource):
+    def __init__(self, path, loop=False, fps=0):
+        """Images of a folder, in alphabetical order.
+
+        Parameters
+        ----------
+        path : str
+            Folder containing the images
+        loop : bool
+            Start again from the first image after the last one
+        fps : float
+            Rate at which the images are delivered, 0 for as fast as possible
+        """
+        folder = Path(path)
+        self.images = sorted(
+            p for p in folder.iterdir() if p.suffix.lower() in IMAGE_EXTENSIONS
+        )
+        if len(self.images) == 0:
+            raise IOError(f"No images found in {folder}")
+        self.loop = loop
+        self.frame_period = 1.0 / fps if fps > 0 else 0.0
+        self.next_frame_time = None
+        self.index = 0
+
+    def read(self, image=None):
+        if self.index >= len(self.images):
+            if not self.loop:
+                self.finished = True
+                return False, None
+            self.index = 0
+        frame = cv2.imread(str(self.images[self.index]))
+        self.index += 1
+        if self.frame_period > 0:
+            now = time.monotonic()
+            if self.next_frame_time is None:
+                self.next_frame_time = now
+            if self.next_frame_time > now:
+                time.sleep(self.next_frame_time - now)
+            self.next_frame_time += self.frame_period
+        return frame is not None, copy_into(frame, image)
+
+
+class SharedMemorySource(FrameSource):
+    def __init__(self, name, timeout=1.0):
+        """Frames written to a SharedFrameRing by another process.
+
+        Parameters
+        ----------
+        name : str
+            Name of the shared memory ring
+        timeout : float
+            Time in seconds to wait for a new frame before read() fails
+        """
+        self.ring = SharedFrameRing(name, track=False)
+        self.timeout = timeout
+        self.last_sequence = -1
+        # -- Gray frames are copied here before their conversion to BGR
+        self.gray = None
+        if self.ring.shape[2] == 1:
+            self.gray = np.empty(self.ring.shape[:2], dtype=np.uint8)
+
+    def read(self, image=None):
+        deadline = time.monotonic() + self.timeout
+        if self.gray is not None:
+            out = self.gray
+        elif image is not None and image.shape == self.ring.shape:
+            out = image
+        else:
+            out = None
+        while True:
+            sequence, frame = self.ring.read_latest(self.last_sequence, out)
+            if frame is not None:
+                self.last_sequence = sequence
+                if frame.ndim == 2:
+                    frame = cv2.cvtColor(frame, cv2.COLOR_GRAY2BGR, dst=image)
+                return True, frame
+            if time.monotonic() > deadline:
+                return False, None
+            time.sleep(0.001)
+
+    def release(self):
+        self.ring.close()
+
+
+def create_frame_source(
+    source="camera",
+    device=0,
+    path="",
+    width=0,
+    height=0,
+    fps=0,
+    fourcc="",
+    buffer_size=0,
+    loop=False,
+    realtime=False,
+):
+    """Create a frame source by name.
+
+    Parameters
+    ----------
+    source : str
+        One of camera, video, images or shm
+    device : int or str
+        Camera index or device path, for camera sources
+    path : str
+        Video file, image folder or shared memory name for the other sources
+
+    The remaining parameters are passed to the sources that use them.
+    """
+    if source == "camera":
+        return CameraSource(device, width, height, fps, fourcc, buffer_size)
+    elif source == "video":
+        return VideoFileSource(path, loop, realtime)
+    elif source == "images":
+        return ImageFolderSource(path, loop, fps)
+    elif source == "shm":
+        return SharedMemorySource(path)
+    raise ValueError(f"Unknown frame source {source}")
@@ -0,0 +1,317 @@
+import threading
+
+import cv2
+import numpy as np
+
+from .calibration_store import new_calibration, write_camera_calibration
+from .camera_calibration import (
+    COVERAGE_GRID,
+    calibrate_rejecting_outliers,
+    coverage_cells,
+    find_board,
+)
+from .frame_source import create_frame_source
+
+WINDOW = "uos-aruco-camera-cal"
+# -- Fewest views calibrated, and saved
+MIN_VIEWS = 5
+
+
+class LiveCalibration:
+    def __init__(
+        self,
+        board,
+        preview_scale=0.5,
+        max_views=40,
+        min_angle=15.0,
+        max_motion=2.0,
+        outlier_ratio=3.0,
+        model="plumb_bob",
+    ):
+        """Calibration from a stream of frames, recomputed as views are added.
+
+        The board is searched in a downscaled preview of each frame and its
+        corners are refined at full resolution. A view is only kept when its
+        corners cover new cells of a grid over the image or, once a first
+        calibration is available, when the board is seen from a new angle.
+        The camera is calibrated again on a background thread after each new
+        view, so the capture never waits for the solver.
+
+        Parameters
+        ----------
+        board : CalibrationBoard
+            Board shown to the camera
+        preview_scale : float
+            Scale of the preview the board is searched in
+        max_views : int
+            Number of views after which no view is added
+        min_angle : float
+            Angle in degrees between the board orientation of a view and those
+            of the kept views, from which a view without new coverage is kept
+        max_motion : float
+            Views are only kept when the corners moved less than this many
+            pixels since the previous frame, to avoid motion blur
+        outlier_ratio : float
+            Views whose reprojection error exceeds this many times the median
+            error are left out of the calibration
+        model : str
+            Distortion model, one of DISTORTION_MODELS
+        """
+        self.board = board
+        self.preview_scale = preview_scale
+        self.max_views = max_views
+        self.min_angle = min_angle
+        self.max_motion = max_motion
+        self.outlier_ratio = outlier_ratio
+        self.model = model
+        self.size = None
+        self.objpoints = []
+        self.imgpoints = []
+        self.normals = []
+        self.covered = set()
+        self.previous = None
+        # -- (rms, camera matrix, distortion, kept views, errors), or None
+        self.result = None
+        self.calibrations = 0
+        self.lock = threading.Lock()
+        self.changed = threading.Event()
+        self.running = threading.Event()
+        self.thread = None
+
+    @property
+    def coverage(self):
+        """Fraction of the cells of the image covered by the kept views."""
+        return len(self.covered) / (COVERAGE_GRID[0] * COVERAGE_GRID[1])
+
+    def start(self):
+        self.running.set()
+        self.thread = threading.Thread(
+            target=self.calibration_loop, name="calibrate", daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        self.running.clear()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def process(self, gray):
+        """Find the board in a gray frame and keep the view if it is useful.
+
+        Returns
+        -------
+        np.ndarray
+            (N, 1, 2) corners of the board, or None if it was not found
+        np.ndarray
+            (N, 1) ids of the corners, or None
+        bool
+            True if the view was kept
+        """
+        self.size = (gray.shape[1], gray.shape[0])
+        corners, ids = find_board(gray, self.board, self.preview_scale)
+        previous, self.previous = self.previous, (corners, ids)
+        if corners is None or len(self.objpoints) >= self.max_views:
+            return corners, ids, False
+        # -- Only still boards are kept, as moving ones are blurred
+        if previous is None or previous[0] is None:
+            return corners, ids, False
+        if self.motion(previous, corners, ids) > self.max_motion:
+            return corners, ids, False
+
+        objp = self.board.object_points(ids)
+        cells = coverage_cells(corners, self.size)
+        normal = self.board_normal(objp, corners)
+        new_angle = normal is not None and all(
+            np.degrees(np.arccos(np.clip(normal @ n, -1.0, 1.0))) > self.min_angle
+            for n in self.normals
+            if n is not None
+        )
+        if not cells - self.covered and not new_angle:
+            return corners, ids, False
+        with self.lock:
+            self.objpoints.append(objp)
+            self.imgpoints.append(corners)
+            self.normals.append(normal)
+            self.covered |= cells
+        self.changed.set()
+        return corners, ids, True
+
+    @staticmethod
+    def motion(previous, corners, ids):
+        """Mean displacement in pixels of the corners seen in both frames."""
+        previous_corners, previous_ids = previous
+        common, here, there = np.intersect1d(
+            ids.ravel(), previous_ids.ravel(), return_indices=True
+        )
+        if len(common) == 0:
+            return float("inf")
+        displacement = corners[here] - previous_corners[there]
+        return float(np.linalg.norm(displacement.reshape(-1, 2), axis=1).mean())
+
+    def board_normal(self, objp, corners):
+        """Normal of the board in the camera frame, None before a calibration."""
+        result = self.result
+        if result is None:
+            return None
+        ok, rvec, _ = cv2.solvePnP(objp, corners, result[1], result[2])
+        if not ok:
+            return None
+        return cv2.Rodrigues(rvec)[0][:, 2]
+
+    def calibration_loop(self):
+        while self.running.is_set():
+            if not self.changed.wait(0.1):
+                continue
+            self.changed.clear()
+            self.calibrate()
+
+    def calibrate(self):
+        """Calibrate the camera with the views kept so far."""
+        with self.lock:
+            objpoints = list(self.objpoints)
+            imgpoints = list(self.imgpoints)
+        if len(objpoints) < MIN_VIEWS:
+            return
+        try:
+            self.result = calibrate_rejecting_outliers(
+                objpoints, imgpoints, self.size, self.outlier_ratio, model=self.model
+            )
+            self.calibrations += 1
+        except cv2.error as e:
+            print("Calibration failed: {}".format(e))
+            return
+        # -- Normals of the views kept before the first calibration
+        with self.lock:
+            for i, normal in enumerate(self.normals):
+                if normal is None:
+                    self.normals[i] = self.board_normal(
+                        self.objpoints[i], self.imgpoints[i]
+                    )
+
+    def draw(self, frame, corners, kept):
+        """Draw the covered cells, the board corners and the calibration state."""
+        height, width = frame.shape[:2]
+        for cell in self.covered:
+            row, column = divmod(cell, COVERAGE_GRID[0])
+            x0 = column * width // COVERAGE_GRID[0]
+            y0 = row * height // COVERAGE_GRID[1]
+            x1 = (column + 1) * width // COVERAGE_GRID[0]
+            y1 = (row + 1) * height // COVERAGE_GRID[1]
+            cv2.rectangle(frame, (x0, y0), (x1, y1), (0, 160, 0), 2)
+        if corners is not None:
+            color = (0, 255, 0) if kept else (0, 200, 255)
+            for x, y in corners.reshape(-1, 2):
+                cv2.circle(frame, (int(x), int(y)), 4, color, -1)
+        for i, text in enumerate(self.status().split(", ")):
+            cv2.putText(
+                frame,
+                text,
+                (20, 40 + 35 * i),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                1.0,
+                (0, 0, 255),
+                2,
+            )
+        return frame
+
+    def status(self):
+        text = "{} views, coverage {:.0f}%".format(
+            len(self.objpoints), 100 * self.coverage
+        )
+        result = self.result
+        if result is None:
+            return text + ", not calibrated"
+        return text + ", reprojection error {:.3f} px".format(result[0])
+
+    def save(self, config_file):
+        """Write the camera matrix and distortion into the configuration file."""
+        result = self.result
+        if result is None:
+            print("Not calibrated yet: show the board to the camera")
+            return False
+        calibration = new_calibration(
+            result[1], result[2], self.size, result[0], len(result[3])
+        )
+        saved = write_camera_calibration(config_file, calibration)
+        print("Calibration saved in the camera section of", saved)
+        print(self.status())
+        return True
+
+
+def run(
+    config,
+    config_file,
+    board,
+    preview_scale=0.5,
+    max_views=40,
+    headless=False,
+    model="plumb_bob",
+):
+    """Calibrate the configured camera live.
+
+    Frames come from the capture section of the configuration. Press s to
+    save the calibration in the camera section of the configuration file,
+    c to start again and q or ESC to quit. Headless, the calibration runs
+    until max_views views are kept, the source ends or Ctrl+C is pressed,
+    and is then saved.
+    """
+    capture = create_frame_source(
+        config.capture_source,
+        config.capture_device,
+        config.capture_path,
+        config.capture_width,
+        config.capture_height,
+        config.capture_fps,
+        config.capture_fourcc,
+        config.capture_buffer_size,
+        config.capture_loop,
+        config.capture_realtime,
+    )
+    calibration = LiveCalibration(board, preview_scale, max_views, model=model)
+    calibration.start()
+    if not headless:
+        cv2.namedWindow(WINDOW, cv2.WINDOW_NORMAL)
+        print("Press s to save the calibration, c to clear it and q to quit")
+    frame = None
+    gray = None
+    last_status = None
+    try:
+        while True:
+            ret, frame = capture.read(frame)
+            if not ret:
+                print("No more frames")
+                break
+            gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY, dst=gray)
+            corners, _, kept = calibration.process(gray)
+            status = calibration.status()
+            if kept or status != last_status:
+                print(status)
+                last_status = status
+            if headless:
+                if len(calibration.objpoints) >= max_views:
+                    break
+                continue
+            cv2.imshow(WINDOW, calibration.draw(frame, corners, kept))
+            key = cv2.waitKey(1) & 0xFF
+            if key in (ord("q"), 27):
+                break
+            elif key == ord("s"):
+                calibration.save(config_file)
+            elif key == ord("c"):
+                calibration.stop()
+                calibration = LiveCalibration(
+                    board, preview_scale, max_views, model=model
+                )
+                calibration.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.release()
+        if not headless:
+            cv2.destroyAllWindows()
+    calibration.stop()
+    if headless:
+        # -- Include the last views before saving
+        calibration.calibrate()
+        calibration.save(config_file)
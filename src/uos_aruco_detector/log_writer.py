@@ -0,0 +1,158 @@
+import csv
+import os
+import threading
+import time
+from collections import deque
+from pathlib import Path
+
+
+class CsvSink:
+    def __init__(
+        self, fname, header, buffer_size=65536, flush_interval=1.0, flush_rows=100
+    ):
+        """CSV file kept open for the whole session with buffered writes.
+
+        Rows are written to disk every flush_rows rows or every flush_interval
+        seconds, whichever happens first.
+
+        Parameters
+        ----------
+        fname : Path
+            Path of the CSV file
+        header : list
+            Column names
+        buffer_size : int
+            Size of the file buffer in bytes
+        flush_interval : float
+            Maximum time in seconds a row stays in the buffer
+        flush_rows : int
+            Maximum number of rows kept in the buffer
+        """
+        self.fname = Path(fname)
+        self.flush_interval = flush_interval
+        self.flush_rows = flush_rows
+        self.file = self.fname.open("w", newline="", buffering=buffer_size)
+        self.writer = csv.writer(self.file)
+        self.writer.writerow(header)
+        self.pending_rows = 0
+        self.last_flush_time = time.monotonic()
+
+    def write_row(self, row):
+        self.writer.writerow(row)
+        self.pending_rows += 1
+        self.flush_if_due()
+
+    def flush_if_due(self):
+        """Flush the buffered rows if the row count or time limit is reached."""
+        if self.pending_rows == 0:
+            return
+        if (
+            self.pending_rows >= self.flush_rows
+            or time.monotonic() - self.last_flush_time >= self.flush_interval
+        ):
+            self.flush()
+
+    def flush(self):
+        """Write the buffered rows to disk."""
+        if self.file.closed:
+            return
+        self.file.flush()
+        self.pending_rows = 0
+        self.last_flush_time = time.monotonic()
+
+    def close(self):
+        """Flush the buffered rows and close the file."""
+        if self.file.closed:
+            return
+        self.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+
+
+class LogWriter:
+    def __init__(self, queue_size=10000, poll_interval=0.05):
+        """Write log rows to their sinks from a background thread.
+
+        Producers call submit() from the detection loop. Rows are handed over
+        through a deque, whose append and popleft are atomic, so the hot path
+        never takes a lock nor waits for the disk. When the queue is full the
+        new row is dropped and counted.
+
+        Parameters
+        ----------
+        queue_size : int
+            Maximum number of rows waiting to be written
+        poll_interval : float
+            Time in seconds the writer sleeps when the queue is empty
+        """
+        self.queue_size = queue_size
+        self.poll_interval = poll_interval
+        self.queue = deque()
+        self.sinks = set()
+        self.submitted = 0
+        self.written = 0
+        self.dropped = 0
+        self.errors = 0
+        self.max_depth = 0
+        self.running = True
+        self.thread = threading.Thread(target=self.run, name="log_writer", daemon=True)
+        self.thread.start()
+
+    @property
+    def depth(self):
+        """Number of rows waiting to be written."""
+        return len(self.queue)
+
+    def stats(self):
+        return {
+            "depth": self.depth,
+            "max_depth": self.max_depth,
+            "submitted": self.submitted,
+            "written": self.written,
+            "dropped": self.dropped,
+            "errors": self.errors,
+        }
+
+    def submit(self, sink, row):
+        """Queue a row to be written to a sink. Never blocks."""
+        depth = len(self.queue)
+        if depth >= self.queue_size:
+            self.dropped += 1
+            return
+        self.queue.append((sink, row))
+        self.submitted += 1
+        if depth + 1 > self.max_depth:
+            self.max_depth = depth + 1
+
+    def run(self):
+        while self.running or self.queue:
+            self.drain()
+            for sink in self.sinks:
+                try:
+                    sink.flush_if_due()
+                except OSError as e:
+                    print("Could not flush {}: {}".format(sink.fname, e))
+            if self.running:
+                time.sleep(self.poll_interval)
+
+    def drain(self):
+        while self.queue:
+            sink, row = self.queue.popleft()
+            self.sinks.add(sink)
+            try:
+                sink.write_row(row)
+                self.written += 1
+            except Exception as e:
+                # -- Any error would otherwise end the thread without a word
+                self.errors += 1
+                print("Could not write log row to {}: {}".format(sink.fname, e))
+
+    def close(self):
+        """Write the queued rows, flush the sinks and stop the thread."""
+        if not self.running:
+            return
+        self.running = False
+        self.thread.join()
+        for sink in self.sinks:
+            sink.flush()
+        print("Log writer stats: {}".format(self.stats()))
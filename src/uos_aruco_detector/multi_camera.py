@@ -0,0 +1,278 @@
+import multiprocessing
+import queue
+import time
+
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+from .aruco_detector import ArucoDetector, FrameInfo
+from .frame_source import create_frame_source
+
+
+def camera_worker(index, camera, marker_size, frame_type, settings, results, running):
+    """Capture and detect the markers of one camera, in its own process.
+
+    Parameters
+    ----------
+    index : int
+        Index of the camera
+    camera : dict
+        Frame source and intrinsics of the camera, as in
+        Configuration.cameras
+    marker_size : float
+        Side of the markers in metres
+    frame_type : str
+        Reference frame, NED or ENU
+    settings : dict
+        Keyword arguments of ArucoDetector
+    results : multiprocessing.Queue
+        Queue receiving (index, info, corners, ids, rvecs, tvecs) tuples, and
+        (index, None) once a video or image folder has no more frames
+    running : multiprocessing.Event
+        Cleared to stop the worker
+    """
+    capture = create_frame_source(
+        camera["source"],
+        camera["device"],
+        camera["path"],
+        camera["width"],
+        camera["height"],
+        camera["fps"],
+        camera["fourcc"],
+        camera["buffer_size"],
+        camera["loop"],
+        camera["realtime"],
+    )
+    detector = ArucoDetector(
+        camera["matrix"],
+        camera["distortion"],
+        marker_size,
+        frame_type,
+        image_size=camera["image_size"],
+        capture=capture,
+        **settings,
+    )
+    dropped = 0
+    try:
+        while running.is_set():
+            frame, info = detector.grab()
+            if frame is None:
+                if detector.finished:
+                    # -- Wait for the marker to be sent, exiting does not
+                    results.put((index, None))
+                    results.close()
+                    results.join_thread()
+                    break
+                time.sleep(0.01)
+                continue
+            corners, ids, rvecs, tvecs = detector.detect(frame, info)
+            # -- Only the detections are sent, never the frame
+            try:
+                results.put_nowait((index, info, corners, ids, rvecs, tvecs))
+            except queue.Full:
+                dropped += 1
+    except KeyboardInterrupt:
+        pass
+    finally:
+        capture.release()
+        # -- Do not wait for the queue to be emptied when exiting
+        results.cancel_join_thread()
+        print("Camera {} dropped {} results".format(index, dropped))
+
+
+def fuse_observations(observations, origins, sequence=0):
+    """Fuse the tag poses seen by several cameras into one pose per tag.
+
+    Parameters
+    ----------
+    observations : list
+        (index, info, corners, ids, rvecs, tvecs) detections of the cameras
+    origins : list
+        OriginReference of each camera
+    sequence : int
+        Sequence number of the fused frame
+
+    Returns
+    -------
+    np.ndarray
+        (N, 1) ids of the tags, or None if no tag was seen
+    np.ndarray
+        (N, 3) mean positions of the tags in the ENU frame of the origin
+    Rotation
+        N mean orientations of the tags
+    FrameInfo
+        Mean capture time of the observations and the slowest duration of
+        each stage
+    """
+    tag_ids, positions, quaternions = [], [], []
+    for index, _, _, ids, rvecs, tvecs in observations:
+        if ids is None:
+            continue
+        camera_positions, camera_rotations = origins[index].get_relative_poses(
+            rvecs, tvecs
+        )
+        tag_ids.append(ids.reshape(-1))
+        positions.append(camera_positions)
+        quaternions.append(camera_rotations.as_quat().reshape(-1, 4))
+
+    infos = [observation[1] for observation in observations]
+    timings = {}
+    for info in infos:
+        for stage, seconds in info.timings.items():
+            timings[stage] = max(timings.get(stage, 0.0), seconds)
+    info = FrameInfo(
+        sequence,
+        float(np.mean([i.capture_time for i in infos])),
+        float(np.mean([i.capture_monotonic for i in infos])),
+        timings,
+    )
+    if len(tag_ids) == 0:
+        return None, None, None, info
+
+    tag_ids = np.concatenate(tag_ids)
+    positions = np.concatenate(positions)
+    quaternions = np.concatenate(quaternions)
+    unique_ids, group = np.unique(tag_ids, return_inverse=True)
+    counts = np.bincount(group)
+    fused_positions = np.zeros((len(unique_ids), 3))
+    np.add.at(fused_positions, group, positions)
+    fused_positions /= counts[:, None]
+    fused_quaternions = np.empty((len(unique_ids), 4))
+    for i in range(len(unique_ids)):
+        rotations = Rotation.from_quat(quaternions[group == i])
+        fused_quaternions[i] = rotations.mean().as_quat()
+    return (
+        unique_ids.reshape(-1, 1),
+        fused_positions,
+        Rotation.from_quat(fused_quaternions),
+        info,
+    )
+
+
+class MultiCameraPipeline:
+    def __init__(
+        self, cameras, marker_size, frame_type, settings, window=0.02, queue_size=4
+    ):
+        """Capture and detection workers of several cameras.
+
+        Each camera runs in its own process and only sends its detections
+        back. get() groups the detections of the cameras captured at about
+        the same time, so that they can be fused.
+
+        Parameters
+        ----------
+        cameras : list
+            Frame source and intrinsics of each camera, as in
+            Configuration.cameras
+        marker_size : float
+            Side of the markers in metres
+        frame_type : str
+            Reference frame, NED or ENU
+        settings : dict
+            Keyword arguments of ArucoDetector
+        window : float
+            Maximum time in seconds between the captures of a group, and
+            maximum time a group waits for the other cameras
+        queue_size : int
+            Detections queued per camera. Workers drop their detections when
+            the queue is full
+        """
+        self.cameras = cameras
+        self.marker_size = marker_size
+        self.frame_type = frame_type
+        self.settings = settings
+        self.window = window
+        # -- Spawned processes do not inherit the OpenCV state of this one
+        self.context = multiprocessing.get_context("spawn")
+        self.results = self.context.Queue(queue_size * len(cameras))
+        self.running = self.context.Event()
+        self.workers = []
+        self.pending = []
+        self.pending_deadline = 0.0
+        # -- Indices of the cameras whose source has no more frames
+        self.finished_cameras = set()
+
+    @property
+    def finished(self):
+        """True once every camera finished and its detections were returned."""
+        return len(self.finished_cameras) == len(self.cameras) and not self.pending
+
+    def start(self):
+        self.running.set()
+        self.workers = [
+            self.context.Process(
+                target=camera_worker,
+                args=(
+                    index,
+                    camera,
+                    self.marker_size,
+                    self.frame_type,
+                    self.settings,
+                    self.results,
+                    self.running,
+                ),
+                name="camera{}".format(index),
+                daemon=True,
+            )
+            for index, camera in enumerate(self.cameras)
+        ]
+        for worker in self.workers:
+            worker.start()
+
+    def stop(self):
+        self.running.clear()
+        for worker in self.workers:
+            worker.join(timeout=2.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+
+    def flush(self):
+        group, self.pending = self.pending, []
+        return group
+
+    def get(self, timeout=0.1):
+        """Get the next group of detections, or None.
+
+        A group holds at most one (index, info, corners, ids, rvecs, tvecs)
+        detection per camera. It is complete when all the cameras are in it,
+        when a detection does not belong to it, or when the fusion window has
+        passed since its first detection arrived. A RuntimeError is raised if
+        a camera worker failed.
+        """
+        for worker in self.workers:
+            # -- Workers whose source finished exit with 0
+            if not worker.is_alive() and worker.exitcode != 0:
+                raise RuntimeError(
+                    "Camera worker {} stopped with exit code {}".format(
+                        worker.name, worker.exitcode
+                    )
+                )
+        deadline = time.monotonic() + timeout
+        while True:
+            now = time.monotonic()
+            wait = (self.pending_deadline if self.pending else deadline) - now
+            try:
+                observation = self.results.get(timeout=max(wait, 0.0))
+            except queue.Empty:
+                return self.flush() if self.pending else None
+            if observation[1] is None:
+                self.finished_cameras.add(observation[0])
+                continue
+            if self.pending and (
+                observation[0] in [p[0] for p in self.pending]
+                or abs(
+                    observation[1].capture_monotonic
+                    - self.pending[0][1].capture_monotonic
+                )
+                > self.window
+            ):
+                group = self.flush()
+                self.pending = [observation]
+                self.pending_deadline = time.monotonic() + self.window
+                return group
+            if not self.pending:
+                self.pending_deadline = time.monotonic() + self.window
+            self.pending.append(observation)
+            if len(self.pending) == len(self.cameras):
+                return self.flush()
@@ -35,6 +35,16 @@ def relative_position(rvec1, tvec1, rvec2, tvec2):
     return composed_rvec, composed_tvec
 
 
+# Rotation matrix for ENU to NED
+ENU_TO_NED = np.array(
+    [
+        [0, 1, 0],
+        [1, 0, 0],
+        [0, 0, -1],
+    ]
+)
+
+
 class OriginReference:
     def __init__(self, path, frame="ENU"):
         self.path = path
@@ -44,6 +54,9 @@ class OriginReference:
         self.corners = None
         self.initialised = False
         self.frame = frame
+        # -- Inverse of the origin transform, cached for get_relative_positions
+        self.rotation_matrix = np.eye(3)
+        self.inverse_rotation = Rotation.identity()
 
     def set(self, corners, rvec, tvec):
         # -- Store the origin location
@@ -53,40 +66,91 @@ class OriginReference:
             self.corners = corners
             self.tvec = tvec
             self.rvec = rvec
+            rotation = Rotation.from_rotvec(np.asarray(rvec, dtype=float).reshape(3))
+            self.rotation_matrix = rotation.as_matrix()
+            self.inverse_rotation = rotation.inv()
             self.initialised = True
 
-    def get_relative_position(self, rvec, tvec):
+    def get_relative_positions(self, rvecs, tvecs):
+        """Position and orientation of several markers wrt the origin at once.
+
+        Equivalent to calling get_relative_position for each marker, computed
+        in a single vectorised pass.
+
+        Args:
+            rvecs (np.ndarray): (N, 1, 3) rotation vectors of the markers, as
+                returned by estimatePoseSingleMarkers.
+            tvecs (np.ndarray): (N, 1, 3) translation vectors of the markers.
+
+        Returns:
+            np.ndarray: (N, 3) positions of the markers in the origin frame.
+            np.ndarray: (N, 3) Euler angles of the markers in degrees.
+        """
         if not self.initialised:
             return None, None
+        return self.express(*self.get_relative_poses(rvecs, tvecs))
+
+    def get_relative_poses(self, rvecs, tvecs):
+        """Poses of several markers in the ENU frame of the origin marker.
+
+        Args:
+            rvecs (np.ndarray): (N, 1, 3) rotation vectors of the markers.
+            tvecs (np.ndarray): (N, 1, 3) translation vectors of the markers.
+
+        Returns:
+            np.ndarray: (N, 3) positions of the markers.
+            Rotation: N orientations of the markers.
+        """
+        rvecs = np.asarray(rvecs, dtype=float).reshape(-1, 3)
+        tvecs = np.asarray(tvecs, dtype=float).reshape(-1, 3)
+        origin_tvec = np.asarray(self.tvec, dtype=float).reshape(1, 3)
 
-        # -- Get the relative position of the second marker wrt the first one
-        composed_rvec, composed_tvec = relative_position(
-            rvec,
-            tvec,
-            self.rvec,
-            self.tvec,
-        )
+        # -- R0^T (t - t0) for every marker, written for row vectors
+        tag_positions = (tvecs - origin_tvec) @ self.rotation_matrix
+        rotations = self.inverse_rotation * Rotation.from_rotvec(rvecs)
+        return tag_positions, rotations
 
-        rot = cv2.Rodrigues(composed_rvec)[0]
-        tag_position = composed_tvec
-        r = Rotation.from_matrix(rot)
-        angles = r.as_euler("XYZ", degrees=True)
-        tag_rotation = np.array([angles[0], angles[1], angles[2]])
+    def express(self, tag_positions, rotations):
+        """Convert poses from get_relative_poses to positions and Euler angles
+        in the output frame.
 
+        Args:
+            tag_positions (np.ndarray): (N, 3) positions in ENU.
+            rotations (Rotation): N orientations in ENU.
+
+        Returns:
+            np.ndarray: (N, 3) positions in the output frame.
+            np.ndarray: (N, 3) Euler angles in degrees.
+        """
+        angles = rotations.as_euler("XYZ", degrees=True)
         if self.frame == "NED":
-            # Rotation matrix for ENU to NED
-            R = np.array(
-                [
-                    [0, 1, 0],
-                    [1, 0, 0],
-                    [0, 0, -1],
-                ]
-            )
             # Transform the position and rotation to NED
-            tag_position = R @ composed_tvec
-            tag_rotation = np.array([angles[1], angles[0], -angles[2]])
-        tag_position = tag_position.reshape((3,))
-        return tag_position, tag_rotation
+            tag_positions = tag_positions @ ENU_TO_NED.T
+            angles = np.stack([angles[:, 1], angles[:, 0], -angles[:, 2]], axis=1)
+        return tag_positions, angles
+
+    def express_rates(self, velocities, angular_velocities):
+        """Convert ENU velocities to the output frame.
+
+        Args:
+            velocities (np.ndarray): (N, 3) velocities in m/s.
+            angular_velocities (np.ndarray): (N, 3) angular velocities in
+                rad/s, as rotation vectors per second.
+
+        Returns:
+            np.ndarray: (N, 6) velocities in m/s followed by angular
+                velocities in deg/s, in the output frame.
+        """
+        rates = np.concatenate([velocities, np.degrees(angular_velocities)], axis=1)
+        if self.frame == "NED":
+            rates = rates.reshape(-1, 2, 3) @ ENU_TO_NED.T
+        return rates.reshape(-1, 6)
+
+    def get_relative_position(self, rvec, tvec):
+        if not self.initialised:
+            return None, None
+        tag_positions, tag_rotations = self.get_relative_positions(rvec, tvec)
+        return tag_positions[0], tag_rotations[0]
 
     def get():
         return
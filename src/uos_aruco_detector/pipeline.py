@@ -0,0 +1,608 @@
+import heapq
+import itertools
+import multiprocessing
+import os
+import queue
+import threading
+import time
+import traceback
+from collections import deque
+
+import cv2
+import numpy as np
+
+from .aruco_detector import ArucoDetector
+from .frame_ring import SharedFrameRing
+from .frame_source import FrameSource
+
+# -- Reader id under which the pipelines hold the slots of their frame ring.
+# -- External readers, e.g. the recorder, use the other ids
+PIPELINE_READER = 0
+
+RING_IDS = itertools.count()
+
+
+class DropOldestQueue:
+    """Bounded queue that discards the oldest item when a new one arrives full.
+
+    Consumers always receive the freshest items, so a slow stage never makes
+    the stages upstream of it block or fall behind.
+    """
+
+    def __init__(self, maxsize=1, on_drop=None):
+        self.maxsize = maxsize
+        self.items = deque()
+        self.dropped = 0
+        # -- Called with each dropped item, e.g. to release its frame
+        self.on_drop = on_drop
+        self.condition = threading.Condition()
+
+    def __len__(self):
+        return len(self.items)
+
+    def put(self, item):
+        dropped = None
+        with self.condition:
+            if len(self.items) >= self.maxsize:
+                dropped = self.items.popleft()
+                self.dropped += 1
+            self.items.append(item)
+            self.condition.notify()
+        if dropped is not None and self.on_drop is not None:
+            self.on_drop(dropped)
+
+    def get(self, timeout=None):
+        """Pop the oldest queued item.
+
+        Parameters
+        ----------
+        timeout : float
+            Maximum time to wait for an item, in seconds. None waits forever.
+
+        Returns
+        -------
+        object
+            The item, or None if the timeout expired.
+        """
+        with self.condition:
+            if not self.condition.wait_for(lambda: len(self.items) > 0, timeout):
+                return None
+            return self.items.popleft()
+
+    def clear(self):
+        with self.condition:
+            items, self.items = list(self.items), deque()
+        if self.on_drop is not None:
+            for item in items:
+                self.on_drop(item)
+
+
+def ring_name(name=None):
+    """Name of the frame ring of a pipeline, unique to it if name is empty."""
+    if name:
+        return name
+    return "uos_aruco_detector_{}_{}".format(os.getpid(), next(RING_IDS))
+
+
+def run_stage(pipeline, loop):
+    """Run the loop of a pipeline stage, keeping its exception for get().
+
+    An exception stops the pipeline, and is raised by the next call to get()
+    on the main thread, instead of ending the thread silently.
+    """
+    try:
+        loop()
+    except Exception as e:
+        pipeline.error = e
+        pipeline.running.clear()
+
+
+class DetectionError(RuntimeError):
+    """Exception of a detector worker, with its traceback as the message."""
+
+
+class FrameRingCapture:
+    """Capture of the frames of a detector directly into a SharedFrameRing.
+
+    The frames are read into the slots of the ring and converted to gray in
+    the gray image of the slot, so the capture does not allocate anything
+    once the ring exists. Each captured slot is held, by PIPELINE_READER,
+    until release() is called on it.
+    """
+
+    def __init__(self, detector, slots, name=None):
+        self.detector = detector
+        self.slots = slots
+        self.name = ring_name(name)
+        self.ring = None
+        self.dropped = 0
+
+    def grab(self):
+        """Capture the next frame into a slot of the ring.
+
+        Returns
+        -------
+        int
+            Sequence number of the frame in the ring, or None if no frame was
+            captured
+        int
+            The held slot, or None
+        FrameInfo
+            Information of the frame, or None
+        """
+        slot = None
+        if self.ring is not None:
+            slot = self.ring.acquire_write()
+            if slot is None:
+                # -- All the slots are in use, the readers are too slow
+                self.dropped += 1
+                time.sleep(0.001)
+                return None, None, None
+        frame, info = self.detector.grab(
+            None if slot is None else self.ring.frame(slot)
+        )
+        if frame is None:
+            return None, None, None
+        if self.ring is None:
+            self.ring = SharedFrameRing(
+                self.name, frame.shape, self.slots, create=True, gray=True
+            )
+            print("Sharing the frames in memory as {}".format(self.name))
+            slot = self.ring.acquire_write()
+        view = self.ring.frame(slot)
+        if frame.shape != view.shape:
+            print("Frame size changed to {}, frame dropped".format(frame.shape))
+            self.dropped += 1
+            return None, None, None
+        # -- Sources that cannot read in place return their own frame
+        if not np.shares_memory(frame, view):
+            np.copyto(view, frame)
+        if frame.ndim == 3:
+            cv2.cvtColor(view, cv2.COLOR_BGR2GRAY, dst=self.ring.gray(slot))
+        else:
+            np.copyto(self.ring.gray(slot), view)
+        self.ring.hold(slot, PIPELINE_READER)
+        return self.ring.commit(slot), slot, info
+
+    def release(self, slot):
+        self.ring.release(slot, PIPELINE_READER)
+
+    def close(self):
+        if self.ring is not None:
+            self.ring.close()
+            self.ring = None
+
+
+class DetectionPipeline:
+    """Capture and detection stages running on their own threads.
+
+    The capture thread grabs frames from the detector's capture device as fast
+    as the camera delivers them and the detection thread processes the freshest
+    one. Results are collected with get() by the publish stage, which is
+    expected to run on the main thread so that OpenCV windows keep working.
+
+    The frames are captured into a SharedFrameRing and passed between the
+    stages as slots of the ring. The frame returned by get() stays valid until
+    the next call to get(), and must not be modified, as other processes such
+    as a recorder may read it.
+    """
+
+    def __init__(self, detector, queue_size=1, ring_name=None):
+        self.detector = detector
+        # -- Slots queued between the stages, one detected, one returned by
+        # -- get(), one being written and spare ones for external readers
+        self.capture = FrameRingCapture(detector, 2 * queue_size + 5, ring_name)
+        self.frames = DropOldestQueue(queue_size, on_drop=self.drop)
+        self.results = DropOldestQueue(queue_size, on_drop=self.drop)
+        self.running = threading.Event()
+        # -- Set once the capture has no more frames, and once they are detected
+        self.captured = threading.Event()
+        self.detected = threading.Event()
+        # -- Exception that stopped a stage, raised by get()
+        self.error = None
+        self.threads = []
+        self.current_slot = None
+
+    @property
+    def finished(self):
+        """True once every frame of a finished capture was returned by get()."""
+        return self.detected.is_set() and len(self.results) == 0
+
+    def start(self):
+        self.running.set()
+        self.threads = [
+            threading.Thread(
+                target=run_stage,
+                args=(self, self.capture_loop),
+                name="capture",
+                daemon=True,
+            ),
+            threading.Thread(
+                target=run_stage,
+                args=(self, self.detection_loop),
+                name="detect",
+                daemon=True,
+            ),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running.clear()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+        self.threads = []
+        self.frames.clear()
+        self.results.clear()
+        self.current_slot = None
+        self.capture.close()
+        print(
+            "Pipeline dropped {dropped frames} frames and {dropped results}"
+            " results".format(**self.stats())
+        )
+
+    def stats(self):
+        return {
+            "dropped frames": self.frames.dropped + self.capture.dropped,
+            "dropped results": self.results.dropped,
+        }
+
+    def drop(self, item):
+        self.capture.release(item[0])
+
+    def capture_loop(self):
+        while self.running.is_set():
+            _, slot, info = self.capture.grab()
+            if slot is None:
+                if self.detector.finished:
+                    self.captured.set()
+                    return
+                continue
+            self.frames.put((slot, info))
+
+    def detection_loop(self):
+        while self.running.is_set():
+            item = self.frames.get(timeout=0.1)
+            if item is None:
+                if self.captured.is_set() and len(self.frames) == 0:
+                    self.detected.set()
+                    return
+                continue
+            slot, info = item
+            ring = self.capture.ring
+            corners, ids, rvecs, tvecs = self.detector.detect(
+                ring.frame(slot), info, ring.gray(slot)
+            )
+            self.results.put((slot, corners, ids, rvecs, tvecs, info))
+
+    def get(self, timeout=0.1):
+        """Get the latest (frame, corners, ids, rvecs, tvecs, info) result, or None.
+
+        The frame of the previous result is released. The exception that
+        stopped a stage is raised.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.current_slot is not None:
+            self.capture.release(self.current_slot)
+            self.current_slot = None
+        result = self.results.get(timeout)
+        if result is None:
+            return None
+        self.current_slot = result[0]
+        return (self.capture.ring.frame(result[0]),) + result[1:]
+
+
+def detection_worker(ring_name, camera, settings, tasks, results, running):
+    """Detect the markers of the frames held in a shared frame ring.
+
+    Parameters
+    ----------
+    ring_name : str
+        Name of the SharedFrameRing holding the frames
+    camera : dict
+        matrix, distortion, image_size, marker_size and frame_type of the
+        detector
+    settings : dict
+        Keyword arguments of ArucoDetector
+    tasks : multiprocessing.Queue
+        (task number, slot, info) of the frames to detect. The slots are held
+        by the capture until their results are used
+    results : multiprocessing.Queue
+        Receives (task number, slot, info, corners, ids, rvecs, tvecs) for
+        each task
+    running : multiprocessing.Event
+        Cleared to stop the worker
+    """
+    # -- The frames come from the ring, the detector never reads a capture
+    detector = ArucoDetector(
+        camera["matrix"],
+        camera["distortion"],
+        camera["marker_size"],
+        camera["frame_type"],
+        image_size=camera["image_size"],
+        capture=FrameSource(),
+        **settings,
+    )
+    # -- Signal that the worker is ready
+    results.put(None)
+    ring = None
+    try:
+        while running.is_set():
+            try:
+                task, slot, info = tasks.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            if ring is None:
+                ring = SharedFrameRing(ring_name)
+            # -- Detect in place, the frame and its gray image are never copied
+            try:
+                result = detector.detect(ring.frame(slot), info, ring.gray(slot))
+            except Exception:
+                # -- Send the error back, as it would end this process unseen
+                results.put(
+                    DetectionError(
+                        "Detector worker {} failed:\n{}".format(
+                            multiprocessing.current_process().name,
+                            traceback.format_exc(),
+                        )
+                    )
+                )
+                # -- Flush it, exiting does not wait for the queue otherwise
+                results.close()
+                results.join_thread()
+                break
+            results.put((task, slot, info) + tuple(result))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if ring is not None:
+            ring.close()
+        results.cancel_join_thread()
+
+
+class ParallelDetectionPipeline:
+    def __init__(
+        self,
+        detector,
+        settings,
+        workers=2,
+        queue_size=1,
+        reorder_timeout=0.5,
+        ring_name=None,
+    ):
+        """Capture thread feeding a pool of detector processes.
+
+        Frames are captured into a ring in shared memory, with their gray
+        images, and only their slots are sent to the workers, which detect
+        the markers in place. At most one frame per worker is in flight:
+        frames captured while all the workers are busy are dropped. The
+        results are put back in capture order before get() returns them. The
+        frame returned by get() stays valid until the next call to get().
+
+        Marker tracking is disabled in the workers, as consecutive frames are
+        detected by different processes.
+
+        Parameters
+        ----------
+        detector : ArucoDetector
+            Detector whose capture device is read, and whose camera is used
+            by the workers
+        settings : dict
+            Keyword arguments of the ArucoDetector of the workers
+        workers : int
+            Number of detector processes
+        queue_size : int
+            Number of ordered results kept for get()
+        reorder_timeout : float
+            Time in seconds after which a missing result is given up on
+        ring_name : str
+            Name of the shared memory frame ring, so that other processes can
+            attach to it. A unique name is used if it is empty
+        """
+        self.detector = detector
+        self.settings = dict(settings, tracking=False)
+        self.num_workers = workers
+        self.reorder_timeout = reorder_timeout
+        # -- Slots in flight, waiting to be reordered or queued, one returned
+        # -- by get(), one being written and spare ones for external readers
+        self.capture = FrameRingCapture(
+            detector, 2 * workers + queue_size + 4, ring_name
+        )
+        self.results = DropOldestQueue(queue_size, on_drop=self.drop)
+        self.dropped_frames = 0
+        self.discarded = 0
+        self.running = threading.Event()
+        # -- Number of tasks sent, final once the capture has no more frames
+        self.sent_tasks = 0
+        self.captured = threading.Event()
+        self.detected = threading.Event()
+        # -- Exception that stopped a stage or a worker, raised by get()
+        self.error = None
+        self.threads = []
+        self.current_slot = None
+        self.available = threading.Semaphore(workers)
+        # -- Spawned processes do not inherit the OpenCV state of this one
+        self.context = multiprocessing.get_context("spawn")
+        self.tasks = self.context.Queue()
+        self.worker_results = self.context.Queue()
+        self.worker_running = self.context.Event()
+        self.workers = []
+
+    def start(self):
+        camera = {
+            "matrix": self.detector.calibrated_matrix,
+            "distortion": self.detector.camera_distortion,
+            "image_size": self.detector.calibrated_size,
+            "marker_size": self.detector.marker_size,
+            "frame_type": self.detector.frame_type,
+        }
+        self.worker_running.set()
+        self.workers = [
+            self.context.Process(
+                target=detection_worker,
+                args=(
+                    self.capture.name,
+                    camera,
+                    self.settings,
+                    self.tasks,
+                    self.worker_results,
+                    self.worker_running,
+                ),
+                name="detect{}".format(i),
+                daemon=True,
+            )
+            for i in range(self.num_workers)
+        ]
+        for worker in self.workers:
+            worker.start()
+        # -- Wait for the workers to load OpenCV, so that no frame is dropped
+        # -- while they start
+        for _ in self.workers:
+            try:
+                self.worker_results.get(timeout=30.0)
+            except queue.Empty:
+                print("Detector workers are slow to start")
+                break
+        if not all(worker.is_alive() for worker in self.workers):
+            self.stop()
+            raise RuntimeError("The detector workers failed to start")
+        self.running.set()
+        self.threads = [
+            threading.Thread(
+                target=run_stage,
+                args=(self, self.capture_loop),
+                name="capture",
+                daemon=True,
+            ),
+            threading.Thread(
+                target=run_stage,
+                args=(self, self.reorder_loop),
+                name="reorder",
+                daemon=True,
+            ),
+        ]
+        for thread in self.threads:
+            thread.start()
+
+    def stop(self):
+        self.running.clear()
+        self.worker_running.clear()
+        for thread in self.threads:
+            thread.join(timeout=1.0)
+        self.threads = []
+        for worker in self.workers:
+            worker.join(timeout=2.0)
+            if worker.is_alive():
+                worker.terminate()
+        self.workers = []
+        self.results.clear()
+        self.current_slot = None
+        self.capture.close()
+        print(
+            "Pipeline dropped {dropped frames} frames and {dropped results}"
+            " results, {discarded} detections were discarded".format(**self.stats())
+        )
+
+    @property
+    def finished(self):
+        """True once every frame of a finished capture was returned by get()."""
+        return self.detected.is_set() and len(self.results) == 0
+
+    def stats(self):
+        return {
+            "dropped frames": self.dropped_frames + self.capture.dropped,
+            "dropped results": self.results.dropped,
+            "discarded": self.discarded,
+        }
+
+    def drop(self, item):
+        self.capture.release(item[0])
+
+    def capture_loop(self):
+        # -- Tasks are numbered separately from the ring, whose sequence also
+        # -- counts the dropped frames, so that the reordering has no gaps
+        while self.running.is_set():
+            _, slot, info = self.capture.grab()
+            if slot is None:
+                if self.detector.finished:
+                    self.captured.set()
+                    return
+                continue
+            if not self.available.acquire(blocking=False):
+                self.capture.release(slot)
+                self.dropped_frames += 1
+                continue
+            self.tasks.put((self.sent_tasks, slot, info))
+            self.sent_tasks += 1
+
+    def reorder_loop(self):
+        pending = []
+        next_task = 0
+        waiting_since = None
+        # -- Tasks given up on, whose permit was already released
+        given_up = set()
+        while self.running.is_set():
+            try:
+                result = self.worker_results.get(timeout=0.05)
+                if result is None:
+                    continue
+                if isinstance(result, DetectionError):
+                    raise result
+                if result[0] in given_up:
+                    given_up.remove(result[0])
+                else:
+                    self.available.release()
+                heapq.heappush(pending, (result[0], result))
+            except queue.Empty:
+                # -- A worker that died never returns its task, nor its permit
+                for worker in self.workers:
+                    if not worker.is_alive():
+                        raise DetectionError(
+                            "Detector worker {} stopped with exit code {}".format(
+                                worker.name, worker.exitcode
+                            )
+                        ) from None
+            now = time.monotonic()
+            # -- Give up on a missing result after a while, returning the
+            # -- permit of its task so that the workers are sent new frames
+            if pending and pending[0][0] != next_task:
+                if waiting_since is None:
+                    waiting_since = now
+                elif now - waiting_since > self.reorder_timeout:
+                    for task in range(next_task, pending[0][0]):
+                        given_up.add(task)
+                        self.available.release()
+                    next_task = pending[0][0]
+            while pending and pending[0][0] <= next_task:
+                _, (task, slot, info, corners, ids, rvecs, tvecs) = heapq.heappop(
+                    pending
+                )
+                # -- Results arriving after they were given up on are dropped
+                if task < next_task:
+                    self.capture.release(slot)
+                    self.discarded += 1
+                    continue
+                next_task = task + 1
+                waiting_since = None
+                self.results.put((slot, corners, ids, rvecs, tvecs, info))
+            if self.captured.is_set() and not pending and next_task >= self.sent_tasks:
+                self.detected.set()
+                return
+
+    def get(self, timeout=0.1):
+        """Get the next (frame, corners, ids, rvecs, tvecs, info) result, or None.
+
+        The frame of the previous result is released. The exception that
+        stopped a stage or a worker is raised.
+        """
+        if self.error is not None:
+            raise self.error
+        if self.current_slot is not None:
+            self.capture.release(self.current_slot)
+            self.current_slot = None
+        result = self.results.get(timeout)
+        if result is None:
+            return None
+        self.current_slot = result[0]
+        return (self.capture.ring.frame(result[0]),) + result[1:]
@@ -0,0 +1,248 @@
+import numpy as np
+from scipy.spatial.transform import Rotation
+
+# -- Standard deviations of the velocities of a new track
+INITIAL_SPEED_STD = 1.0  # [m/s]
+INITIAL_ANGULAR_SPEED_STD = np.radians(90.0)  # [rad/s]
+
+
+def process_noise(dt, acceleration_noise):
+    """Covariance of a constant velocity model driven by random accelerations.
+
+    Returns
+    -------
+    np.ndarray
+        (N, 2, 2) covariances of the value and rate of one axis
+    """
+    dt = dt.reshape(-1, 1, 1)
+    q = np.concatenate(
+        [
+            np.concatenate([dt**4 / 4, dt**3 / 2], axis=2),
+            np.concatenate([dt**3 / 2, dt**2], axis=2),
+        ],
+        axis=1,
+    )
+    return q * acceleration_noise**2
+
+
+def predict_covariance(covariance, dt, acceleration_noise):
+    """Propagate (N, 2, 2) value and rate covariances by dt seconds."""
+    dt = dt.reshape(-1)
+    p00, p01, p11 = covariance[:, 0, 0], covariance[:, 0, 1], covariance[:, 1, 1]
+    # -- F P F^T with F = [[1, dt], [0, 1]]
+    predicted = np.empty_like(covariance)
+    predicted[:, 0, 0] = p00 + 2 * dt * p01 + dt**2 * p11
+    predicted[:, 0, 1] = predicted[:, 1, 0] = p01 + dt * p11
+    predicted[:, 1, 1] = p11
+    return predicted + process_noise(dt, acceleration_noise)
+
+
+def initial_covariance(n, value_std, rate_std):
+    covariance = np.zeros((n, 2, 2))
+    covariance[:, 0, 0] = value_std**2
+    covariance[:, 1, 1] = rate_std**2
+    return covariance
+
+
+class PoseFilter:
+    def __init__(
+        self,
+        max_tags=100,
+        position_noise=0.005,
+        angle_noise=1.0,
+        acceleration_noise=2.0,
+        angular_acceleration_noise=90.0,
+        gate=16.0,
+        max_rejections=5,
+        timeout=1.0,
+    ):
+        """Constant velocity Kalman filter of the pose of every tag.
+
+        Positions and orientations are filtered separately. Each axis has the
+        same noise, so a single 2x2 covariance of value and rate is kept per
+        tag for the position and one for the orientation, whose errors are
+        small rotation vectors. The state of all the tags lives in arrays
+        indexed by tag id and each update processes all the tags of a frame
+        at once.
+
+        Parameters
+        ----------
+        max_tags : int
+            Number of tag ids, e.g. the size of the ArUco dictionary
+        position_noise : float
+            Standard deviation of the measured positions [m]
+        angle_noise : float
+            Standard deviation of the measured orientations [deg]
+        acceleration_noise : float
+            Standard deviation of the accelerations of the tags [m/s^2]
+        angular_acceleration_noise : float
+            Standard deviation of the angular accelerations [deg/s^2]
+        gate : float
+            Squared Mahalanobis distance of the position or orientation
+            innovation beyond which a measurement is rejected as an outlier
+        max_rejections : int
+            Number of consecutive rejections after which the track restarts
+            from the measurement, to follow real jumps
+        timeout : float
+            Time in seconds after which a tag that was not seen restarts
+        """
+        self.max_tags = max_tags
+        self.position_variance = position_noise**2
+        self.angle_variance = np.radians(angle_noise) ** 2
+        self.acceleration_noise = acceleration_noise
+        self.angular_acceleration_noise = np.radians(angular_acceleration_noise)
+        self.gate = gate
+        self.max_rejections = max_rejections
+        self.timeout = timeout
+
+        self.initialised = np.zeros(max_tags, dtype=bool)
+        self.time = np.zeros(max_tags)  # -- [s], monotonic
+        self.position = np.zeros((max_tags, 3))
+        self.velocity = np.zeros((max_tags, 3))
+        self.position_covariance = np.zeros((max_tags, 2, 2))
+        self.orientation = np.tile([0.0, 0.0, 0.0, 1.0], (max_tags, 1))  # -- xyzw
+        self.angular_velocity = np.zeros((max_tags, 3))
+        self.orientation_covariance = np.zeros((max_tags, 2, 2))
+        self.rejections = np.zeros(max_tags, dtype=int)
+        self.rejected = 0
+
+    def reset(self):
+        """Forget all the tracks, e.g. when the origin changes."""
+        self.initialised[:] = False
+        self.rejections[:] = 0
+
+    def update(self, tag_ids, t, positions, rotations):
+        """Update the tracks of the tags seen in a frame.
+
+        Parameters
+        ----------
+        tag_ids : np.ndarray
+            (N,) ids of the tags
+        t : float
+            Monotonic capture time of the frame [s]
+        positions : np.ndarray
+            (N, 3) measured positions
+        rotations : Rotation
+            N measured orientations
+
+        Returns
+        -------
+        np.ndarray
+            (N,) True for the measurements that were used, False for the
+            rejected outliers
+        """
+        ids = np.asarray(tag_ids, dtype=int).reshape(-1)
+        positions = np.asarray(positions, dtype=float).reshape(-1, 3)
+        quaternions = rotations.as_quat().reshape(-1, 4)
+        dt = np.maximum(t - self.time[ids], 0.0)
+        restart = ~self.initialised[ids] | (dt > self.timeout)
+
+        # -- Predict the state at the capture time
+        predicted_position = self.position[ids] + self.velocity[ids] * dt[:, None]
+        predicted_rotation = Rotation.from_rotvec(
+            self.angular_velocity[ids] * dt[:, None]
+        ) * Rotation.from_quat(self.orientation[ids])
+        position_covariance = predict_covariance(
+            self.position_covariance[ids], dt, self.acceleration_noise
+        )
+        orientation_covariance = predict_covariance(
+            self.orientation_covariance[ids], dt, self.angular_acceleration_noise
+        )
+
+        # -- Innovations and outlier gating
+        position_error = positions - predicted_position
+        orientation_error = (
+            Rotation.from_quat(quaternions) * predicted_rotation.inv()
+        ).as_rotvec()
+        position_innovation = position_covariance[:, 0, 0] + self.position_variance
+        orientation_innovation = orientation_covariance[:, 0, 0] + self.angle_variance
+        distance = np.maximum(
+            np.sum(position_error**2, axis=1) / position_innovation,
+            np.sum(orientation_error**2, axis=1) / orientation_innovation,
+        )
+        outlier = ~restart & (distance > self.gate)
+        rejections = np.where(outlier, self.rejections[ids] + 1, 0)
+        restart |= rejections >= self.max_rejections
+        outlier &= ~restart
+        rejections[restart] = 0
+        accepted = ~outlier
+        self.rejected += int(np.count_nonzero(outlier))
+
+        # -- Kalman gains of the value and rate
+        position_gain = position_covariance[:, :, 0] / position_innovation[:, None]
+        orientation_gain = (
+            orientation_covariance[:, :, 0] / orientation_innovation[:, None]
+        )
+        position = predicted_position + position_gain[:, :1] * position_error
+        velocity = self.velocity[ids] + position_gain[:, 1:] * position_error
+        orientation = (
+            Rotation.from_rotvec(orientation_gain[:, :1] * orientation_error)
+            * predicted_rotation
+        ).as_quat()
+        angular_velocity = (
+            self.angular_velocity[ids] + orientation_gain[:, 1:] * orientation_error
+        )
+        # -- P - K H P
+        position_covariance -= (
+            position_gain[:, :, None] * position_covariance[:, None, 0, :]
+        )
+        orientation_covariance -= (
+            orientation_gain[:, :, None] * orientation_covariance[:, None, 0, :]
+        )
+
+        # -- New and restarted tracks start at the measurement, at rest
+        n = int(np.count_nonzero(restart))
+        position[restart] = positions[restart]
+        velocity[restart] = 0.0
+        position_covariance[restart] = initial_covariance(
+            n, np.sqrt(self.position_variance), INITIAL_SPEED_STD
+        )
+        orientation[restart] = quaternions[restart]
+        angular_velocity[restart] = 0.0
+        orientation_covariance[restart] = initial_covariance(
+            n, np.sqrt(self.angle_variance), INITIAL_ANGULAR_SPEED_STD
+        )
+
+        # -- Outliers leave their track untouched
+        updated = ids[accepted]
+        self.position[updated] = position[accepted]
+        self.velocity[updated] = velocity[accepted]
+        self.position_covariance[updated] = position_covariance[accepted]
+        self.orientation[updated] = orientation[accepted]
+        self.angular_velocity[updated] = angular_velocity[accepted]
+        self.orientation_covariance[updated] = orientation_covariance[accepted]
+        self.time[updated] = t
+        self.initialised[updated] = True
+        self.rejections[ids] = rejections
+        return accepted
+
+    def predict(self, tag_ids, t):
+        """Pose and velocity of tracked tags at a given time.
+
+        Parameters
+        ----------
+        tag_ids : np.ndarray
+            (N,) ids of tags that have been updated
+        t : float
+            Monotonic time [s], e.g. the capture time for the filtered poses
+            or the current time to compensate for the latency
+
+        Returns
+        -------
+        np.ndarray
+            (N, 3) positions
+        Rotation
+            N orientations
+        np.ndarray
+            (N, 3) velocities [m/s]
+        np.ndarray
+            (N, 3) angular velocities [rad/s], as rotation vectors per second
+            in the frame of the positions
+        """
+        ids = np.asarray(tag_ids, dtype=int).reshape(-1)
+        dt = (t - self.time[ids])[:, None]
+        positions = self.position[ids] + self.velocity[ids] * dt
+        rotations = Rotation.from_rotvec(
+            self.angular_velocity[ids] * dt
+        ) * Rotation.from_quat(self.orientation[ids])
+        return positions, rotations, self.velocity[ids], self.angular_velocity[ids]
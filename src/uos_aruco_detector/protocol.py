@@ -0,0 +1,122 @@
+import struct
+
+MAGIC = b"UOSA"
+VERSION = 2
+
+# -- Magic, version, flags, number of tags, datagram sequence number, frame id
+HEADER_V1 = struct.Struct("<4sBBHII")
+# -- Version 1 header followed by the capture epoch [s], the latency at send
+# -- time and the grab, detect, pose and publish durations [ms]
+HEADER = struct.Struct("<4sBBHIIdf4f")
+TIMED_STAGES = ["grab", "detect", "pose", "publish"]
+# -- Tag id, epoch [s], elapsed [s], x, y, z [m], roll, pitch, yaw [deg]
+RECORD = struct.Struct("<Hdd6f")
+# -- Record followed by the velocity [m/s] and angular velocity [deg/s]
+RECORD_VELOCITY = struct.Struct("<Hdd12f")
+
+# -- Header flags
+FLAG_NED = 0x01
+FLAG_VELOCITY = 0x02
+
+
+def is_binary_message(data):
+    """Check if a datagram uses the binary protocol rather than JSON."""
+    return data[: len(MAGIC)] == MAGIC
+
+
+def encode_message(message, sequence, header=None, frame_type="NED"):
+    """Pack the tag poses of a broadcast message in a binary datagram.
+
+    Parameters
+    ----------
+    message : dict
+        Broadcast message, mapping tag ids to [epoch, elapsed, x, y, z, roll,
+        pitch, yaw] as built by TagLogger.update_broadcast_msg, optionally
+        followed by [vx, vy, vz, roll rate, pitch rate, yaw rate]
+    sequence : int
+        Sequence number of the datagram
+    header : dict
+        frame_id, capture_time, latency [ms] and timings {stage: [ms]} of the
+        frame the poses were measured in
+    frame_type : str
+        Reference frame of the poses, NED or ENU
+
+    Returns
+    -------
+    bytes
+        The datagram
+    """
+    if header is None:
+        header = {}
+    timings = header.get("timings", {})
+    flags = FLAG_NED if frame_type == "NED" else 0
+    record, fields = RECORD, 8
+    if any(len(values) > 8 for values in message.values()):
+        flags |= FLAG_VELOCITY
+        record, fields = RECORD_VELOCITY, 14
+    data = bytearray(HEADER.size + record.size * len(message))
+    HEADER.pack_into(
+        data,
+        0,
+        MAGIC,
+        VERSION,
+        flags,
+        len(message),
+        sequence & 0xFFFFFFFF,
+        header.get("frame_id", 0) & 0xFFFFFFFF,
+        header.get("capture_time", 0.0),
+        header.get("latency", 0.0),
+        *[timings.get(stage, 0.0) for stage in TIMED_STAGES],
+    )
+    offset = HEADER.size
+    for tag_id, values in message.items():
+        if len(values) < fields:
+            # -- Tags without a velocity estimate
+            values = list(values) + [float("nan")] * (fields - len(values))
+        record.pack_into(data, offset, int(tag_id), *values[:fields])
+        offset += record.size
+    return bytes(data)
+
+
+def decode_message(data):
+    """Unpack a binary datagram.
+
+    Parameters
+    ----------
+    data : bytes
+        The datagram
+
+    Returns
+    -------
+    dict
+        Header with the version, sequence, frame_id and frame fields, and
+        from version 2 the capture_time, latency and timings fields
+    dict
+        Tag ids mapped to [epoch, elapsed, x, y, z, roll, pitch, yaw], followed
+        by the velocities if the message carries them
+    """
+    magic, version, flags, count, sequence, frame_id = HEADER_V1.unpack_from(data)
+    if magic != MAGIC:
+        raise ValueError("Not an ArUco binary message")
+    if version > VERSION:
+        raise ValueError("Unsupported message version {}".format(version))
+    header = {
+        "version": version,
+        "sequence": sequence,
+        "frame_id": frame_id,
+        "frame": "NED" if flags & FLAG_NED else "ENU",
+    }
+    header_size = HEADER_V1.size
+    if version >= 2:
+        values = HEADER.unpack_from(data)
+        header["capture_time"] = values[6]
+        header["latency"] = values[7]
+        header["timings"] = dict(zip(TIMED_STAGES, values[8:]))
+        header_size = HEADER.size
+    record = RECORD_VELOCITY if flags & FLAG_VELOCITY else RECORD
+    tags = {}
+    for values in record.iter_unpack(
+        memoryview(data)[header_size : header_size + count * record.size]
+    ):
+        tags[values[0]] = list(values[1:])
+    return header, tags
@@ -0,0 +1,201 @@
+import json
+import socket
+
+from .protocol import encode_message
+
+TARGET_TYPES = ["udp", "multicast", "unix"]
+# -- Settings every target of a type must have
+TARGET_KEYS = {"udp": ["ip", "port"], "multicast": ["group", "port"], "unix": ["path"]}
+
+
+class Target:
+    """Destination of the published datagrams.
+
+    Sockets are non-blocking: a datagram that cannot be sent immediately is
+    dropped and counted rather than delaying the other targets.
+    """
+
+    def __init__(self, sock, address):
+        sock.setblocking(False)
+        self.socket = sock
+        self.address = address
+        self.sent = 0
+        self.dropped = 0
+        self.last_error = None
+
+    def send(self, data):
+        try:
+            self.socket.sendto(data, self.address)
+            self.sent += 1
+        except OSError as e:
+            # -- Full send buffer, unreachable host or no local listener
+            self.dropped += 1
+            self.last_error = e
+
+    def close(self):
+        self.socket.close()
+
+    def __str__(self):
+        return "{} {}".format(type(self).__name__, self.address)
+
+
+class UDPTarget(Target):
+    def __init__(self, ip, port):
+        """Unicast or broadcast UDP destination.
+
+        Parameters
+        ----------
+        ip : str
+            Host address, or a broadcast address such as 255.255.255.255
+        port : int
+            Destination port
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        # -- Enable port reusage
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        # -- Enable broadcasting mode
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_BROADCAST, 1)
+        super().__init__(sock, (ip, int(port)))
+
+
+class MulticastTarget(Target):
+    def __init__(self, group, port, ttl=1, interface="", loopback=True):
+        """IP multicast destination.
+
+        Parameters
+        ----------
+        group : str
+            Multicast group address, e.g. 239.0.0.1
+        port : int
+            Destination port
+        ttl : int
+            Number of routers the datagrams may cross, 1 keeps them on the
+            local network
+        interface : str
+            Address of the interface to send from, empty for the default one
+        loopback : bool
+            Deliver the datagrams to listeners on this host as well
+        """
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM, socket.IPPROTO_UDP)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, int(ttl))
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_LOOP, int(loopback))
+        if interface:
+            sock.setsockopt(
+                socket.IPPROTO_IP, socket.IP_MULTICAST_IF, socket.inet_aton(interface)
+            )
+        super().__init__(sock, (group, int(port)))
+
+
+class UnixTarget(Target):
+    def __init__(self, path):
+        """Unix datagram socket, for consumers running on the same host.
+
+        Parameters
+        ----------
+        path : str
+            Path of the socket bound by the consumer. Datagrams are dropped
+            while nothing is bound to it
+        """
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        super().__init__(sock, str(path))
+
+
+def create_target(target):
+    """Create a target from its configuration.
+
+    Parameters
+    ----------
+    target : dict
+        type (udp, multicast or unix) and the parameters of that target type:
+        ip and port, group, port, ttl, interface and loopback, or path
+    """
+    kind = target.get("type", "udp")
+    if kind == "udp":
+        return UDPTarget(target["ip"], target["port"])
+    elif kind == "multicast":
+        return MulticastTarget(
+            target["group"],
+            target["port"],
+            target.get("ttl", 1),
+            target.get("interface", ""),
+            target.get("loopback", True),
+        )
+    elif kind == "unix":
+        return UnixTarget(target["path"])
+    raise ValueError(f"Unknown publisher target type {kind}")
+
+
+class Publisher:
+    def __init__(self, targets, message_format="json"):
+        """Send the tag poses to several destinations.
+
+        Each message is encoded once and the same datagram is sent to every
+        target, so adding targets costs one system call each.
+
+        Parameters
+        ----------
+        targets : list
+            Target instances, or target configurations for create_target
+        message_format : str
+            json for pretty-printed JSON, binary for the packed format of the
+            protocol module
+        """
+        self.targets = [create_target(t) if isinstance(t, dict) else t for t in targets]
+        self.message_format = message_format
+        self.sequence = 0
+
+    def encode(self, message, header=None, frame_type="NED"):
+        """Encode a message as a datagram and advance the sequence number."""
+        if self.message_format == "binary":
+            data = encode_message(message, self.sequence, header, frame_type)
+        else:
+            # -- The tags are kept apart from the header, so that every key of
+            # -- "tags" is a tag id, as in the messages of the stream server
+            message = {
+                "header": dict(header or {}, sequence=self.sequence),
+                "frame": frame_type,
+                "tags": message,
+            }
+            # -- Broadcast the dictionary as a bytes-like object (string-like info) and empties
+            data = json.dumps(message, indent=3).encode("utf-8")
+        self.sequence += 1
+        return data
+
+    def broadcast(self, message, header=None, frame_type="NED"):
+        """Send a message to all the targets.
+
+        Parameters
+        ----------
+        message : dict
+            Tag poses by tag id
+        header : dict
+            Frame id, capture time, latency and stage timings of the frame the
+            poses were measured in. In JSON it is sent under the "header" key
+            together with the datagram sequence number, and the poses under
+            the "tags" key
+        frame_type : str
+            Reference frame of the poses, used by the binary format
+        """
+        data = self.encode(message, header, frame_type)
+        for target in self.targets:
+            target.send(data)
+
+    def send(self, message):
+        """Send a JSON message to all the targets, without a sequence number.
+
+        Used for the status messages, which are not part of the pose stream.
+        """
+        data = json.dumps(message, indent=3).encode("utf-8")
+        for target in self.targets:
+            target.send(data)
+
+    def close(self):
+        for target in self.targets:
+            message = "{}: sent {} datagrams, dropped {}".format(
+                target, target.sent, target.dropped
+            )
+            if target.last_error is not None:
+                message += " (last error: {})".format(target.last_error)
+            print(message)
+            target.close()
+        self.targets = []
@@ -0,0 +1,201 @@
+import asyncio
+import json
+import threading
+
+
+class StreamClient:
+    def __init__(self, writer):
+        """Subscription of one connected client.
+
+        Only the latest sample is kept: a sample that has not been sent when
+        the next one arrives, because of the client's rate limit or a slow
+        connection, is dropped rather than queued.
+        """
+        self.writer = writer
+        self.peer = writer.get_extra_info("peername")
+        self.tags = None  # -- None subscribes to all the tags
+        self.interval = 0.0  # -- [s], 0 sends every frame
+        self.sample = None
+        self.ready = asyncio.Event()
+        self.last_send_time = float("-inf")
+        self.sent = 0
+        self.dropped = 0
+
+    def subscribe(self, tags=None, rate=0.0):
+        """Set the tag ids and update rate of the client.
+
+        Parameters
+        ----------
+        tags : list
+            Tag ids to receive, None or "all" for all of them
+        rate : float
+            Maximum number of updates per second, 0 for every frame
+        """
+        if tags is None or tags == "all":
+            self.tags = None
+        elif isinstance(tags, list):
+            self.tags = {str(t) for t in tags}
+        else:
+            raise ValueError("tags must be a list of tag ids or 'all'")
+        rate = float(rate)
+        if rate < 0:
+            raise ValueError("rate must be positive, or 0 for every frame")
+        self.interval = 1.0 / rate if rate > 0 else 0.0
+
+    def offer(self, message, header, frame_type):
+        """Replace the pending sample with the subscribed tags of a message."""
+        if self.tags is not None:
+            message = {k: v for k, v in message.items() if str(k) in self.tags}
+        if not message:
+            return
+        if self.sample is not None:
+            self.dropped += 1
+        self.sample = (message, header, frame_type)
+        self.ready.set()
+
+
+class StreamServer:
+    def __init__(self, host="0.0.0.0", port=50002, max_clients=16):
+        """TCP server streaming the tag poses to subscribed clients.
+
+        Clients send one JSON object per line to subscribe, e.g.
+        {"tags": [1, 2], "rate": 10} or {"tags": "all", "rate": 0}, and may
+        send another one at any time to change their subscription. Each line
+        sent back is a JSON object with the header, frame and tags of a frame.
+
+        The server runs an asyncio loop on a background thread. publish() only
+        hands the message over to that loop, so it never blocks the caller.
+
+        Parameters
+        ----------
+        host : str
+            Address to listen on
+        port : int
+            TCP port to listen on
+        max_clients : int
+            Connections beyond this number are refused
+        """
+        self.host = host
+        self.port = port
+        self.max_clients = max_clients
+        self.clients = set()
+        self.loop = None
+        self.stopping = None
+        self.thread = None
+        self.started = threading.Event()
+        self.error = None
+
+    def start(self):
+        """Start listening, raising an OSError if the port cannot be bound."""
+        self.thread = threading.Thread(target=self.run, name="stream", daemon=True)
+        self.thread.start()
+        self.started.wait()
+        if self.error is not None:
+            raise self.error
+        print("Streaming tag poses on {}:{}".format(self.host, self.port))
+
+    def run(self):
+        try:
+            asyncio.run(self.serve())
+        except OSError as e:
+            self.error = e
+            self.started.set()
+
+    async def serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopping = asyncio.Event()
+        server = await asyncio.start_server(self.handle_client, self.host, self.port)
+        self.started.set()
+        async with server:
+            await self.stopping.wait()
+        for client in list(self.clients):
+            client.writer.close()
+
+    def stop(self):
+        if self.loop is None or self.thread is None:
+            return
+        self.loop.call_soon_threadsafe(self.stopping.set)
+        self.thread.join(timeout=1.0)
+        self.thread = None
+
+    def publish(self, message, header=None, frame_type="NED"):
+        """Offer the tag poses of a frame to the clients. Thread safe.
+
+        Parameters
+        ----------
+        message : dict
+            Tag poses by tag id, as broadcast by the Publisher
+        header : dict
+            Frame id, capture time, latency and stage timings of the frame
+        frame_type : str
+            Reference frame of the poses
+        """
+        if self.loop is None or not self.clients or not message:
+            return
+        self.loop.call_soon_threadsafe(self.dispatch, message, header, frame_type)
+
+    def dispatch(self, message, header, frame_type):
+        for client in self.clients:
+            client.offer(message, header, frame_type)
+
+    async def handle_client(self, reader, writer):
+        if len(self.clients) >= self.max_clients:
+            writer.write(self.encode({"error": "Too many clients"}))
+            writer.close()
+            return
+        client = StreamClient(writer)
+        self.clients.add(client)
+        print("Stream client {} connected".format(client.peer))
+        sender = asyncio.ensure_future(self.send_loop(client))
+        try:
+            async for line in reader:
+                if not line.strip():
+                    continue
+                try:
+                    request = json.loads(line)
+                    client.subscribe(request.get("tags"), request.get("rate", 0.0))
+                except (ValueError, TypeError, AttributeError) as e:
+                    writer.write(self.encode({"error": str(e)}))
+                    continue
+                reply = {
+                    "tags": "all" if client.tags is None else sorted(client.tags),
+                    "rate": 1.0 / client.interval if client.interval > 0 else 0.0,
+                }
+                writer.write(self.encode({"subscribed": reply}))
+        except (ConnectionError, asyncio.CancelledError):
+            # -- Client gone, or server stopping
+            pass
+        finally:
+            self.clients.discard(client)
+            sender.cancel()
+            writer.close()
+            print(
+                "Stream client {} disconnected: sent {} samples, dropped {}".format(
+                    client.peer, client.sent, client.dropped
+                )
+            )
+
+    async def send_loop(self, client):
+        try:
+            while True:
+                await client.ready.wait()
+                # -- Wait for the rate limit, keeping the freshest sample
+                delay = client.last_send_time + client.interval - self.loop.time()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                client.ready.clear()
+                sample, client.sample = client.sample, None
+                if sample is None:
+                    continue
+                message, header, frame_type = sample
+                sample = {"header": header, "frame": frame_type, "tags": message}
+                client.writer.write(self.encode(sample))
+                client.last_send_time = self.loop.time()
+                client.sent += 1
+                await client.writer.drain()
+        except ConnectionError:
+            pass
+
+    @staticmethod
+    def encode(message):
+        return (json.dumps(message) + "\n").encode("utf-8")
@@ -1,33 +1,90 @@
-import csv
 from pathlib import Path
 
-from .udp_broadcast_server import UDPBroadcastServer
+from .log_writer import CsvSink
+
+TAG_LOG_HEADER = [
+    "epoch [s]",
+    "elapsed [s]",
+    "x [m]",
+    "y [m]",
+    "z [m]",
+    "roll [deg]",
+    "pitch [deg]",
+    "yaw [deg]",
+    "broadcasted 1=yes",
+]
+SESSION_LOG_HEADER = ["tag id"] + TAG_LOG_HEADER
+TIMING_LOG_HEADER = [
+    "sequence",
+    "epoch [s]",
+    "grab [ms]",
+    "detect [ms]",
+    "pose [ms]",
+    "publish [ms]",
+    "latency [ms]",
+    "tags",
+    "broadcasted 1=yes",
+    "log queue depth",
+]
 
 
 class TagLogger:
-    def __init__(self, tag_id, tag_name, tag_color, log_dir):
+    def __init__(
+        self,
+        tag_id,
+        tag_name,
+        tag_color,
+        log_dir,
+        buffer_size=65536,
+        flush_interval=1.0,
+        flush_rows=100,
+        sink=None,
+        writer=None,
+    ):
+        """Log the detections of a tag.
+
+        By default each tag is logged to its own CSV file. If a sink is given,
+        rows are written to it prefixed with the tag id instead. This allows
+        all tags of a session to share a single file, or other log formats.
+
+        Parameters
+        ----------
+        tag_id : int
+            ArUco id of the tag
+        tag_name : str
+            Name of the tag, used in the filename
+        tag_color : tuple
+            BGR colour of the tag
+        log_dir : Path
+            Folder where the CSV file is written
+        buffer_size : int
+            Size of the file buffer in bytes
+        flush_interval : float
+            Maximum time in seconds a row stays in the buffer
+        flush_rows : int
+            Maximum number of rows kept in the buffer
+        sink : CsvSink or BinarySink
+            Sink with a tag id column. If None, a file for this tag is created
+        writer : LogWriter
+            Background writer. If None, rows are written synchronously
+        """
         self.tag_id = tag_id
         self.tag_name = tag_name
         self.tag_color = tag_color
-        self.fname = Path(log_dir) / f"{tag_id}_{tag_name}.csv"
-        with self.fname.open("w", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(
-                [
-                    "epoch [s]",
-                    "elapsed [s]",
-                    "x [m]",
-                    "y [m]",
-                    "z [m]",
-                    "roll [deg]",
-                    "pitch [deg]",
-                    "yaw [deg]",
-                    "broadcasted 1=yes",
-                ]
+        self.writer = writer
+        self.owns_sink = sink is None
+        if sink is None:
+            sink = CsvSink(
+                Path(log_dir) / f"{tag_id}_{tag_name}.csv",
+                TAG_LOG_HEADER,
+                buffer_size,
+                flush_interval,
+                flush_rows,
             )
-            file.close()
+        self.sink = sink
+        self.fname = sink.fname
 
-    def update_broadcast_msg(self, msg_dict: dict):
+    def update_broadcast_msg(self, msg_dict: dict, velocity=None):
         # -- Broadcast the tag position and rotation
         msg_dict[self.tag_id] = [
             self.current_time,
@@ -39,6 +96,9 @@ class TagLogger:
             self.tag_rotation[1],
             self.tag_rotation[2],
         ]
+        # -- Followed by the linear and angular velocities, if estimated
+        if velocity is not None:
+            msg_dict[self.tag_id].extend(velocity)
         return msg_dict
 
     def log(self, current_time, elapsed_time, tag_position, tag_rotation, broadcasted):
@@ -47,19 +107,31 @@ class TagLogger:
         self.tag_position = tag_position
         self.tag_rotation = tag_rotation
         # -- Log the detection of the tag
-        with self.fname.open("a", newline="") as file:
-            writer = csv.writer(file)
-            writer.writerow(
-                [
-                    current_time,
-                    elapsed_time,
-                    tag_position[0],
-                    tag_position[1],
-                    tag_position[2],
-                    tag_rotation[0],
-                    tag_rotation[1],
-                    tag_rotation[2],
-                    broadcasted,
-                ]
-            )
-            file.close()
+        row = [
+            current_time,
+            elapsed_time,
+            tag_position[0],
+            tag_position[1],
+            tag_position[2],
+            tag_rotation[0],
+            tag_rotation[1],
+            tag_rotation[2],
+            broadcasted,
+        ]
+        if not self.owns_sink:
+            row.insert(0, self.tag_id)
+        if self.writer is not None:
+            self.writer.submit(self.sink, row)
+        else:
+            self.sink.write_row(row)
+
+    def flush_if_due(self):
+        """Flush the buffered rows if the row count or time limit is reached."""
+        # The background writer takes care of flushing its sinks
+        if self.writer is None:
+            self.sink.flush_if_due()
+
+    def close(self):
+        """Flush the buffered rows and close the file, if created here."""
+        if self.owns_sink:
+            self.sink.close()
@@ -0,0 +1,159 @@
+import hashlib
+import os
+from pathlib import Path
+
+import cv2
+import numpy as np
+
+UNDISTORT_MODES = ["none", "image", "points"]
+
+
+def calibration_key(camera_matrix, camera_distortion, size):
+    """Short hash identifying a calibration and an image size."""
+    digest = hashlib.sha1()
+    digest.update(np.asarray(camera_matrix, dtype=np.float64).tobytes())
+    digest.update(np.asarray(camera_distortion, dtype=np.float64).ravel().tobytes())
+    digest.update(np.asarray(size, dtype=np.int64).tobytes())
+    return digest.hexdigest()[:16]
+
+
+def undistortion_maps(camera_matrix, camera_distortion, size, cache_dir=None):
+    """Maps of cv2.remap() removing the lens distortion of the images.
+
+    The rectified images keep the camera matrix of the distorted ones. The
+    maps are in the fixed-point CV_16SC2 form, which is smaller and faster to
+    remap with than floating-point maps.
+
+    Parameters
+    ----------
+    camera_matrix : np.ndarray
+        3x3 camera intrinsic matrix
+    camera_distortion : np.ndarray
+        Distortion coefficients of the camera
+    size : tuple
+        (width, height) of the images
+    cache_dir : Path
+        Folder where the maps are saved, keyed by the calibration and size,
+        so that they are only computed once. None disables the cache
+
+    Returns
+    -------
+    np.ndarray
+        (height, width, 2) int16 integer pixel coordinates
+    np.ndarray
+        (height, width) uint16 interpolation table indices
+    """
+    camera_matrix = np.asarray(camera_matrix, dtype=np.float64)
+    camera_distortion = np.asarray(camera_distortion, dtype=np.float64)
+    path = None
+    if cache_dir is not None:
+        key = calibration_key(camera_matrix, camera_distortion, size)
+        path = Path(cache_dir) / "undistort_{}x{}_{}.npz".format(size[0], size[1], key)
+        if path.exists():
+            try:
+                with np.load(path) as maps:
+                    return maps["map1"], maps["map2"]
+            except (OSError, ValueError, KeyError):
+                print("Ignoring the corrupted undistortion maps {}".format(path))
+    map1, map2 = cv2.initUndistortRectifyMap(
+        camera_matrix, camera_distortion, None, camera_matrix, size, cv2.CV_16SC2
+    )
+    if path is not None:
+        path.parent.mkdir(parents=True, exist_ok=True)
+        # -- Written aside and renamed, as several processes may share the cache
+        temporary = path.with_name("{}.{}.tmp.npz".format(path.stem, os.getpid()))
+        np.savez(temporary, map1=map1, map2=map2)
+        os.replace(temporary, path)
+    return map1, map2
+
+
+class Undistortion:
+    def __init__(self, camera_matrix, camera_distortion, cache_dir=None, iterations=20):
+        """Removal of the lens distortion from images and image points.
+
+        Parameters
+        ----------
+        camera_matrix : list
+            3x3 camera intrinsic matrix
+        camera_distortion : list
+            Distortion coefficients of the camera
+        cache_dir : Path
+            Folder where the undistortion maps are cached. None computes them
+            every time the program starts
+        iterations : int
+            Maximum number of iterations when undistorting points. Strong
+            wide-angle distortions need more than the 5 of cv2.undistortPoints
+        """
+        self.camera_matrix = np.array(camera_matrix, dtype=np.float64)
+        self.camera_distortion = np.array(camera_distortion, dtype=np.float64)
+        self.inverse_matrix = np.linalg.inv(self.camera_matrix)
+        self.cache_dir = cache_dir
+        self.criteria = (
+            cv2.TERM_CRITERIA_COUNT + cv2.TERM_CRITERIA_EPS,
+            iterations,
+            1e-6,
+        )
+        # -- Remap tables, computed for the size of the first image
+        self.size = None
+        self.map1 = None
+        self.map2 = None
+
+    def rectify(self, image, dst=None):
+        """Remove the distortion of an image, into dst if given."""
+        size = (image.shape[1], image.shape[0])
+        if size != self.size:
+            self.map1, self.map2 = undistortion_maps(
+                self.camera_matrix, self.camera_distortion, size, self.cache_dir
+            )
+            self.size = size
+        return cv2.remap(image, self.map1, self.map2, cv2.INTER_LINEAR, dst=dst)
+
+    def undistort_points(self, points):
+        """Pixel coordinates without distortion of distorted image points.
+
+        Parameters
+        ----------
+        points : np.ndarray
+            (..., 2) pixel coordinates in the distorted image
+
+        Returns
+        -------
+        np.ndarray
+            Pixel coordinates of the same shape in the rectified image
+        """
+        points = np.asarray(points, dtype=np.float32)
+        undistorted = cv2.undistortPointsIter(
+            points.reshape(-1, 1, 2),
+            self.camera_matrix,
+            self.camera_distortion,
+            None,
+            self.camera_matrix,
+            self.criteria,
+        )
+        return undistorted.reshape(points.shape)
+
+    def distort_points(self, points):
+        """Pixel coordinates in the distorted image of rectified image points.
+
+        Parameters
+        ----------
+        points : np.ndarray
+            (..., 2) pixel coordinates in the rectified image
+
+        Returns
+        -------
+        np.ndarray
+            Pixel coordinates of the same shape in the distorted image
+        """
+        points = np.asarray(points, dtype=np.float32)
+        homogeneous = np.ones((points.size // 2, 3))
+        homogeneous[:, :2] = points.reshape(-1, 2)
+        rays = homogeneous @ self.inverse_matrix.T
+        distorted, _ = cv2.projectPoints(
+            rays,
+            np.zeros(3),
+            np.zeros(3),
+            self.camera_matrix,
+            self.camera_distortion,
+        )
+        return distorted.astype(np.float32).reshape(points.shape)